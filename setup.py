@@ -23,7 +23,6 @@ _ = os.path.abspath(os.path.dirname(__file__))
 requirements = [
     'spacy',
     'nltk',
-    'tqdm'
     ]
 
 setup(
@@ -37,5 +36,9 @@ setup(
     author_email='johnsigmon@gmail.com, sanjanakapoor793@gmail.com',
     packages=['text_pipeline'],
     license='MIT',
-    install_requires=requirements
+    install_requires=requirements,
+    extras_require={'yaml': ['pyyaml'], 'progress': ['tqdm']},
+    entry_points={
+        'console_scripts': ['text-pipeline = text_pipeline.cli:main'],
+        }
 )
@@ -9,16 +9,143 @@ Last modified: 7/2/18
 """
 
 import os
+import sys
+import json
+import subprocess
+import tempfile
 import warnings
+import functools
+import asyncio
+import concurrent.futures
+import time
+import contextlib
+import io
 import pickle as pkl
+import weakref
+from types import SimpleNamespace
+from collections import Counter
 import unittest
+from unittest import mock
 from text_pipeline import TokenFilter
 from text_pipeline import Tokenizer 
+from text_pipeline import Normalizer
 from text_pipeline import Stemmer
 from text_pipeline import Pipeline
+from text_pipeline import ModelRegistry
+from text_pipeline import Vocabulary
+from text_pipeline import ResultCache
+from text_pipeline import TokenStore, TokenStoreWriter, write_store
+from text_pipeline import Corpus, write_corpus
+from text_pipeline import cli
+from text_pipeline import benchmark
+from text_pipeline import Hook, JsonSink, PrometheusSink
+from text_pipeline.Pipeline import SpacyStage, _stage_cost, \
+        _apply_spec_batch, _spec_pipelines
+from text_pipeline.ResultCache import fingerprint
+from text_pipeline.Stemmer import TokenCache
+from text_pipeline.CountMinSketch import CountMinSketch
 
 ROOT_PATH = os.path.dirname(os.path.realpath(__file__))
 
+# Cold start budget for `import text_pipeline`, in seconds
+IMPORT_TIME_BUDGET = 0.5
+
+class WhitespaceSplit():
+    '''
+    Minimal pipeline step that does not need any backend.
+    '''
+
+    barrier = False
+
+    def apply(self, docs):
+        return [doc.split() for doc in docs]
+
+
+class FailOnce():
+    '''
+    Pipeline step that fails on its n-th batch, once, like a run that is
+    preempted part way through.
+    '''
+
+    barrier = False
+
+    def __init__(self, n):
+        self.n = n
+        # Private, so that they are not part of the pipeline's fingerprint
+        self._calls = 0
+        self._seen = 0
+
+    def apply(self, docs):
+        self._calls += 1
+        if self._calls == self.n:
+            raise RuntimeError("Preempted")
+        self._seen += len(docs)
+        return docs
+
+
+class SlowSplit(WhitespaceSplit):
+    '''
+    WhitespaceSplit that takes a while per batch.
+    '''
+
+    def __init__(self):
+        self._batches = 0
+
+    def apply(self, docs):
+        time.sleep(0.01)
+        self._batches += 1
+        return super().apply(docs)
+
+
+class DropWords():
+    '''
+    Token level filter step that does not need any backend.
+    '''
+
+    barrier = False
+
+    def __init__(self, words):
+        self.words = set(words)
+        self._seen = 0
+
+    def apply(self, docs):
+        return [[w for w in doc if w not in self.words] for doc in docs]
+
+    def _token_op(self):
+        def keep(words):
+            self._seen += len(words)
+            return [w not in self.words for w in words]
+        return 'filter', keep
+
+
+class UpperCase():
+    '''
+    Token level map step that does not need any backend.
+    '''
+
+    barrier = False
+
+    def apply(self, docs):
+        return [[w.upper() for w in doc] for doc in docs]
+
+    def _token_op(self):
+        return 'map', lambda words: [w.upper() for w in words]
+
+
+class ProgressHook(Hook):
+    '''
+    Records progress calls.
+    '''
+
+    progress = True
+
+    def __init__(self):
+        self.progressed = {}
+
+    def on_progress(self, index, name, n):
+        self.progressed[name] = self.progressed.get(name, 0) + n
+
+
 class TestPipeline(unittest.TestCase):
    
     def setUp(self):
@@ -142,6 +269,23 @@ class TestPipeline(unittest.TestCase):
         self.assertEqual(test_output, expected_output, 
                 'NLTK did not remove non English words')
 
+    def test_oov_vocab_file(self):
+        docs = [['this', 'sentence', 'has', 'gii', 'only'], ['lalew']]
+        expected_output = [['this', 'sentence', 'only'], []]
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'vocab.txt')
+            with open(path, 'w') as f:
+                f.write('this\nsentence\nonly\n')
+            f = TokenFilter('nltk', remove_stops=False, remove_oov=True,
+                    vocab_file=path)
+            g = TokenFilter('nltk', remove_stops=False, remove_oov=True,
+                    vocab_file=path)
+        self.assertIsInstance(f.vocab, frozenset)
+        self.assertIs(f.vocab, g.vocab)
+        self.assertEqual(list(f.stream(docs)), expected_output)
+        # Sent to other processes by name, not by value
+        self.assertIs(pkl.loads(pkl.dumps(f)).vocab, f.vocab)
+
     def test_spacy_numbers(self):
         warnings.simplefilter('ignore')
         expected_output = [['this', 'sentence', '$', 'has', 'no', 'numbers']]
@@ -165,6 +309,25 @@ class TestPipeline(unittest.TestCase):
         self.assertEqual(test_output, expected_output, 
                 'Spacy did not remove numbers')
 
+    def test_spacy_compiled_checks(self):
+        def lexeme(**attrs):
+            flags = dict.fromkeys(['is_stop', 'is_alpha', 'is_digit',
+                'is_punct', 'like_num', 'like_email', 'like_url'], False)
+            flags.update(attrs)
+            return SimpleNamespace(**flags)
+
+        f = TokenFilter('spacy', keep_alpha_nums=True, remove_stops=True,
+                remove_nums=True)
+        self.assertEqual(len(f._checks), 5)
+        self.assertTrue(f._spacy_decide(lexeme(is_alpha=True)))
+        self.assertFalse(f._spacy_decide(lexeme(is_alpha=True, is_stop=True)))
+        self.assertFalse(f._spacy_decide(lexeme(is_punct=True)))
+        self.assertFalse(f._spacy_decide(lexeme(is_digit=True, like_num=True)))
+        f = TokenFilter('spacy', keep_alpha_nums=False, remove_stops=False,
+                remove_url=False, remove_email=False)
+        self.assertEqual(f._checks, ())
+        self.assertTrue(f._spacy_decide(lexeme(is_punct=True)))
+
     def test_spacy_punct(self):
         warnings.simplefilter('ignore')
         expected_output = [['this', 'sentence', 'has', 'no', 'punctuation']]
@@ -330,6 +493,72 @@ class TestPipeline(unittest.TestCase):
         self.assertEqual(test_output, expected_output, 
                 'NLTK lemmatiZZZZzer did not lemmatize')
 
+    def test_stem_cache(self):
+        warnings.simplefilter('ignore')
+        docs = [['running', 'runs', 'running'], ['runs', 'crying']]
+        s = Stemmer('nltk', stemmer='porter')
+        test_output = s.apply(docs)
+        self.assertEqual(test_output, [['run', 'run', 'run'], ['run', 'cri']])
+        self.assertEqual(s.cache_info()['misses'], 3)
+        self.assertEqual(s.cache_info()['hits'], 2)
+
+    def test_token_cache_eviction(self):
+        words = ['a', 'b', 'a', 'c', 'a', 'd']
+        lru = TokenCache(2, 'lru')
+        fun = lru.wrap(str.upper)
+        self.assertEqual([fun(w) for w in words], [w.upper() for w in words])
+        self.assertEqual(lru.items(), [('a', 'A'), ('d', 'D')])
+        self.assertEqual(lru.info()['hits'], 2)
+        fifo = TokenCache(2, 'fifo')
+        fun = fifo.wrap(str.upper)
+        self.assertEqual([fun(w) for w in words], [w.upper() for w in words])
+        self.assertEqual(fifo.info()['hits'], 1)
+        self.assertRaises(ValueError, TokenCache, 2, 'random')
+
+    def test_spacy_decision_cache(self):
+        class Vocab(dict):
+            def __missing__(self, w):
+                return SimpleNamespace(is_stop=w == 'the', is_alpha=w.isalpha(),
+                        is_digit=w.isdigit(), is_punct=False, like_num=False,
+                        like_email=False, like_url=False)
+
+        nlp = SimpleNamespace(vocab=Vocab())
+        with mock.patch.object(TokenFilter, 'nlp', nlp):
+            words = ['w' + 'x' * i for i in range(50)]
+            docs = [['the', w, 'a', '!'] for w in words]
+            f = TokenFilter('spacy', cache_size=10)
+            self.assertEqual(f.apply(docs), [[w, 'a'] for w in words])
+            # Decisions stay bounded on an open vocabulary
+            info = f.cache_info()
+            self.assertEqual((info['size'], info['maxsize']), (10, 10))
+            self.assertEqual(info['misses'], 3 + 50)
+            self.assertEqual(pkl.loads(pkl.dumps(f)).cache_info()['size'], 0)
+            f = TokenFilter('spacy', cache_size=0)
+            self.assertEqual(f.apply(docs[:1]), [['w', 'a']])
+            self.assertIsNone(f.cache_info())
+        self.assertIsNone(TokenFilter('frequency', threshold=2).cache_info())
+
+    def test_stem_cache_file(self):
+        s = Stemmer('nltk', stemmer='porter')
+        s.cache.update([('running', 'run'), ('crying', 'cri')])
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'cache.json')
+            s.save_cache(path)
+            preloaded = Stemmer('nltk', stemmer='porter', cache_file=path)
+            self.assertEqual(preloaded.cache.items(), s.cache.items())
+            other = Stemmer('nltk', stemmer='snowball')
+            self.assertRaises(ValueError, other.load_cache, path)
+            # Without a cache there is nothing to save or load into
+            disabled = Stemmer('nltk', stemmer='porter', cache_size=0)
+            self.assertIsNone(disabled.cache_info())
+            self.assertRaises(ValueError, disabled.save_cache,
+                    os.path.join(tmp, 'disabled.json'))
+            self.assertFalse(os.path.exists(os.path.join(tmp,
+                'disabled.json')))
+            self.assertRaises(ValueError, disabled.load_cache, path)
+            self.assertRaises(ValueError, Stemmer, 'nltk', stemmer='porter',
+                    cache_size=0, cache_file=path)
+
     def test_remove_non_alphas_01(self):
         warnings.simplefilter('ignore')
         expected_output = [
@@ -457,6 +686,956 @@ class TestPipeline(unittest.TestCase):
     def test_freq_filter(self):
         pass
 
+    def test_parallel_freq_filter(self):
+        docs = ['a b c', 'a b', 'a d', 'e a', 'b b q'] * 3
+        p = Pipeline(
+                WhitespaceSplit(),
+                TokenFilter('frequency', threshold=4),
+                TokenFilter('frequency', threshold=7)
+                )
+        expected_output = list(p.stream(docs))
+        self.assertEqual(p.apply(docs, n_jobs=3, chunk_size=2),
+                expected_output)
+
+    def test_parallel_spacy(self):
+        warnings.simplefilter('ignore')
+        docs = [
+                self.test_docs['stopwords_01'],
+                self.test_docs['numbers_01'],
+                self.test_docs['stems_01'],
+                ] * 4
+        t = Tokenizer('spacy')
+        f = TokenFilter('spacy', remove_stops=True)
+        s = Stemmer('nltk', stemmer='porter')
+        p = Pipeline(t, f, s)
+        self.assertEqual(p.apply(docs, n_jobs=2, chunk_size=5), p.apply(docs))
+
+    def test_spacy_batch_size(self):
+        warnings.simplefilter('ignore')
+        docs = [
+                self.test_docs['stopwords_01'],
+                self.test_docs['numbers_01'],
+                self.test_docs['emails_01'],
+                self.test_docs['stems_01'],
+                ]
+        # Each document on its own, so no batch spans documents
+        f = TokenFilter('spacy')
+        tokens = [Tokenizer('spacy').apply([doc])[0] for doc in docs]
+        filtered = [f.apply([doc])[0] for doc in tokens]
+        expected_output = [Stemmer('spacy').apply([doc])[0]
+                for doc in filtered]
+        # Batches of 3 split the documents unevenly, and the Stemmer's
+        # batches share a single Doc that is cut back into documents
+        for batch_size in (1, 3, 1000):
+            t = Tokenizer('spacy', batch_size=batch_size)
+            s = Stemmer('spacy', batch_size=batch_size)
+            self.assertEqual(t.apply(docs), tokens)
+            self.assertEqual(s.apply(filtered), expected_output)
+            self.assertEqual(list(s.stream(iter(filtered))), expected_output)
+
+    def _ids_pipelines(self, tmp):
+        path = os.path.join(tmp, 'vocab.txt')
+        with open(path, 'w') as f:
+            f.write('a\nb\nc\nd\nq\n')
+        params = {'remove_stops': False, 'remove_oov': True, 'vocab_file': path}
+        return [Pipeline(
+            WhitespaceSplit(),
+            TokenFilter('nltk', **params),
+            TokenFilter('frequency', threshold=4),
+            TokenFilter('nltk', **params),
+            ids=ids) for ids in (False, True)]
+
+    def test_ids_stream(self):
+        docs = ['a b c', 'a b', 'a d', 'e a', 'b b q x'] * 3
+        with tempfile.TemporaryDirectory() as tmp:
+            strings, ids = self._ids_pipelines(tmp)
+            expected_output = list(strings.stream(docs))
+            self.assertEqual(list(ids.stream(docs)), expected_output)
+            self.assertEqual(ids.apply(docs, n_jobs=2, chunk_size=3),
+                    expected_output)
+        self.assertEqual(ids.vocab.strings, ['a', 'b', 'c', 'd', 'e', 'q', 'x'])
+
+    def test_ids_apply(self):
+        docs = ['a b c', 'a b', 'a d', 'e a', 'b b q x'] * 3
+        with tempfile.TemporaryDirectory() as tmp:
+            strings, ids = self._ids_pipelines(tmp)
+            self.assertEqual(ids.apply(docs), strings.apply(docs))
+
+    def test_vocabulary(self):
+        vocab = Vocabulary(['a'])
+        encoded = vocab.encode(['b', 'a', 'b', 'c'])
+        self.assertEqual(list(encoded), [1, 0, 1, 2])
+        self.assertEqual(vocab.decode(encoded), ['b', 'a', 'b', 'c'])
+        self.assertEqual(vocab.add('c'), 2)
+        self.assertEqual(len(vocab), 3)
+
+    def test_ids_spacy(self):
+        warnings.simplefilter('ignore')
+        docs = [
+                self.test_docs['stopwords_01'],
+                self.test_docs['numbers_01'],
+                self.test_docs['stems_01'],
+                ]
+        t = Tokenizer('nltk')
+        f = TokenFilter('spacy', remove_stops=True)
+        s = Stemmer('spacy')
+        f_2 = TokenFilter('frequency', threshold=1)
+        s_2 = Stemmer('nltk', stemmer='porter')
+        expected_output = Pipeline(t, f, s, f_2, s_2).apply(docs)
+        p = Pipeline(t, f, s, f_2, s_2, ids=True)
+        self.assertEqual(p.apply(docs), expected_output)
+
+    def test_shared_model(self):
+        warnings.simplefilter('ignore')
+        t = Tokenizer('spacy')
+        f = TokenFilter('spacy')
+        s = Stemmer('spacy')
+        self.assertIs(t.nlp, f.nlp)
+        self.assertIs(f.nlp, s.nlp)
+        self.assertTrue(ModelRegistry.is_loaded('en_core_web_sm'))
+        names = [m['name'] for m in ModelRegistry.stats()]
+        self.assertEqual(names.count('en_core_web_sm'), 1)
+
+    def test_freq_filter_stream(self):
+        docs = [['a', 'b', 'c'], ['a', 'b'], ['a', 'd']]
+        expected_output = [['a', 'b'], ['a', 'b'], ['a']]
+        f = TokenFilter('frequency', threshold=2)
+        self.assertTrue(f.barrier)
+        self.assertEqual(list(f.stream(iter(docs))), expected_output)
+        f = TokenFilter('frequency', threshold=2, spool=False)
+        self.assertEqual(list(f.stream(iter(docs))), expected_output)
+
+    def test_freq_counts_merge(self):
+        docs = [['a', 'b', 'c'], ['a', 'b'], ['a', 'd']] * 5
+        f = TokenFilter('frequency', threshold=6)
+        counts = f.count(docs)
+        self.assertEqual(counts['a'], 15)
+        self.assertEqual(f.merge_counts([f.count(docs[:4]), f.count(docs[4:])]),
+                counts)
+        shards = [docs[:7], functools.partial(list, docs[7:])]
+        self.assertEqual(f.count_shards(shards), counts)
+        self.assertEqual(f.count_shards(shards, n_jobs=2), counts)
+
+    def test_freq_filter_parallel(self):
+        docs = [['a', 'b', 'c'], ['a', 'b'], ['a', 'd']] * 5
+        expected_output = TokenFilter('frequency', threshold=6).apply(docs)
+        f = TokenFilter('frequency', threshold=6, n_jobs=2)
+        self.assertEqual(f.apply(docs), expected_output)
+
+    def test_freq_filter_approximate(self):
+        docs = [['a', 'b', 'c'], ['a', 'b'], ['a', 'd']] * 2
+        exact = TokenFilter('frequency', threshold=3)
+        approximate = TokenFilter('frequency', threshold=3, approximate=True,
+                memory=2 ** 16)
+        self.assertEqual(list(approximate.stream(docs)),
+                list(exact.stream(docs)))
+        # Chunks send exact counts, folded into one sketch
+        self.assertIsInstance(approximate._barrier_partial(docs), Counter)
+        self.assertEqual(Pipeline(approximate).apply(docs, n_jobs=2,
+            chunk_size=2), exact.apply(docs))
+
+    def test_freq_fit_transform(self):
+        history = [['a', 'b', 'c'], ['a', 'b']]
+        batch = [['a', 'c', 'x']]
+        for approximate in (False, True):
+            f = TokenFilter('frequency', threshold=2, approximate=approximate,
+                    memory=2 ** 12)
+            self.assertRaises(ValueError, f.transform, batch)
+            self.assertEqual(f.fit(history).transform(batch), [['a']])
+            f.fit(batch)
+            self.assertEqual(f.transform(batch), [['a', 'c']])
+            with tempfile.TemporaryDirectory() as tmp:
+                path = os.path.join(tmp, 'counts.gz')
+                TokenFilter('frequency', threshold=2, approximate=approximate,
+                        memory=2 ** 12).fit(history).save_counts(path)
+                # A daily job only counts the new batch
+                daily = TokenFilter('frequency', threshold=2,
+                        approximate=approximate, memory=2 ** 12,
+                        counts_file=path, incremental=True)
+                self.assertEqual(daily.apply(batch), [['a', 'c']])
+                self.assertEqual(daily.counts['a'], 3)
+                self.assertRaises(ValueError, TokenFilter, 'frequency',
+                        threshold=2, approximate=not approximate,
+                        counts_file=path)
+
+        # Stored counts are keyed by word, also when tokens are IDs
+        for ids in (False, True):
+            f = TokenFilter('frequency', threshold=2, incremental=True)
+            p = Pipeline(WhitespaceSplit(), f, ids=ids)
+            self.assertEqual(p.apply(['a b', 'b']), [['b'], ['b']])
+            self.assertEqual(p.apply(['c', 'c a']), [['c'], ['c', 'a']])
+            self.assertEqual(f.counts, Counter({'a': 2, 'b': 2, 'c': 2}))
+
+    def test_result_cache(self):
+        docs = ['a b c', 'a b', 'a d']
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'cache.db')
+            expected_output = Pipeline(WhitespaceSplit(),
+                    TokenFilter('frequency', threshold=2)).apply(docs)
+            p = Pipeline(WhitespaceSplit(),
+                    TokenFilter('frequency', threshold=2), cache=path)
+            self.assertEqual(p.apply(docs), expected_output)
+            self.assertEqual(p.cache.info()['misses'], 3)
+            # Barriers see the whole corpus, cached or not
+            p = Pipeline(WhitespaceSplit(),
+                    TokenFilter('frequency', threshold=2), cache=path)
+            self.assertEqual(p.apply(docs[:2] + ['a e']),
+                    [['a', 'b'], ['a', 'b'], ['a']])
+            self.assertEqual(p.cache.info()['hits'], 2)
+            self.assertEqual(list(p.stream(iter(docs), batch_size=2)),
+                    expected_output)
+            self.assertEqual(p.cache.info()['hits'], 5)
+            # A different configuration does not reuse the entries
+            p = Pipeline(WhitespaceSplit(),
+                    TokenFilter('nltk', remove_stops=False), cache=path)
+            self.assertNotEqual(p.fingerprint, Pipeline(WhitespaceSplit(),
+                    TokenFilter('nltk', to_lower=False, remove_stops=False),
+                    cache=path).fingerprint)
+
+            # Files are fingerprinted by their contents, not their paths
+            def write(name, data):
+                with open(os.path.join(tmp, name), 'w') as f:
+                    f.write(data)
+                return os.path.join(tmp, name)
+
+            table = write('lemmas.json', '{"ran": "run"}')
+            same = write('same.json', '{"ran": "run"}')
+            edited = write('edited.json', '{"ran": "running"}')
+            self.assertEqual(fingerprint([Stemmer('spacy', lemma_table=table)]),
+                    fingerprint([Stemmer('spacy', lemma_table=same)]))
+            self.assertNotEqual(fingerprint([Stemmer('spacy',
+                lemma_table=table)]), fingerprint([Stemmer('spacy',
+                    lemma_table=edited)]))
+            before = fingerprint([Stemmer('spacy', lemma_table=table)])
+            write('lemmas.json', '{"ran": "running"}')
+            self.assertNotEqual(before, fingerprint([Stemmer('spacy',
+                lemma_table=table)]))
+            words = write('words.txt', 'a\nb\n')
+            more_words = write('more_words.txt', 'a\nb\nc\n')
+            f = TokenFilter('nltk', remove_stops=False, remove_oov=True,
+                    vocab_file=words)
+            self.assertNotEqual(fingerprint([f]), fingerprint([TokenFilter(
+                'nltk', remove_stops=False, remove_oov=True,
+                vocab_file=more_words)]))
+            # The digest of a word list is computed once, when it is loaded
+            self.assertIsNotNone(f.vocab.digest)
+
+    def test_result_cache_eviction(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            cache = ResultCache(os.path.join(tmp, 'cache.db'), max_entries=2)
+            cache.set_many([(b'a', ['a']), (b'b', ['b'])])
+            cache.get_many([b'a'])
+            cache.set_many([(b'c', ['c'])])
+            # b was used least recently
+            self.assertEqual(cache.get_many([b'a', b'b', b'c']),
+                    {b'a': ['a'], b'c': ['c']})
+            info = cache.info()
+            self.assertEqual((info['entries'], info['hits'], info['misses']),
+                    (2, 3, 1))
+            cache.close()
+
+    def test_checkpoint_resume(self):
+        docs = ['a b c', 'a b', 'a d', 'a x'] * 3
+        expected_output = Pipeline(WhitespaceSplit(),
+                TokenFilter('frequency', threshold=4)).apply(docs)
+        fail = FailOnce(2)
+        p = Pipeline(WhitespaceSplit(), TokenFilter('frequency', threshold=4),
+                fail)
+        with tempfile.TemporaryDirectory() as tmp:
+            self.assertRaises(RuntimeError, p.apply, docs, chunk_size=3,
+                    checkpoint_dir=tmp)
+            # The first chunk of the last step was done before the failure
+            self.assertEqual(fail._seen, 3)
+            self.assertEqual(p.apply(docs, chunk_size=3, checkpoint_dir=tmp),
+                    expected_output)
+            self.assertEqual(fail._seen, 12)
+            # Done runs are read back without running any step
+            self.assertEqual(p.apply(docs, chunk_size=3, checkpoint_dir=tmp),
+                    expected_output)
+            self.assertEqual(fail._seen, 12)
+            self.assertRaises(ValueError, p.apply, docs[1:], chunk_size=3,
+                    checkpoint_dir=tmp)
+
+    def test_token_store(self):
+        docs = [['a', 'b', 'a'], [], ['caf\u00e9', 'b']]
+        p = Pipeline(WhitespaceSplit())
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'docs.tps')
+            self.assertEqual(write_store(path,
+                p.stream(' '.join(doc) for doc in docs)), 3)
+            with TokenStore(path) as store:
+                self.assertEqual(len(store), 3)
+                self.assertEqual(list(store), docs)
+                self.assertEqual(store[-1], docs[2])
+                self.assertEqual(list(store.ids(0)), [0, 1, 0])
+                self.assertEqual(store.vocabulary().strings,
+                        ['a', 'b', 'caf\u00e9'])
+                self.assertRaises(IndexError, store.ids, 3)
+
+            # Views still held keep the file mapped until they are gone
+            with TokenStore(path) as store:
+                ids = store.ids(0)
+                mm = weakref.ref(store.mm)
+            self.assertEqual(list(ids), [0, 1, 0])
+            store.close()
+            del ids
+            self.assertIsNone(mm())
+
+            # Interrupted writes can not be read
+            with self.assertRaises(RuntimeError):
+                with TokenStoreWriter(path) as writer:
+                    writer.add(['a'])
+                    raise RuntimeError
+            self.assertRaises(ValueError, TokenStore, path)
+
+    def test_corpus_split(self):
+        lines = ['doc {} {}'.format(i, 'x' * (i % 17)) for i in range(200)]
+        lines += ['', 'caf\u00e9']
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'docs.txt')
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write('\n'.join(lines) + '\n')
+            self.assertEqual(list(Corpus(path)), lines)
+            for n in (1, 2, 7, 50):
+                parts = [list(part) for part in Corpus(path).split(n)]
+                self.assertEqual(len(parts), n)
+                self.assertEqual([doc for part in parts for doc in part],
+                        lines)
+
+    def test_corpus_formats(self):
+        docs = [['a', 'b'], [], ['caf\u00e9']]
+        with tempfile.TemporaryDirectory() as tmp:
+            os.mkdir(os.path.join(tmp, 'sub'))
+            for name in ('a.jsonl.gz', 'b.txt.bz2', os.path.join('sub', 'c.txt')):
+                self.assertEqual(write_corpus(os.path.join(tmp, name), docs), 3)
+            self.assertEqual(list(Corpus(os.path.join(tmp, 'a.jsonl.gz'),
+                field='tokens')), docs)
+            self.assertEqual(list(Corpus(os.path.join(tmp, 'b.txt.bz2'))),
+                    ['a b', '', 'caf\u00e9'])
+            corpus = Corpus(tmp, field='tokens')
+            self.assertEqual(len(corpus.files()), 3)
+            self.assertEqual(len(list(corpus)), 9)
+            self.assertEqual(Corpus(tmp, pattern='.txt').files(),
+                    [os.path.join(tmp, 'sub', 'c.txt')])
+            self.assertRaises(ValueError,
+                    Corpus(os.path.join(tmp, 'b.txt.bz2')).split, 2)
+            # Pipeline output streams straight to disk
+            p = Pipeline(WhitespaceSplit())
+            out = os.path.join(tmp, 'out.jsonl')
+            write_corpus(out, p.stream(Corpus(os.path.join(tmp, 'sub'))))
+            self.assertEqual(list(Corpus(out, field='tokens')), docs)
+
+    def test_corpus_newlines(self):
+        import gzip
+        data = b'a\rb\nc\r\n'
+        with tempfile.TemporaryDirectory() as tmp:
+            with open(os.path.join(tmp, 'x.txt'), 'wb') as f:
+                f.write(data)
+            with gzip.open(os.path.join(tmp, 'x.txt.gz'), 'wb') as f:
+                f.write(data)
+            # Only '\n' ends a document, compressed or not
+            for name in ('x.txt', 'x.txt.gz'):
+                self.assertEqual(list(Corpus(os.path.join(tmp, name))),
+                        ['a\rb', 'c'])
+
+    def test_cli(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            os.makedirs(os.path.join(tmp, 'in', 'sub'))
+            write_corpus(os.path.join(tmp, 'in', 'a.jsonl'),
+                    [['a', 'b'], ['a']] * 3 + [['x']])
+            write_corpus(os.path.join(tmp, 'in', 'sub', 'b.jsonl.gz'),
+                    [['x', 'y'], ['x']])
+            config = os.path.join(tmp, 'config.json')
+            with open(config, 'w') as f:
+                json.dump({'steps': [{'type': 'TokenFilter',
+                    'name': 'frequency', 'threshold': 3}],
+                    'field': 'tokens'}, f)
+            for workers in ('1', '2'):
+                out = os.path.join(tmp, 'out' + workers)
+                stdout = io.StringIO()
+                with contextlib.redirect_stdout(stdout):
+                    cli.main([config, os.path.join(tmp, 'in'), '-o', out,
+                        '-j', workers, '--compress', 'gz'])
+                self.assertIn('2 files, 9 documents, 12 tokens',
+                        stdout.getvalue())
+                # Frequency filtering counts every file, x occurs 3 times
+                self.assertEqual(list(Corpus(os.path.join(out, 'sub',
+                    'b.jsonl.gz'), field='tokens')), [['x'], ['x']])
+                self.assertEqual(list(Corpus(os.path.join(out, 'a.jsonl.gz'),
+                    field='tokens'))[-1], ['x'])
+
+            # Outputs with the same name are refused
+            os.makedirs(os.path.join(tmp, 'x'))
+            os.makedirs(os.path.join(tmp, 'y'))
+            inputs = [os.path.join(tmp, 'x', 'day.txt'),
+                    os.path.join(tmp, 'y', 'day.txt')]
+            for path in inputs:
+                write_corpus(path, ['a b'])
+            self.assertRaises(ValueError, cli.shards, inputs, out, 'jsonl')
+            with contextlib.redirect_stderr(io.StringIO()):
+                self.assertRaises(SystemExit, cli.main, [config] + inputs +
+                    ['-o', os.path.join(tmp, 'dup')])
+            self.assertFalse(os.path.exists(os.path.join(tmp, 'dup')))
+
+    def test_cli_spool(self):
+        tokenizer = sys.modules['text_pipeline.Tokenizer']
+        with tempfile.TemporaryDirectory() as tmp:
+            os.makedirs(os.path.join(tmp, 'in'))
+            write_corpus(os.path.join(tmp, 'in', 'a.txt'), ['a b', 'a', 'x'])
+            write_corpus(os.path.join(tmp, 'in', 'b.txt.gz'), ['x y', 'a x'])
+            config = os.path.join(tmp, 'config.json')
+            with open(config, 'w') as f:
+                json.dump({'steps': [{'type': 'Tokenizer', 'name': 'regex'},
+                    {'type': 'TokenFilter', 'name': 'frequency',
+                        'threshold': 3},
+                    {'type': 'TokenFilter', 'name': 'frequency',
+                        'threshold': 2}]}, f)
+            spool_dir = os.path.join(tmp, 'spool')
+            os.mkdir(spool_dir)
+            for workers in ('1', '2'):
+                out = os.path.join(tmp, 'out' + workers)
+                with mock.patch.object(tokenizer, '_regex_pattern',
+                        wraps=tokenizer._regex_pattern) as pattern:
+                    with contextlib.redirect_stdout(io.StringIO()):
+                        cli.main([config, os.path.join(tmp, 'in'), '-o', out,
+                            '-j', workers, '--spool-dir', spool_dir])
+                if workers == '1':
+                    # The tokenizer runs once per file, not once per pass
+                    self.assertEqual(pattern.call_count, 2)
+                self.assertEqual(list(Corpus(os.path.join(out, 'a.jsonl'),
+                    field='tokens')), [['a'], ['a'], ['x']])
+                self.assertEqual(list(Corpus(os.path.join(out, 'b.jsonl'),
+                    field='tokens')), [['x'], ['a', 'x']])
+                self.assertEqual(os.listdir(spool_dir), [])
+
+    def test_apply_async(self):
+        docs = ['a b c', 'a b', 'a d'] * 5
+        p = Pipeline(WhitespaceSplit())
+        expected_output = p.apply(docs)
+
+        async def docs_async():
+            for doc in docs:
+                yield doc
+
+        async def run():
+            self.assertEqual(await p.apply_async(docs, batch_size=4),
+                    expected_output)
+            self.assertEqual([doc async for doc in p.astream(docs_async(),
+                batch_size=2, max_in_flight=1)], expected_output)
+            # Barriers see every document
+            f = Pipeline(WhitespaceSplit(),
+                    TokenFilter('frequency', threshold=6))
+            self.assertEqual(await f.apply_async(docs, batch_size=4),
+                    f.apply(docs))
+
+        asyncio.run(run())
+
+    def test_apply_async_cache(self):
+        docs = ['a b c', 'a b', 'a d'] * 5
+        expected_output = Pipeline(WhitespaceSplit()).apply(docs)
+        with tempfile.TemporaryDirectory() as tmp:
+            # The cache is opened here and used from executor threads
+            p = Pipeline(WhitespaceSplit(), cache=os.path.join(tmp, 'cache.db'))
+            self.assertEqual(asyncio.run(p.apply_async(docs, batch_size=4)),
+                    expected_output)
+            self.assertEqual(asyncio.run(p.apply_async(docs, batch_size=4)),
+                    expected_output)
+            self.assertGreater(p.cache.info()['hits'], 0)
+            p.cache.close()
+
+    def test_apply_async_processes(self):
+        docs = ['a b c', 'a b', 'a d'] * 5
+        p = Pipeline(WhitespaceSplit(), DropWords(['a']), UpperCase())
+        expected_output = p.apply(docs)
+        # Tables built up by runs are not part of what workers are sent
+        size = len(p._spec())
+        p.apply([str(i) for i in range(1000)])
+        self.assertLess(len(p._spec()), size + 8)
+        with p.executor(2) as executor:
+            self.assertEqual(asyncio.run(p.apply_async(docs, executor,
+                batch_size=4)), expected_output)
+        with concurrent.futures.ProcessPoolExecutor(2) as executor:
+            self.assertEqual(asyncio.run(p.apply_async(docs, executor,
+                batch_size=4)), expected_output)
+
+    def test_spec_without_run_state(self):
+        stemmer = Stemmer('nltk', stemmer='porter', cache_size=500,
+                cache_policy='fifo')
+        f = TokenFilter('frequency', threshold=2, incremental=True)
+        p = Pipeline(WhitespaceSplit(), stemmer, f)
+        size = len(p._spec())
+        # What an nltk run and an incremental run leave behind
+        stemmer.cache.update((str(i), str(i)) for i in range(1000))
+        f.fit([[str(i) for i in range(1000)]])
+        self.assertLess(len(p._spec()), size + 16)
+        self.assertEqual(len(stemmer.cache.items()), 500)
+        self.assertEqual(len(f.counts), 1000)
+        steps, _, _ = pkl.loads(p._spec())
+        self.assertEqual(steps[1].cache.info(), {'hits': 0, 'misses': 0,
+            'size': 0, 'maxsize': 500})
+        self.assertEqual(steps[1].cache.policy, 'fifo')
+        self.assertIsNone(steps[2].counts)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'counts.gz')
+            f.save_counts(path)
+            f = TokenFilter('frequency', threshold=2, incremental=True,
+                    counts_file=path)
+            f.fit([['a']])
+            steps, _, _ = pkl.loads(Pipeline(f)._spec())
+            # Workers start from the saved counts, not this run's
+            self.assertEqual(len(steps[0].counts), 1000)
+            self.assertNotIn('a', steps[0].counts)
+
+    def test_spec_pipelines_bounded(self):
+        specs = [Pipeline(WhitespaceSplit(), DropWords([w]))._spec()
+                for w in 'abc']
+        try:
+            for spec, expected in zip(specs, [['b'], ['a'], ['a', 'b']]):
+                self.assertEqual(_apply_spec_batch(spec, ['a b']),
+                        [expected])
+                # Only the most recent spec's pipeline is kept
+                self.assertEqual(list(_spec_pipelines), [spec])
+            # Besides the one a worker was started with
+            _spec_pipelines[None] = _spec_pipelines[specs[2]]
+            _apply_spec_batch(specs[0], ['a b'])
+            self.assertEqual(set(_spec_pipelines), {None, specs[0]})
+        finally:
+            _spec_pipelines.clear()
+
+    def test_astream_cancel(self):
+        step = SlowSplit()
+        p = Pipeline(step)
+
+        async def consume():
+            async for doc in p.astream(['a b'] * 100, batch_size=1,
+                    max_in_flight=2):
+                pass
+
+        async def run():
+            task = asyncio.ensure_future(consume())
+            await asyncio.sleep(0.05)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+            batches = step._batches
+            await asyncio.sleep(0.05)
+            # Only batches a thread had already picked up still finish
+            self.assertLessEqual(step._batches, batches + 2)
+            self.assertLess(step._batches, 100)
+
+        asyncio.run(run())
+
+    def test_benchmark(self):
+        docs = benchmark.synthetic_corpus(200, mean_length=50, seed=1)
+        self.assertEqual(docs, benchmark.synthetic_corpus(200, mean_length=50,
+            seed=1))
+        self.assertNotEqual(docs, benchmark.synthetic_corpus(200,
+            mean_length=50, seed=2))
+        mean = sum(len(doc.split()) for doc in docs) / len(docs)
+        self.assertTrue(35 < mean < 65)
+
+        results = benchmark.run(n_docs=50, cases='TokenFilter.frequency',
+                repeat=1)
+        result = results['results']['TokenFilter.frequency']
+        self.assertEqual(list(results['results']), ['TokenFilter.frequency'])
+        self.assertGreater(result['docs_per_s'], 0)
+        self.assertGreater(result['peak_memory'], 0)
+
+        slower = json.loads(json.dumps(results))
+        slower['results']['TokenFilter.frequency']['docs_per_s'] /= 2
+        self.assertEqual(benchmark.compare(results, results), [])
+        self.assertEqual([r[:2] for r in benchmark.compare(results, slower)],
+                [('TokenFilter.frequency', 'docs_per_s')])
+
+        # Every run gets a fresh pipeline, so caches start cold
+        built = []
+
+        def factory():
+            built.append(Pipeline(WhitespaceSplit()))
+            return built[-1]
+
+        with mock.patch.dict(benchmark.CASES, {'fresh': (factory, False)}):
+            benchmark.run_case('fresh', docs, repeat=2)
+        self.assertEqual(len(built), 4)
+
+    def test_hooks(self):
+        docs = ['a b c', 'a b', 'a d'] * 5
+        sink = JsonSink()
+        progress = ProgressHook()
+        p = Pipeline(WhitespaceSplit(), TokenFilter('frequency', threshold=6),
+                hooks=[sink, progress])
+        expected_output = Pipeline(WhitespaceSplit(),
+                TokenFilter('frequency', threshold=6)).apply(docs)
+
+        for run in (p.apply, lambda docs: list(p.stream(iter(docs)))):
+            self.assertEqual(run(docs), expected_output)
+            split, freq = sink.report['steps']
+            self.assertEqual((split['name'], freq['name']),
+                    ('WhitespaceSplit', 'TokenFilter.frequency'))
+            self.assertEqual((split['docs_in'], split['tokens_in'],
+                split['tokens_out']), (15, None, 35))
+            self.assertEqual((freq['docs_out'], freq['tokens_in'],
+                freq['tokens_out']), (15, 35, 25))
+            self.assertGreaterEqual(freq['wall_time'], 0)
+            self.assertEqual(sink.report['docs_out'], 15)
+        self.assertEqual(progress.progressed['TokenFilter.frequency'], 15)
+
+        self.assertEqual(p.apply(docs, n_jobs=2), expected_output)
+        self.assertEqual([step['name'] for step in sink.report['steps']],
+                ['WhitespaceSplit, TokenFilter.frequency (partial)',
+                    'TokenFilter.frequency (finish)'])
+
+        class RunCounter(Hook):
+            runs = 0
+
+            def on_run_end(self, report):
+                self.runs += 1
+
+        with tempfile.TemporaryDirectory() as tmp:
+            # Cached runs report once, with the steps of both halves
+            counter = RunCounter()
+            p = Pipeline(WhitespaceSplit(), UpperCase(), hooks=[sink, counter],
+                    cache=os.path.join(tmp, 'cache.sqlite'))
+            for run in (p.apply, lambda docs: list(p.stream(iter(docs),
+                    batch_size=4))):
+                run(['a b {}'.format(i) for i in range(15)])
+                self.assertEqual([(step['index'], step['name'], step['docs_in'])
+                    for step in sink.report['steps']],
+                    [(0, 'WhitespaceSplit', 15), (1, 'UpperCase', 15)])
+                p.cache.clear()
+            self.assertEqual(counter.runs, 2)
+
+            p = Pipeline(WhitespaceSplit(), TokenFilter('frequency',
+                threshold=6), hooks=[sink, counter],
+                cache=os.path.join(tmp, 'cache2.sqlite'))
+            self.assertEqual(p.apply(docs), expected_output)
+            self.assertEqual([(step['index'], step['name'])
+                for step in sink.report['steps']],
+                [(0, 'WhitespaceSplit'), (1, 'TokenFilter.frequency')])
+            self.assertEqual(counter.runs, 3)
+
+            # Checkpointed runs report every unit that ran
+            p = Pipeline(WhitespaceSplit(), TokenFilter('frequency',
+                threshold=6), hooks=[sink])
+            checkpoint_dir = os.path.join(tmp, 'checkpoint')
+            self.assertEqual(p.apply(docs, chunk_size=4,
+                checkpoint_dir=checkpoint_dir), expected_output)
+            split, freq = sink.report['steps']
+            self.assertEqual((split['docs_in'], split['tokens_out'],
+                freq['tokens_out']), (15, 35, 25))
+            self.assertEqual(p.apply(docs, chunk_size=4,
+                checkpoint_dir=checkpoint_dir), expected_output)
+            self.assertEqual(sink.report['steps'], [])
+        if sink.report['peak_memory_delta'] is not None:
+            self.assertGreaterEqual(sink.report['peak_memory_delta'], 0)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'pipeline.prom')
+            Pipeline(WhitespaceSplit(), hooks=[PrometheusSink(path)]).apply(docs)
+            with open(path) as f:
+                text = f.read()
+            self.assertIn('# TYPE text_pipeline_step_seconds gauge', text)
+            self.assertIn('text_pipeline_step_docs_out{index="0",'
+                    'step="WhitespaceSplit"} 15', text)
+
+    def test_regex_tokenizer(self):
+        expected_output = {
+                'stopwords_01': ['except', 'could', 'i', ':', 'what', 'will',
+                    'i', 'look', 'like-this', 'is', 'a', 'sentence'],
+                'numbers_01': ['this', 'sentence', '$', '59', 'has', 'ten',
+                    'no', '1', 'numbers'],
+                'emails_01': ['this', 'sentence', 'john', '@', 'gmail.com',
+                    'has', 'no', 'paul', '@', 'yahoo.net', 'emails'],
+                'url_01': ['this', 'sentence', 'www.enron.com', 'has',
+                    'https', ':', '//spacy.io', 'no', 'urls'],
+                'stems_01': ['running', 'do', "n't", 'does', "n't", 'crying',
+                    'going', 'gone', 'tested'],
+                'punct_01': ['this', '!', 'sentence', '(', ')', '?', 'has',
+                    '.', 'no', ',', '[', 'punctuation', ']'],
+                }
+        keys = list(expected_output)
+        p = Pipeline(Tokenizer('regex'))
+        test_output = p.apply([self.test_docs[k] for k in keys])
+        self.assertEqual(test_output, [expected_output[k] for k in keys],
+                'Regex tokenizer does not follow nltk conventions')
+        self.assertEqual(list(p.stream([self.test_docs['url_01']])),
+                [expected_output['url_01']])
+
+        docs = ['Mail John@Gmail.com, see https://spacy.io. Pay $1,000.50 '
+                'at 10:30!']
+        t = Tokenizer('regex', to_lower=False, keep_urls=True,
+                keep_emails=True, keep_nums=True)
+        self.assertEqual(t.apply(docs), [['Mail', 'John@Gmail.com', ',',
+            'see', 'https://spacy.io', '.', 'Pay', '$1,000.50', 'at',
+            '10:30', '!']])
+
+    def test_regex_matches_nltk(self):
+        # The documented agreement: identical output on every test doc
+        docs = list(self.test_docs.values())
+        self.assertEqual(Tokenizer('regex').apply(docs),
+                Tokenizer('nltk').apply(docs))
+
+    def test_normalizer(self):
+        docs = ['  Caf\u00e9 &amp; cr\u00e8me\u200b br\u00fbl\u00e9e\n\n',
+                '\ufb01ne\u00a0\u2460 \ud55c\uad6d\uc5b4',
+                'plain   ascii &lt;b&gt;']
+        n = Normalizer('unicode')
+        self.assertEqual(n.apply(docs), ['Caf\u00e9 & cr\u00e8me br\u00fbl\u00e9e',
+            'fine 1 \ud55c\uad6d\uc5b4', 'plain ascii <b>'])
+        self.assertEqual(list(n.stream(iter(docs))), n.apply(docs))
+
+        n = Normalizer('unicode', strip_accents=True)
+        self.assertEqual(n.apply(docs)[:2], ['Cafe & creme brulee',
+            'fine 1 \ud55c\uad6d\uc5b4'])
+
+        n = Normalizer('unicode', form=None, unescape_html=False,
+                remove_invisible=False, collapse_whitespace=False)
+        self.assertEqual(n.apply(docs), docs)
+
+        p = Pipeline(Normalizer('unicode', strip_accents=True),
+                Tokenizer('regex'))
+        self.assertEqual(p.apply(docs[:1]), [['cafe', '&', 'creme',
+            'brulee']])
+
+    def test_lemma_table(self):
+        table = {'running': 'run', "n't": 'not', 'went': 'go'}
+        docs = [['running', "n't", 'fast'], ['went', 'running']]
+        expected_output = [['run', 'not', 'fast'], ['go', 'run']]
+        s = Stemmer('spacy', lemma_table=table, batch_size=1)
+        self.assertTrue(s.lookup)
+        self.assertEqual(s.apply(docs), expected_output)
+        self.assertEqual(list(s.stream(iter(docs))), expected_output)
+        self.assertEqual(Pipeline(s, ids=True).apply(docs), expected_output)
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'lemmas.json')
+            s.save_lemma_table(path)
+            s = Stemmer('spacy', lemma_table=path)
+            self.assertEqual(s.apply(docs), expected_output)
+
+    def test_spacy_lemma_lookup(self):
+        docs = [d.lower().split() for d in self.test_docs.values()]
+        s = Stemmer('spacy', lookup=True, batch_size=2)
+        self.assertEqual(s.apply(docs), Stemmer('spacy').apply(docs))
+        self.assertEqual(list(s.stream(docs)), s.apply(docs))
+
+        # The lemmas looked up are bounded by cache_size
+        small = Stemmer('spacy', lookup=True, batch_size=2, cache_size=3)
+        self.assertEqual(small.apply(docs), s.apply(docs))
+        self.assertEqual(len(small._lemmas.items()), 3)
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'lemmas.json')
+            small.save_lemma_table(path)
+            with open(path) as f:
+                self.assertEqual(json.load(f), dict(small._lemmas.items()))
+
+        docs = list(self.test_docs.values())
+        p = Pipeline(Tokenizer('spacy'), Stemmer('spacy', lookup=True))
+        self.assertEqual(p.apply(docs),
+                Pipeline(Tokenizer('spacy'), Stemmer('spacy')).apply(docs))
+
+    def test_token_fusion(self):
+        docs = ['a b c d', 'b b e', 'c a f', 'g'] * 3
+        drop = DropWords(['a', 'e'])
+        steps = [WhitespaceSplit(), drop, UpperCase(), DropWords(['B']),
+                TokenFilter('frequency', threshold=4), UpperCase(),
+                DropWords(['G'])]
+        expected_output = docs
+        for step in steps:
+            expected_output = step.apply(expected_output)
+        self.assertEqual(expected_output, [['C'], [], ['C'], []] * 3)
+
+        p = Pipeline(*steps)
+        plan = p.plan()
+        self.assertEqual([stage['name'] for stage in plan], ['WhitespaceSplit',
+            'TokenStage(DropWords, UpperCase, DropWords)',
+            'TokenFilter.frequency', 'TokenStage(UpperCase, DropWords)'])
+        self.assertEqual([stage['passes'] for stage in plan], [1, 1, 2, 1])
+        # The spooled barrier unpickles every document before filtering it
+        self.assertEqual([stage['lists'] for stage in plan], [1, 1, 2, 1])
+        self.assertEqual(plan[1]['steps'], ['DropWords', 'UpperCase',
+            'DropWords'])
+        self.assertIn('7 steps in 4 stages: 5 passes, 5 lists per document '
+                '(unfused: 8 passes, 8 lists per document)', p.explain())
+
+        # A fused spacy stage builds one Doc, the kept tokens and the lemmas
+        spacy_steps = [SimpleNamespace(name='spacy', spacy_role='tokenize'),
+                SimpleNamespace(name='spacy', spacy_role='filter'),
+                SimpleNamespace(name='spacy', spacy_role='lemmatize',
+                    lookup=False)]
+        self.assertEqual(_stage_cost(SpacyStage(spacy_steps)), (1, 3))
+        self.assertEqual([_stage_cost(step) for step in spacy_steps],
+                [(1, 2), (1, 1), (1, 4)])
+
+        self.assertEqual(p.apply(docs), expected_output)
+        # Every distinct word went through the fused steps once
+        self.assertEqual(drop._seen, 7)
+        self.assertEqual(list(p.stream(iter(docs))), expected_output)
+        self.assertEqual(p.apply(docs, n_jobs=2, chunk_size=5),
+                expected_output)
+
+        p = Pipeline(*steps, ids=True)
+        self.assertEqual([stage['name'] for stage in p.plan()][2:4],
+                ['IdStage(TokenStage(DropWords, UpperCase, DropWords))',
+                    'IdStage(TokenFilter.frequency)'])
+        # Encoding and decoding are passes of their own
+        self.assertEqual([(stage['passes'], stage['lists'])
+            for stage in p.plan()],
+            [(1, 1), (1, 1), (1, 1), (2, 3), (1, 1), (1, 1)])
+        self.assertEqual(p.apply(docs), expected_output)
+
+    def test_plan_lists(self):
+        steps = [SimpleNamespace(name='spacy', spacy_role='tokenize',
+                    model='m', disable=None, barrier=False),
+                SimpleNamespace(name='spacy', spacy_role='filter', model='m',
+                    disable=None, barrier=False, _special_cases=lambda: ()),
+                TokenFilter('frequency', threshold=2, spool=False),
+                TokenFilter('frequency', threshold=2)]
+        p = Pipeline(*steps)
+        # A Doc, the kept tokens and their texts; a barrier kept in memory
+        # or spooled and unpickled again
+        self.assertEqual([(stage['passes'], stage['lists'])
+            for stage in p.plan()], [(1, 3), (2, 1), (2, 2)])
+        self.assertIn('4 steps in 3 stages: 5 passes, 6 lists per document '
+                '(unfused: 6 passes, 6 lists per document)', p.explain())
+
+        p = Pipeline(*steps, ids=True)
+        # With IDs, barriers turn their output back into arrays
+        self.assertEqual([(stage['name'], stage['lists'])
+            for stage in p.plan()][1:4], [('EncodeStage', 1),
+                ('IdStage(TokenFilter.frequency)', 2),
+                ('IdStage(TokenFilter.frequency)', 3)])
+
+    def test_count_min_sketch(self):
+        words = ['w{}'.format(i % 50) for i in range(1000)] + ['rare']
+        sketch = CountMinSketch.from_memory(2 ** 10, delta=0.01)
+        self.assertEqual(sketch.depth, 5)
+        sketch.update(words)
+        self.assertEqual(sketch.total, len(words))
+        for w in set(words):
+            # Never underestimates, overestimates within the bound
+            self.assertGreaterEqual(sketch[w], words.count(w))
+            self.assertLessEqual(sketch[w], words.count(w) + sketch.error_bound())
+        # Merging shards gives the same counts as counting everything
+        left = CountMinSketch(sketch.width, sketch.depth)
+        right = CountMinSketch(sketch.width, sketch.depth)
+        left.update(words[:300])
+        right.update(words[300:])
+        left.update(pkl.loads(pkl.dumps(right)))
+        self.assertEqual(left.table, sketch.table)
+        counted = CountMinSketch(sketch.width, sketch.depth)
+        counted.update(Counter(words))
+        self.assertEqual((counted.table, counted.total),
+                (sketch.table, sketch.total))
+        self.assertRaises(ValueError, left.update, CountMinSketch(3, 2))
+
+    def test_stream_matches_apply(self):
+        warnings.simplefilter('ignore')
+        docs = [
+                self.test_docs['stopwords_01'],
+                self.test_docs['numbers_01'],
+                self.test_docs['stems_01'],
+                ]
+        t = Tokenizer('spacy')
+        f = TokenFilter('spacy', remove_stops=True)
+        s = Stemmer('nltk', stemmer='porter')
+        p = Pipeline(t, f, s)
+        self.assertEqual(list(p.stream(iter(docs))), p.apply(docs))
+
+    def test_spacy_fusion_models(self):
+        # Steps fused into one stage would all use the first one's model
+        t = Tokenizer('spacy')
+        f = TokenFilter('spacy', disable=['parser'])
+        s = Stemmer('spacy', model='no_such_model')
+        p = Pipeline(t, f, s)
+        self.assertFalse(any(isinstance(stage, SpacyStage)
+            for stage in p.stages))
+        # Token level fusion keeps every step on its own model
+        self.assertEqual(p.stages[1].steps, [f, s])
+        p = Pipeline(t, TokenFilter('spacy'), s)
+        self.assertIsInstance(p.stages[0], SpacyStage)
+        self.assertEqual(p.stages[1:], [s])
+
+    def test_spacy_special_cases(self):
+        from spacy.symbols import ORTH
+
+        params = {'remove_stops': False, 'add_special_case':
+                [('gimme', [{ORTH: 'gim'}, {ORTH: 'me'}])]}
+        p = Pipeline(Tokenizer('spacy'), TokenFilter('spacy', **params))
+        self.assertEqual(p.apply(['gimme that']), [['gim', 'me', 'that']])
+        # The shared model's tokenizer is left alone
+        self.assertEqual(Pipeline(Tokenizer('spacy')).apply(['gimme that']),
+                [['gimme', 'that']])
+        self.assertNotEqual(fingerprint([TokenFilter('spacy', **params)]),
+                fingerprint([TokenFilter('spacy', remove_stops=False)]))
+        # Unfused, the Tokenizer still tokenizes with the special cases
+        unfused = Pipeline(Tokenizer('spacy'), TokenFilter('spacy',
+            disable=['ner'], **params))
+        self.assertEqual(unfused.apply(['gimme that']), p.apply(['gimme that']))
+        self.assertIs(ModelRegistry.tokenizer('en_core_web_sm', None,
+            params['add_special_case']), ModelRegistry.tokenizer(
+                'en_core_web_sm', None, params['add_special_case']))
+
+    def test_special_case_stages(self):
+        params = {'add_special_case': [('gimme', [{'ORTH': 'gim'},
+            {'ORTH': 'me'}])]}
+        cases = params['add_special_case']
+        p = Pipeline(Tokenizer('spacy'), TokenFilter('spacy', **params))
+        self.assertEqual(p.stages[0].special_cases, cases)
+        # A different model can not be fused, the cases still go to the
+        # Tokenizer
+        p = Pipeline(Tokenizer('spacy'), TokenFilter('spacy', disable=['ner'],
+            **params), TokenFilter('spacy', disable=['ner']))
+        self.assertEqual([stage['name'] for stage in p.plan()],
+                ['SpacyStage(Tokenizer.spacy)',
+                    'SpacyStage(TokenFilter.spacy, TokenFilter.spacy)'])
+        self.assertEqual(p.stages[0].special_cases, cases)
+        self.assertRaises(ValueError, Pipeline, WhitespaceSplit(),
+                TokenFilter('spacy', **params))
+
+    def test_spacy_fusion_missing_model(self):
+        p = Pipeline(Tokenizer('spacy'), Stemmer('spacy', model='no_such_model'))
+        self.assertRaises(OSError, p.apply, ['Running tests'])
+
+    def test_spacy_fused(self):
+        warnings.simplefilter('ignore')
+        docs = [
+                self.test_docs['stopwords_01'],
+                self.test_docs['numbers_01'],
+                self.test_docs['stems_01'],
+                ]
+        t = Tokenizer('spacy')
+        f = TokenFilter('spacy', remove_stops=True, remove_nums=True)
+        s = Stemmer('spacy')
+        p = Pipeline(t, f, s)
+        self.assertEqual(len(p.stages), 1)
+        self.assertIsInstance(p.stages[0], SpacyStage)
+        expected_output = s.apply(f.apply(t.apply(docs)))
+        self.assertEqual(p.apply(docs), expected_output)
+        self.assertEqual(list(p.stream(iter(docs))), expected_output)
+
+
+
+class TestImport(unittest.TestCase):
+
+    def test_import_is_light(self):
+        # Fresh interpreter so that nothing is cached from other tests
+        code = (
+                'import sys, time, json\n'
+                't = time.perf_counter()\n'
+                'import text_pipeline\n'
+                't = time.perf_counter() - t\n'
+                'heavy = ["spacy", "en_core_web_sm", "nltk", "tqdm"]\n'
+                'print(json.dumps({"time": t, '
+                '"loaded": [m for m in heavy if m in sys.modules]}))\n'
+                )
+        out = subprocess.check_output([sys.executable, '-c', code],
+                cwd=os.path.dirname(ROOT_PATH))
+        result = json.loads(out.decode())
+        self.assertEqual(result['loaded'], [],
+                'Backends imported by import text_pipeline')
+        self.assertLess(result['time'], IMPORT_TIME_BUDGET,
+                'import text_pipeline took {:.3f}s'.format(result['time']))
 
 
 if __name__=="__main__":
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Durable per-chunk checkpoints that let an interrupted Pipeline run resume.
+
+@author: John Sigmon
+"""
+
+import os
+import json
+import hashlib
+import logging.config
+import pickle as pkl
+
+logger = logging.getLogger(__name__)
+
+class Checkpoint():
+    '''
+    A directory of pipeline output. A run is a sequence of units, each a
+    run of per-document stages or a single barrier step, and every unit
+    writes its output as numbered chunk files. A file only appears once it
+    is completely written and synced, and a unit is marked done once all
+    of its chunks are, so after a crash every file present can be trusted.
+    Once a unit is done the previous unit's chunks are deleted, so at most
+    two copies of the corpus are on disk.
+    '''
+
+    MANIFEST = 'manifest.json'
+
+    def __init__(self, path):
+        '''
+        :param path {str} checkpoint directory, created if it does not exist
+
+        '''
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def __repr__(self):
+        return '<Checkpoint {}>'.format(self.path)
+
+    def start(self, fingerprint, docs, chunk_size):
+        '''
+        Begin a run, or resume the run that was checkpointed here.
+
+        :param fingerprint {str} pipeline fingerprint
+
+        :param docs {list} input documents
+
+        :param chunk_size {int} documents per chunk
+
+        :raises ValueError if the directory holds a different run
+
+        '''
+        h = hashlib.blake2b(digest_size=20)
+        for doc in docs:
+            data = doc if isinstance(doc, str) else json.dumps(doc)
+            h.update(data.encode('utf-8'))
+            h.update(b'\0')
+        manifest = {'fingerprint': fingerprint, 'input': h.hexdigest(),
+                'docs': len(docs), 'chunk_size': chunk_size}
+
+        path = os.path.join(self.path, self.MANIFEST)
+        if os.path.exists(path):
+            with open(path) as f:
+                if json.load(f) != manifest:
+                    raise ValueError("{} holds the checkpoint of a different "
+                            "run".format(self.path))
+            logger.info("Resuming from %s", self.path)
+        else:
+            self._write(path, json.dumps(manifest).encode('utf-8'))
+
+    def done(self, unit):
+        '''
+        :returns {bool} True if every chunk of the unit was written
+        '''
+        return os.path.exists(self._done_path(unit))
+
+    def has_chunk(self, unit, j):
+        return os.path.exists(self._chunk_path(unit, j))
+
+    def write_chunk(self, unit, j, docs):
+        self._write(self._chunk_path(unit, j),
+                pkl.dumps(docs, pkl.HIGHEST_PROTOCOL))
+
+    def read_chunk(self, unit, j):
+        with open(self._chunk_path(unit, j), 'rb') as f:
+            return pkl.load(f)
+
+    def chunks(self, unit):
+        '''
+        :returns {int} number of chunks of a unit that is done
+        '''
+        with open(self._done_path(unit)) as f:
+            return json.load(f)['chunks']
+
+    def read(self, unit):
+        '''
+        :returns {list} whole output of a unit that is done
+        '''
+        return [doc for j in range(self.chunks(unit))
+                for doc in self.read_chunk(unit, j)]
+
+    def finish(self, unit, n_chunks):
+        '''
+        Mark a unit done and delete the output of the unit before it.
+        '''
+        self._write(self._done_path(unit),
+                json.dumps({'chunks': n_chunks}).encode('utf-8'))
+        if unit > 0:
+            for j in range(self.chunks(unit - 1)):
+                try:
+                    os.remove(self._chunk_path(unit - 1, j))
+                except FileNotFoundError:
+                    pass
+
+    def _chunk_path(self, unit, j):
+        return os.path.join(self.path, 'unit_{}_chunk_{}.pkl'.format(unit, j))
+
+    def _done_path(self, unit):
+        return os.path.join(self.path, 'unit_{}.done'.format(unit))
+
+    @staticmethod
+    def _write(path, data):
+        # Write then rename, so a crash never leaves a partial file
+        tmp = path + '.tmp'
+        with open(tmp, 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
@@ -0,0 +1,221 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Streaming readers and writers for corpora on disk.
+
+@author: John Sigmon
+"""
+
+import os
+import bz2
+import gzip
+import json
+import logging.config
+
+logger = logging.getLogger(__name__)
+
+# Compressed variants are recognized by a further extension
+COMPRESSION = {'.gz': gzip.open, '.bz2': bz2.open}
+JSONL_EXTENSIONS = ('.jsonl', '.json', '.ndjson')
+
+class Corpus():
+    '''
+    Iterable of the documents of a file or a directory of files, read one
+    line at a time. Plain text files hold one document per line; JSONL
+    files one JSON object per line, with the document in field. gzip and
+    bz2 files are decompressed on the fly. The corpus can be iterated over
+    any number of times, and is cheap to pickle, so it can be handed to
+    worker processes.
+    '''
+
+    field = 'text'              # JSONL field holding the document
+    format = None               # 'text' or 'jsonl', None to go by extension
+    start = 0                   # First byte of the file to read
+    end = None                  # Byte to stop at, None for end of file
+    buffer_size = 2 ** 20       # Read buffer in bytes
+    pattern = None              # Only read files of a directory ending so
+
+    def __init__(self, path, **params):
+        '''
+        :param path {str} file or directory. Directories are read file by
+            file, in name order, including subdirectories.
+
+        :param *params supported keywords are above as attributes
+
+        '''
+        self.path = path
+        for key in params:
+            setattr(self, key, params[key])
+
+    def __repr__(self):
+        if self.start or self.end is not None:
+            return '<Corpus {} [{}:{}]>'.format(self.path, self.start, self.end)
+        return '<Corpus {}>'.format(self.path)
+
+    def __iter__(self):
+        if os.path.isdir(self.path):
+            for path in self.files():
+                yield from Corpus(path, field=self.field, format=self.format,
+                        buffer_size=self.buffer_size)
+            return
+
+        if _format(self.path, self.format) == 'jsonl':
+            field = self.field
+            for line in self._lines():
+                if line.strip():
+                    yield json.loads(line)[field]
+        else:
+            for line in self._lines():
+                yield line.rstrip('\r\n')
+
+    def files(self):
+        '''
+        :returns {list[str]} files of the directory, in the order read
+        '''
+        paths = []
+        for root, dirs, files in os.walk(self.path):
+            dirs.sort()
+            for name in sorted(files):
+                if self.pattern is None or name.endswith(self.pattern):
+                    paths.append(os.path.join(root, name))
+        return paths
+
+    def split(self, n):
+        '''
+        Divide an uncompressed file into n byte ranges of about the same
+        size, for example one per worker. Every line belongs to exactly
+        one range: the one in which it starts.
+
+        :param n {int} number of ranges
+
+        :returns {list[Corpus]} one corpus per range
+
+        '''
+        if os.path.isdir(self.path) or _compression(self.path) is not None:
+            raise ValueError("Only uncompressed files can be split, "
+                    "not {}".format(self.path))
+        size = os.path.getsize(self.path)
+        bounds = [size * i // n for i in range(n + 1)]
+        return [Corpus(self.path, field=self.field, format=self.format,
+                    buffer_size=self.buffer_size, start=start, end=end)
+                for start, end in zip(bounds, bounds[1:])]
+
+    def _lines(self):
+        '''
+        Decoded lines of the file that start within [start, end).
+        '''
+        opener = _compression(self.path)
+        if opener is not None:
+            if self.start or self.end is not None:
+                raise ValueError("Compressed files can not be read by byte "
+                        "range")
+            with opener(self.path, 'rt', encoding='utf-8', newline='\n') as f:
+                yield from f
+            return
+
+        with open(self.path, 'rb', buffering=self.buffer_size) as f:
+            if self.start > 0:
+                # The line running into start belongs to the range before
+                f.seek(self.start - 1)
+                f.readline()
+            end = self.end
+            if end is None:
+                for line in f:
+                    yield line.decode('utf-8')
+                return
+            readline = f.readline
+            while f.tell() < end:
+                line = readline()
+                if not line:
+                    break
+                yield line.decode('utf-8')
+
+
+class CorpusWriter():
+    '''
+    Writes processed documents, one per line, compressed if the path ends
+    in .gz or .bz2. Plain text files get the tokens of a document joined
+    by spaces; JSONL files an object with the tokens as a list in field.
+    '''
+
+    field = 'tokens'            # JSONL field for the tokens
+    format = None               # 'text' or 'jsonl', None to go by extension
+    buffer_size = 2 ** 20       # Write buffer in bytes
+
+    def __init__(self, path, **params):
+        '''
+        :param path {str} file to write
+
+        :param *params supported keywords are above as attributes
+
+        '''
+        self.path = path
+        for key in params:
+            setattr(self, key, params[key])
+        self.jsonl = _format(path, self.format) == 'jsonl'
+        self.count = 0
+        opener = _compression(path)
+        if opener is not None:
+            self.f = opener(path, 'wt', encoding='utf-8')
+        else:
+            self.f = open(path, 'w', encoding='utf-8',
+                    buffering=self.buffer_size)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def add(self, doc):
+        '''
+        :param doc {list[str]} tokens
+
+        '''
+        if self.jsonl:
+            self.f.write(json.dumps({self.field: list(doc)},
+                ensure_ascii=False))
+        else:
+            self.f.write(' '.join(doc))
+        self.f.write('\n')
+        self.count += 1
+
+    def extend(self, docs):
+        for doc in docs:
+            self.add(doc)
+
+    def close(self):
+        self.f.close()
+
+
+def write_corpus(path, docs, **params):
+    '''
+    Write documents with a CorpusWriter.
+
+    :param path {str} file to write
+
+    :param docs {iterable[list[str]]} documents, e.g. Pipeline.stream output
+
+    :param *params CorpusWriter params
+
+    :returns {int} number of documents written
+
+    '''
+    with CorpusWriter(path, **params) as writer:
+        writer.extend(docs)
+        return writer.count
+
+
+def _compression(path):
+    return COMPRESSION.get(os.path.splitext(path)[1])
+
+
+def _format(path, format=None):
+    if format is not None:
+        if format not in ('text', 'jsonl'):
+            raise ValueError("Unknown corpus format {}".format(format))
+        return format
+    root, ext = os.path.splitext(path)
+    if ext in COMPRESSION:
+        ext = os.path.splitext(root)[1]
+    return 'jsonl' if ext in JSONL_EXTENSIONS else 'text'
@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Fixed size approximate token counter for frequency filtering.
+
+@author: John Sigmon
+"""
+
+import sys
+import math
+import hashlib
+import logging.config
+from array import array
+
+logger = logging.getLogger(__name__)
+
+class CountMinSketch():
+    '''
+    Count-min sketch: depth rows of width counters. A token is counted in
+    one counter of every row, picked by hashing it, and its estimated count
+    is the smallest of those counters. Memory is fixed however many distinct
+    tokens there are.
+
+    Estimates are never below the true count. With N the total number of
+    tokens counted, epsilon = e / width and delta = exp(-depth), an estimate
+    exceeds the true count by more than epsilon * N with probability at most
+    delta.
+
+    Hashes are stable across processes, so sketches with the same width and
+    depth can be merged with update, e.g. after counting shards in parallel.
+    '''
+
+    # Bytes per counter
+    ITEMSIZE = array('Q').itemsize
+
+    def __init__(self, width, depth):
+        '''
+        :param width {int} counters per row
+
+        :param depth {int} number of rows
+
+        '''
+        self.width = int(width)
+        self.depth = int(depth)
+        self.total = 0
+        self.table = array('Q', bytes(self.width * self.depth * self.ITEMSIZE))
+
+    @classmethod
+    def from_memory(cls, memory, delta=0.01):
+        '''
+        Make the widest sketch that fits in a memory budget.
+
+        :param memory {int} bytes to spend on counters
+
+        :param delta {float} probability that an estimate is off by more
+            than the error bound, sets the depth
+
+        '''
+        depth = max(1, int(math.ceil(math.log(1.0 / delta))))
+        width = max(1, int(memory) // (depth * cls.ITEMSIZE))
+        return cls(width, depth)
+
+    @classmethod
+    def from_error(cls, epsilon, delta=0.01):
+        '''
+        Make the smallest sketch with the requested error bound.
+
+        :param epsilon {float} error bound as a fraction of the total count
+
+        :param delta {float} probability that an estimate is off by more
+            than epsilon times the total count
+
+        '''
+        width = int(math.ceil(math.e / epsilon))
+        depth = max(1, int(math.ceil(math.log(1.0 / delta))))
+        return cls(width, depth)
+
+    @property
+    def epsilon(self):
+        return math.e / self.width
+
+    @property
+    def delta(self):
+        return math.exp(-self.depth)
+
+    def error_bound(self):
+        '''
+        :returns {float} with probability 1 - delta no estimate exceeds the
+            true count by more than this
+
+        '''
+        return self.epsilon * self.total
+
+    def _indices(self, w):
+        '''
+        Position of w's counter in every row, using two halves of one
+        stable hash (Kirsch-Mitzenmacher double hashing).
+        '''
+        data = w.encode('utf-8') if isinstance(w, str) else repr(w).encode('utf-8')
+        h = int.from_bytes(hashlib.blake2b(data, digest_size=16).digest(), 'little')
+        h1 = h & 0xFFFFFFFFFFFFFFFF
+        h2 = (h >> 64) | 1
+        width = self.width
+        return [row * width + (h1 + row * h2) % width for row in range(self.depth)]
+
+    def add(self, w, n=1):
+        table = self.table
+        for i in self._indices(w):
+            table[i] += n
+        self.total += n
+
+    def update(self, other):
+        '''
+        Count every token of an iterable, add the counts of a mapping such
+        as a Counter, or add the counts of another sketch of the same size.
+
+        :param other {iterable} or {dict} or {CountMinSketch}
+
+        '''
+        if isinstance(other, CountMinSketch):
+            if (other.width, other.depth) != (self.width, self.depth):
+                raise ValueError("Cannot merge sketches of different sizes")
+            if other.total:
+                self.table = _add_tables(self.table, other.table)
+                self.total += other.total
+            return
+        if hasattr(other, 'items'):
+            for w, n in other.items():
+                self.add(w, n)
+            return
+        for w in other:
+            self.add(w)
+
+    def __getitem__(self, w):
+        table = self.table
+        return min(table[i] for i in self._indices(w))
+
+    def __getstate__(self):
+        # Counters pickle as raw bytes
+        return {'width': self.width, 'depth': self.depth,
+                'total': self.total, 'table': self.table.tobytes()}
+
+    def __setstate__(self, state):
+        self.width = state['width']
+        self.depth = state['depth']
+        self.total = state['total']
+        self.table = array('Q')
+        self.table.frombytes(state['table'])
+
+
+def _add_tables(a, b):
+    '''
+    Add two tables of counters, element by element, as two big integers.
+    No counter reaches 2 ** 64, so no carry crosses from one counter into
+    the next. This is about ten times faster than adding them one by one.
+
+    :returns {array} the sums
+    '''
+    order = sys.byteorder
+    size = len(a) * a.itemsize
+    total = int.from_bytes(a.tobytes(), order) + int.from_bytes(b.tobytes(),
+            order)
+    table = array(a.typecode)
+    table.frombytes(total.to_bytes(size, order))
+    return table
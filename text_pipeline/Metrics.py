@@ -0,0 +1,360 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Hooks that receive per-step measurements of Pipeline runs, and sinks that
+report them.
+
+@author: John Sigmon
+"""
+
+import os
+import sys
+import json
+import time
+import logging.config
+
+logger = logging.getLogger(__name__)
+
+class Hook():
+    '''
+    Base class of Pipeline hooks. Pipeline calls these methods around a
+    run; subclasses override the ones they need.
+
+    Step reports are dicts with the step's index and name, wall_time and
+    cpu_time (seconds of CPU used by this process) while the step ran,
+    docs_in, docs_out, tokens_in and tokens_out (None for raw text),
+    tokens_per_s (tokens in, or out for a Tokenizer, per second of wall
+    time) and peak_memory_delta (bytes by which the step raised this
+    process's peak resident set size, None where the platform does not
+    report it). The run report has the same totals and a list of the step
+    reports under steps.
+    '''
+
+    # Set to get on_progress calls, which cost a little per document
+    progress = False
+
+    def on_run_start(self, pipeline, n_docs):
+        pass
+
+    def on_step_start(self, index, name, n_docs):
+        pass
+
+    def on_progress(self, index, name, n):
+        '''
+        n more documents went through the step.
+        '''
+        pass
+
+    def on_step_end(self, report):
+        pass
+
+    def on_run_end(self, report):
+        pass
+
+
+class LogSink(Hook):
+    '''
+    Logs every step report and the run report as one JSON line.
+    '''
+
+    def __init__(self, log=None, level=logging.INFO):
+        '''
+        :param log {logging.Logger} where to log, default this module's
+
+        :param level {int} logging level
+
+        '''
+        self.log = log or logger
+        self.level = level
+
+    def on_step_end(self, report):
+        self.log.log(self.level, "step %s", json.dumps(report))
+
+    def on_run_end(self, report):
+        report = {k: v for k, v in report.items() if k != 'steps'}
+        self.log.log(self.level, "run %s", json.dumps(report))
+
+
+class JsonSink(Hook):
+    '''
+    Keeps the report of the last run, and writes it to a JSON file if
+    given a path.
+    '''
+
+    def __init__(self, path=None):
+        self.path = path
+        self.report = None
+
+    def on_run_end(self, report):
+        self.report = report
+        if self.path is not None:
+            _replace(self.path, json.dumps(report, indent=2))
+
+
+class PrometheusSink(Hook):
+    '''
+    Writes the last run's step reports in the Prometheus text format, for
+    the node exporter's textfile collector, as gauges labeled by step.
+    '''
+
+    METRICS = [
+            ('wall_time', 'seconds', "Wall time of the step"),
+            ('cpu_time', 'cpu_seconds', "CPU time of the step"),
+            ('docs_in', 'docs_in', "Documents into the step"),
+            ('docs_out', 'docs_out', "Documents out of the step"),
+            ('tokens_in', 'tokens_in', "Tokens into the step"),
+            ('tokens_out', 'tokens_out', "Tokens out of the step"),
+            ('tokens_per_s', 'tokens_per_second', "Step throughput"),
+            ('peak_memory_delta', 'peak_memory_delta_bytes',
+                "Growth of the peak resident set size during the step"),
+            ]
+
+    def __init__(self, path, prefix='text_pipeline_step'):
+        '''
+        :param path {str} file to write, e.g. ending in .prom in the
+            collector's directory
+
+        :param prefix {str} metric name prefix
+
+        '''
+        self.path = path
+        self.prefix = prefix
+
+    def on_run_end(self, report):
+        lines = []
+        for key, name, help_text in self.METRICS:
+            metric = '{}_{}'.format(self.prefix, name)
+            lines.append('# HELP {} {}'.format(metric, help_text))
+            lines.append('# TYPE {} gauge'.format(metric))
+            for step in report['steps']:
+                if step.get(key) is None:
+                    continue
+                lines.append('{}{{index="{}",step="{}"}} {}'.format(metric,
+                    step['index'], _escape(step['name']), step[key]))
+        _replace(self.path, '\n'.join(lines) + '\n')
+
+
+class TqdmSink(Hook):
+    '''
+    A tqdm progress bar per step. Needs tqdm to be installed.
+    '''
+
+    progress = True
+
+    def __init__(self, **params):
+        '''
+        :param *params passed on to tqdm, e.g. file or mininterval
+        '''
+        from tqdm import tqdm
+
+        self.tqdm = tqdm
+        self.params = params
+        # When streaming, every step is in progress at once
+        self.bars = {}
+
+    def on_step_start(self, index, name, n_docs):
+        self.bars[index] = self.tqdm(total=n_docs, desc=name,
+                position=index, **self.params)
+
+    def on_progress(self, index, name, n):
+        self.bars[index].update(n)
+
+    def on_step_end(self, report):
+        bar = self.bars.pop(report['index'])
+        # Steps that can not report progress finish in one go
+        bar.update(max(0, report['docs_in'] - bar.n))
+        bar.close()
+
+
+class StreamMeter():
+    '''
+    Measures one stage of a streamed pipeline. Stages of a stream run
+    interleaved, each pulling documents from the one before, so the time
+    spent waiting on the upstream stage is subtracted from the stage's own.
+    '''
+
+    def __init__(self, index, name, hooks):
+        self.index = index
+        self.name = name
+        self.hooks = hooks
+        self.progress = [hook for hook in hooks if hook.progress]
+        self.wall_time = 0.0
+        self.cpu_time = 0.0
+        self.docs_in = 0
+        self.docs_out = 0
+        self.tokens_in = 0
+        self.tokens_out = 0
+        self.peak_memory_delta = 0
+        self.report = None
+        self._upstream_wall = 0.0
+        self._upstream_cpu = 0.0
+        self._upstream_peak = 0
+
+    def input(self, docs):
+        '''
+        Wrap the stage's input.
+        '''
+        it = iter(docs)
+        while True:
+            wall, cpu = time.perf_counter(), time.process_time()
+            peak = peak_memory()
+            try:
+                doc = next(it)
+            except StopIteration:
+                return
+            finally:
+                self._upstream_wall += time.perf_counter() - wall
+                self._upstream_cpu += time.process_time() - cpu
+                self._upstream_peak += _delta(peak)
+            self.docs_in += 1
+            if isinstance(doc, str):
+                self.tokens_in = None
+            elif self.tokens_in is not None:
+                self.tokens_in += len(doc)
+            for hook in self.progress:
+                hook.on_progress(self.index, self.name, 1)
+            yield doc
+
+    def output(self, docs):
+        '''
+        Wrap the stage's output, and report when it is exhausted.
+        '''
+        for hook in self.hooks:
+            hook.on_step_start(self.index, self.name, None)
+        it = iter(docs)
+        while True:
+            wall, cpu = time.perf_counter(), time.process_time()
+            peak = peak_memory()
+            upstream_wall, upstream_cpu = self._upstream_wall, self._upstream_cpu
+            upstream_peak = self._upstream_peak
+            try:
+                doc = next(it)
+            except StopIteration:
+                break
+            finally:
+                self.wall_time += time.perf_counter() - wall - (
+                        self._upstream_wall - upstream_wall)
+                self.cpu_time += time.process_time() - cpu - (
+                        self._upstream_cpu - upstream_cpu)
+                self.peak_memory_delta += _delta(peak) - (
+                        self._upstream_peak - upstream_peak)
+            self.docs_out += 1
+            if isinstance(doc, str):
+                self.tokens_out = None
+            elif self.tokens_out is not None:
+                self.tokens_out += len(doc)
+            yield doc
+
+        self.report = step_report(self.index, self.name, self.wall_time,
+                self.cpu_time, self.docs_in, self.docs_out, self.tokens_in,
+                self.tokens_out, self.peak_memory_delta
+                if peak_memory() is not None else None)
+        for hook in self.hooks:
+            hook.on_step_end(self.report)
+
+
+def step_report(index, name, wall_time, cpu_time, docs_in, docs_out,
+        tokens_in, tokens_out, peak_memory_delta=None):
+    '''
+    :param peak_memory_delta {int} see Hook, e.g. from memory_delta
+
+    :returns {dict} report of one step, see Hook
+    '''
+    tokens = tokens_in if tokens_in is not None else tokens_out
+    return {
+            'index': index,
+            'name': name,
+            'wall_time': wall_time,
+            'cpu_time': cpu_time,
+            'docs_in': docs_in,
+            'docs_out': docs_out,
+            'tokens_in': tokens_in,
+            'tokens_out': tokens_out,
+            'tokens_per_s': tokens / wall_time
+                if tokens is not None and wall_time > 0 else None,
+            'peak_memory_delta': peak_memory_delta,
+            }
+
+
+def run_report(steps, wall_time, cpu_time, peak_memory_delta=None):
+    '''
+    :param steps {list[dict]} step reports, in pipeline order
+
+    :returns {dict} report of the run, see Hook
+    '''
+    report = step_report(None, 'Pipeline', wall_time, cpu_time,
+            steps[0]['docs_in'] if steps else 0,
+            steps[-1]['docs_out'] if steps else 0,
+            steps[0]['tokens_in'] if steps else None,
+            steps[-1]['tokens_out'] if steps else None, peak_memory_delta)
+    del report['index']
+    report['steps'] = steps
+    return report
+
+
+def merge_reports(a, b):
+    '''
+    :returns {dict} report of a step that ran twice, e.g. once per batch,
+        as a and b
+    '''
+    def add(key):
+        if a[key] is None or b[key] is None:
+            return None
+        return a[key] + b[key]
+
+    return step_report(a['index'], a['name'], add('wall_time'),
+            add('cpu_time'), add('docs_in'), add('docs_out'),
+            add('tokens_in'), add('tokens_out'), add('peak_memory_delta'))
+
+
+def peak_memory():
+    '''
+    :returns {int} peak resident set size of this process in bytes, or
+        None if the platform does not report it
+    '''
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def memory_delta(before):
+    '''
+    :param before {int} peak_memory() when the step started
+
+    :returns {int} bytes the peak resident set size grew by since, or None
+        if the platform does not report it
+    '''
+    return None if before is None else peak_memory() - before
+
+
+def _delta(before):
+    return memory_delta(before) or 0
+
+
+def count_tokens(docs):
+    '''
+    :returns {int} total tokens of tokenized documents, or None for raw
+        text
+    '''
+    total = 0
+    for doc in docs:
+        if isinstance(doc, str):
+            return None
+        total += len(doc)
+    return total
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"')
+
+
+def _replace(path, text):
+    # Readers never see a half written file
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        f.write(text)
+    os.replace(tmp, path)
@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Process-wide registry of loaded spacy models, shared by every pipeline step.
+
+@author: John Sigmon
+"""
+
+import os
+import sys
+import copy
+import time
+import logging.config
+import threading
+
+logger = logging.getLogger(__name__)
+
+class ModelRegistry():
+    '''
+    Loads each spacy model once, on first use, and hands the same object
+    to every step that asks for it. Models are keyed by name and by the
+    pipeline components that were disabled when loading.
+    '''
+
+    _models = {}
+    _stats = {}
+    _tokenizers = {}
+    _lock = threading.Lock()
+
+    @classmethod
+    def load(cls, name='en_core_web_sm', disable=None):
+        '''
+        Get a spacy model, loading it if this process has not yet done so.
+
+        :param name {str} model package name, e.g. en_core_web_sm or
+            en_core_web_md
+
+        :param disable {list[str]} spacy pipeline components not to load,
+            e.g. ['parser', 'ner']
+
+        :returns {spacy.language.Language} the shared model
+
+        '''
+        key = cls._key(name, disable)
+        nlp = cls._models.get(key)
+        if nlp is not None:
+            return nlp
+
+        with cls._lock:
+            # Another thread may have loaded it while we waited
+            if key in cls._models:
+                return cls._models[key]
+
+            import spacy
+
+            rss = _rss()
+            start = time.time()
+            nlp = spacy.load(name, disable=list(key[1]))
+            load_time = time.time() - start
+            memory = _rss() - rss
+
+            cls._models[key] = nlp
+            cls._stats[key] = {
+                    'name': name,
+                    'disable': list(key[1]),
+                    'version': nlp.meta.get('version'),
+                    'load_time': load_time,
+                    'memory': memory,
+                    }
+            logger.info("Loaded %s in %.2fs, ~%.1f MB", name, load_time,
+                    memory / 2 ** 20)
+        return nlp
+
+    @classmethod
+    def tokenizer(cls, name='en_core_web_sm', disable=None, special_cases=()):
+        '''
+        Get a tokenizer of a model with special cases added. It is a copy
+        of the model's tokenizer sharing its vocab, so the shared model
+        never sees the special cases, and it is built once per model,
+        disabled components and special cases.
+
+        :param special_cases {list[tuple(str, list[dict])]} (pattern,
+            replacement) pairs, see spacy's Tokenizer.add_special_case
+
+        :returns {spacy.tokenizer.Tokenizer} the model's own tokenizer if
+            there are no special cases
+
+        '''
+        nlp = cls.load(name, disable)
+        if not special_cases:
+            return nlp.tokenizer
+        key = (cls._key(name, disable), repr(list(special_cases)))
+        tokenizer = cls._tokenizers.get(key)
+        if tokenizer is not None:
+            return tokenizer
+
+        with cls._lock:
+            if key in cls._tokenizers:
+                return cls._tokenizers[key]
+            # Tokenizers copy by rebuilding from their rules, so the copy
+            # gets its own special cases
+            tokenizer = copy.copy(nlp.tokenizer)
+            for pattern, replace in special_cases:
+                tokenizer.add_special_case(pattern, replace)
+            cls._tokenizers[key] = tokenizer
+        return tokenizer
+
+    @classmethod
+    def is_loaded(cls, name='en_core_web_sm', disable=None):
+        '''
+        :returns {bool} True if the model is already loaded in this process
+
+        '''
+        return cls._key(name, disable) in cls._models
+
+    @classmethod
+    def stats(cls):
+        '''
+        Report on every model loaded in this process.
+
+        :returns {list[dict]} one entry per model with its name, disabled
+            components, version, load_time (seconds) and memory (approximate
+            growth of the resident set in bytes while loading)
+
+        '''
+        return [dict(s) for s in cls._stats.values()]
+
+    @classmethod
+    def clear(cls):
+        '''
+        Forget every loaded model so that it can be garbage collected.
+        '''
+        with cls._lock:
+            cls._models.clear()
+            cls._stats.clear()
+            cls._tokenizers.clear()
+
+    @staticmethod
+    def _key(name, disable):
+        return (name, tuple(sorted(disable or ())))
+
+
+def _rss():
+    '''
+    Resident set size of this process in bytes, or the peak resident set
+    size where the current one is not available.
+    '''
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # Linux reports kilobytes, macOS bytes
+        return peak if sys.platform == 'darwin' else peak * 1024
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Normalization of raw text before tokenization.
+
+@author: John Sigmon
+"""
+
+import html
+import unicodedata
+import logging.config
+
+logger = logging.getLogger(__name__)
+
+# Forms whose decomposition is compatibility rather than canonical
+_COMPATIBILITY = {'NFKC': 'NFKD', 'NFKD': 'NFKD', 'NFC': 'NFD', 'NFD': 'NFD'}
+
+# Code points scanned for translation tables: every combining mark and
+# format character is in the first two planes or in plane 14
+_RANGES = (range(0x20000), range(0xE0000, 0xE1000))
+
+# Translation tables, one per combination of options
+_tables = {}
+
+class Normalizer():
+    '''
+    Cleans raw documents before a Tokenizer. Each document gets at most
+    one pass per enabled transformation, each a single call into C:
+    html.unescape, unicodedata.normalize, str.translate with a table built
+    once per process, and str.split, which collapses whitespace several
+    times faster than a regex substitution. Documents that are pure ASCII
+    skip the Unicode passes, and documents without '&' the unescaping.
+    '''
+
+    apply = None
+    stream = None
+    dispatch_fun = None
+    stream_fun = None
+    barrier = False
+    form = 'NFKC'               # Unicode normal form, None to skip
+    strip_accents = False       # Remove accents, e.g. 'café' -> 'cafe'
+    unescape_html = True        # Replace entities, e.g. '&amp;' -> '&'
+    remove_invisible = True     # Remove zero width and other format chars
+    collapse_whitespace = True  # Runs of whitespace -> one space, trimmed
+
+    def __init__(self, name, **params):
+        '''
+        :param name {str} name of the normalizer, 'unicode'
+
+        :param *params supported keywords are above as attributes
+
+        '''
+        self.dispatch_fun = {
+                'unicode' : self.unicode,
+                }
+        self.stream_fun = {
+                'unicode' : self._unicode_stream,
+                }
+        self.name = name
+        if name:
+            self.apply = self.dispatch_fun[name]
+            self.stream = self.stream_fun[name]
+        for key in params:
+            setattr(self, key, params[key])
+
+    def unicode(self, docs):
+        '''
+        Normalize documents with the standard library.
+
+        :param docs {list[str]}
+
+        :returns {list[str]} normalized docs
+
+        '''
+        return list(self._unicode_stream(docs))
+
+    def _unicode_stream(self, docs):
+        '''
+        Generator version of unicode, yields one normalized document at a
+        time.
+
+        :param docs {iterable[str]}
+
+        :returns {generator[str]} normalized docs
+
+        '''
+        unescape = html.unescape if self.unescape_html is True else None
+        form = self.form
+        strip_accents = self.strip_accents is True
+        if strip_accents:
+            # Accents are separate marks only in decomposed text
+            decompose = _COMPATIBILITY[form or 'NFC']
+            compose = 'NFC' if form is None else (
+                    form if form in ('NFC', 'NFKC') else None)
+        table = _table(strip_accents, self.remove_invisible is True)
+        collapse = self.collapse_whitespace is True
+
+        for doc in docs:
+            if unescape is not None and '&' in doc:
+                doc = unescape(doc)
+            if not doc.isascii():
+                if strip_accents:
+                    doc = unicodedata.normalize(decompose, doc).translate(
+                            table)
+                    if compose is not None:
+                        doc = unicodedata.normalize(compose, doc)
+                else:
+                    if form is not None:
+                        doc = unicodedata.normalize(form, doc)
+                    if table:
+                        doc = doc.translate(table)
+            if collapse:
+                doc = ' '.join(doc.split())
+            yield doc
+
+
+def _table(strip_accents, remove_invisible):
+    '''
+    :returns {dict} str.translate table deleting combining marks and, or,
+        format characters, empty if neither is removed
+    '''
+    key = (strip_accents, remove_invisible)
+    table = _tables.get(key)
+    if table is None:
+        table = {}
+        if strip_accents or remove_invisible:
+            for codes in _RANGES:
+                for i in codes:
+                    c = chr(i)
+                    if (strip_accents and unicodedata.combining(c)) or (
+                            remove_invisible and
+                            unicodedata.category(c) == 'Cf'):
+                        table[i] = None
+            logger.debug("Built translation table of %d characters",
+                    len(table))
+        _tables[key] = table
+    return table
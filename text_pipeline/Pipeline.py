@@ -10,10 +10,20 @@ Last modified: 6/22/18
 """
 
 import pickle as pkl
-import sys
 import os
-import json
+import copy
+import time
+import tempfile
+import threading
 import logging.config
+import multiprocessing
+from collections import deque
+from array import array
+from .Vocabulary import Vocabulary, TYPECODE
+from .ResultCache import ResultCache, fingerprint
+from .Checkpoint import Checkpoint
+from .Metrics import Hook, StreamMeter, step_report, run_report, \
+        merge_reports, count_tokens, peak_memory, memory_delta
 
 logger = logging.getLogger()
 ROOT_PATH = os.path.dirname(os.path.realpath(__file__))
@@ -21,31 +31,1336 @@ ROOT_PATH = os.path.dirname(os.path.realpath(__file__))
 class Pipeline:
     
     steps = None
+    stages = None
+    vocab = None
+    cache = None
+    _lock = None
 
-    def __init__(self, *args):
+    def __init__(self, *args, ids=False, cache=None, hooks=None):
         """
         Set up basic pipeline attributes
+
+        :param ids {bool} pass tokens between steps as arrays of integer
+            IDs into a shared Vocabulary rather than as lists of strings.
+            Steps that work on single tokens then become table lookups by
+            ID, and strings are only decoded at the end.
+
+        :param cache {ResultCache} or {str} path of a sqlite file. Output
+            of the per-document steps before the first barrier is cached
+            per document, so unchanged documents skip those steps.
+
+        :param hooks {list[Hook]} receive measurements of every step of
+            every run, see Metrics
         """
         
         self.steps = args
+        self.ids = ids
+        self.hooks = list(hooks or ())
+        # Consecutive spacy steps, and consecutive token level steps, are
+        # run as one fused stage each, see plan
+        self.stages = _compile(args)
+        if ids:
+            self.vocab = Vocabulary()
+            self.stages = _use_ids(self.stages, self.vocab)
+        if cache is not None:
+            self.cache = cache if isinstance(cache, ResultCache) \
+                    else ResultCache(cache)
+            n = 0
+            while n < len(args) and not getattr(args[n], 'barrier', False):
+                n += 1
+            # Barriers depend on the whole corpus, so only the steps
+            # before the first one are cached. The two halves only pass on
+            # their step reports, this pipeline reports the run.
+            self._step_reports = {}
+            self.cached = Pipeline(*args[:n], ids=ids, hooks=[_StepEvents(
+                self.hooks, self._step_reports, 0)] if self.hooks else None)
+            self.uncached = Pipeline(*args[n:], ids=ids, hooks=[_StepEvents(
+                self.hooks, self._step_reports, len(self.cached.stages))]
+                if self.hooks else None)
+            self.fingerprint = fingerprint(args[:n])
 
-    def apply(self, docs):
-        for step in self.steps:
+    def apply(self, docs, n_jobs=1, chunk_size=1000, checkpoint_dir=None):
+        '''
+        Applies the pipeline to the text.
+
+        :param docs {list[str]} documents
+
+        :param n_jobs {int} number of worker processes, -1 for one per CPU.
+            With more than one job the documents are split into chunks that
+            are processed by a process pool; the output is in input order.
+
+        :param chunk_size {int} documents per chunk when n_jobs > 1 or when
+            checkpointing
+
+        :param checkpoint_dir {str} directory to checkpoint the run in. The
+            output of every chunk is written to disk as it is done, and
+            running the same pipeline on the same documents again resumes
+            where the previous run stopped.
+
+        :returns {list[list[str]]} processed documents
+
+        '''
+        if n_jobs == -1:
+            n_jobs = os.cpu_count() or 1
+        if self.cache is not None and self.cached.steps:
+            started = self._run_start(len(docs))
+            docs = self._apply_cached(docs, n_jobs, chunk_size)
+            docs = self.uncached.apply(docs, n_jobs, chunk_size,
+                    checkpoint_dir)
+            self._run_end(started)
+            return docs
+        if checkpoint_dir is not None:
+            return self._apply_checkpointed(docs, n_jobs, chunk_size,
+                    checkpoint_dir)
+        if n_jobs is not None and n_jobs > 1:
+            return self._apply_parallel(docs, n_jobs, chunk_size)
+        if self.hooks:
+            return self._apply_measured(docs)
+
+        for step in self.stages:
             logger.info("Running step {}".format(step))
             docs = step.apply(docs)
         return docs
 
-if __name__=="__main__":
-    import Tokenizer as ct
-    # Must pass in filename to load a list of strings
-    if len(sys.argv) is not 2:
-        print("Usage: python3 Pipeline.py <docs>")
-        print("docs: path to a pickled list of strings")
-        sys.exit()
-    filename = sys.argv[1]
-    with open(ROOT_PATH + '/' + filename, 'rb') as f:
-        docs = pkl.load(f)
-
-    t = ct.Tokenizer('spacy')
-    pipeline = Pipeline(t)
-    pipeline.apply(docs[:10])
+    def _apply_measured(self, docs):
+        '''
+        apply, reporting on every step to the hooks.
+        '''
+        hooks = self.hooks
+        progress = [hook for hook in hooks if hook.progress]
+        for hook in hooks:
+            hook.on_run_start(self, len(docs))
+        run_wall, run_cpu = time.perf_counter(), time.process_time()
+        run_peak = peak_memory()
+        reports = []
+        tokens = count_tokens(docs)
+        for i, step in enumerate(self.stages):
+            name = _step_name(step)
+            logger.info("Running step {}".format(step))
+            for hook in hooks:
+                hook.on_step_start(i, name, len(docs))
+            docs_in, tokens_in = len(docs), tokens
+            wall, cpu = time.perf_counter(), time.process_time()
+            peak = peak_memory()
+            if progress and not getattr(step, 'barrier', False) and \
+                    getattr(step, 'stream', None) is not None:
+                docs = list(step.stream(_progress(docs, progress, i, name)))
+            else:
+                docs = step.apply(docs)
+            wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+            tokens = count_tokens(docs)
+            report = step_report(i, name, wall, cpu, docs_in, len(docs),
+                    tokens_in, tokens, memory_delta(peak))
+            reports.append(report)
+            for hook in hooks:
+                hook.on_step_end(report)
+
+        report = run_report(reports, time.perf_counter() - run_wall,
+                time.process_time() - run_cpu, memory_delta(run_peak))
+        for hook in hooks:
+            hook.on_run_end(report)
+        return docs
+
+    def _run_start(self, n_docs):
+        '''
+        Starts reporting a run of a cached pipeline, whose steps run in
+        the cached and uncached halves.
+        '''
+        if not self.hooks:
+            return None
+        self._step_reports.clear()
+        for hook in self.hooks:
+            hook.on_run_start(self, n_docs)
+        return time.perf_counter(), time.process_time(), peak_memory()
+
+    def _run_end(self, started):
+        if started is None:
+            return
+        wall, cpu, peak = started
+        reports = [self._step_reports[i] for i in sorted(self._step_reports)]
+        report = run_report(reports, time.perf_counter() - wall,
+                time.process_time() - cpu, memory_delta(peak))
+        for hook in self.hooks:
+            hook.on_run_end(report)
+
+    def _apply_cached(self, docs, n_jobs=1, chunk_size=1000):
+        '''
+        Runs the cached steps on the documents that are not in the cache,
+        and stores their output.
+        '''
+        keys = [self.cache.key(self.fingerprint, doc) for doc in docs]
+        found = self.cache.get_many(keys)
+        missing = [i for i, key in enumerate(keys) if key not in found]
+        logger.info("%d of %d documents cached", len(docs) - len(missing),
+                len(docs))
+        if missing:
+            output = self.cached.apply([docs[i] for i in missing], n_jobs,
+                    chunk_size)
+            self.cache.set_many((keys[i], doc)
+                    for i, doc in zip(missing, output))
+            for i, doc in zip(missing, output):
+                found[keys[i]] = doc
+        return [found[key] for key in keys]
+
+    def _apply_checkpointed(self, docs, n_jobs, chunk_size, checkpoint_dir):
+        '''
+        Runs the pipeline in units, checkpointing the output of each (see
+        Checkpoint). A unit is either the per-document stages between two
+        barriers, which run chunk by chunk, optionally in a process pool,
+        or a single barrier step, which runs on the whole corpus. Units
+        and chunks that are already on disk are skipped. With hooks, every
+        unit that runs is reported as one step, on the chunks it ran.
+        '''
+        hooks = self.hooks
+        for hook in hooks:
+            hook.on_run_start(self, len(docs))
+        run_wall, run_cpu = time.perf_counter(), time.process_time()
+        run_peak = peak_memory()
+        reports = []
+
+        checkpoint = Checkpoint(checkpoint_dir)
+        checkpoint.start(fingerprint(self.steps), docs, chunk_size)
+
+        units = []
+        for stages, barrier in _split_at_barriers(_compile(self.steps)):
+            if stages:
+                units.append((stages, False))
+            if barrier is not None:
+                units.append(([barrier], True))
+        n_chunks = (len(docs) + chunk_size - 1) // chunk_size
+
+        previous = None
+        for k, (stages, barrier) in enumerate(units):
+            if checkpoint.done(k):
+                previous = k
+                continue
+
+            counts = {'docs_in': 0, 'docs_out': 0, 'tokens_in': 0,
+                    'tokens_out': 0}
+
+            def read(j, previous=previous):
+                if previous is None:
+                    chunk = docs[j * chunk_size:(j + 1) * chunk_size]
+                else:
+                    chunk = checkpoint.read_chunk(previous, j)
+                if hooks:
+                    _tally(counts, 'in', chunk)
+                return chunk
+
+            def write(j, chunk):
+                if hooks:
+                    _tally(counts, 'out', chunk)
+                checkpoint.write_chunk(k, j, chunk)
+
+            logger.info("Running steps {}, checkpointed".format(stages))
+            if hooks:
+                name = ', '.join(_step_name(stage) for stage in stages)
+                for hook in hooks:
+                    hook.on_step_start(k, name, None)
+                wall, cpu = time.perf_counter(), time.process_time()
+                peak = peak_memory()
+            run = _use_ids(stages, self.vocab) if self.ids else stages
+            pooled = False
+            if barrier:
+                out = [doc for j in range(n_chunks) for doc in read(j)]
+                for stage in run:
+                    out = stage.apply(out)
+                for j in range(n_chunks):
+                    write(j, out[j * chunk_size:(j + 1) * chunk_size])
+            else:
+                todo = [j for j in range(n_chunks)
+                        if not checkpoint.has_chunk(k, j)]
+                pooled = n_jobs is not None and n_jobs > 1 and len(todo) > 1
+                if pooled:
+                    with multiprocessing.Pool(n_jobs,
+                            initializer=_init_worker,
+                            initargs=([(stages, None)], self.ids)) as pool:
+                        tasks = ((0, None, read(j)) for j in todo)
+                        results = pool.imap(_run_segment, tasks)
+                        for j, (chunk, _) in zip(todo, results):
+                            write(j, chunk)
+                else:
+                    for j in todo:
+                        write(j, _run_stages(run, read(j)))
+            checkpoint.finish(k, n_chunks)
+            previous = k
+            if hooks:
+                # As in _apply_parallel, pooled work is done in the workers
+                report = step_report(k, name, time.perf_counter() - wall,
+                        None if pooled else time.process_time() - cpu,
+                        counts['docs_in'], counts['docs_out'],
+                        counts['tokens_in'], counts['tokens_out'],
+                        memory_delta(peak))
+                reports.append(report)
+                for hook in hooks:
+                    hook.on_step_end(report)
+
+        out = docs if previous is None else checkpoint.read(previous)
+        if hooks:
+            report = run_report(reports, time.perf_counter() - run_wall,
+                    time.process_time() - run_cpu, memory_delta(run_peak))
+            for hook in hooks:
+                hook.on_run_end(report)
+        return out
+
+    def _apply_parallel(self, docs, n_jobs, chunk_size):
+        '''
+        Runs the pipeline over chunks of docs in a process pool.
+
+        The stages are split into segments at each barrier step. Every
+        segment is one round of tasks, one task per chunk, and a worker
+        runs all per-document stages of the segment on its chunk. When a
+        segment ends in a barrier that supports sharding (see the barrier
+        protocol in TokenFilter), the worker also computes the barrier's
+        partial result for its chunk. The parent reduces the partials once
+        and the next round's workers apply the result to their chunks
+        before running the next segment. Other barriers are run in the
+        parent on the whole corpus.
+        '''
+        # Workers intern tokens with their own Vocabulary, see _init_worker
+        segments = _split_at_barriers(_compile(self.steps))
+        chunks = [docs[i:i + chunk_size]
+                for i in range(0, len(docs), chunk_size)]
+        logger.info("Running %d segments over %d chunks with %d jobs",
+                len(segments), len(chunks), n_jobs)
+
+        hooks = self.hooks
+        for hook in hooks:
+            hook.on_run_start(self, len(docs))
+        run_wall, run_cpu = time.perf_counter(), time.process_time()
+        run_peak = peak_memory()
+        reports = []
+
+        with tempfile.TemporaryDirectory() as tmp, \
+                multiprocessing.Pool(n_jobs, initializer=_init_worker,
+                        initargs=(segments, self.ids)) as pool:
+            state_path = None
+            for i, (stages, barrier) in enumerate(segments):
+                logger.info("Running steps {} in parallel".format(stages))
+                if hooks:
+                    # One report per round, the work of every worker
+                    name = _round_name(segments, i)
+                    docs_in = sum(len(chunk) for chunk in chunks)
+                    tokens_in = count_tokens(d for chunk in chunks
+                            for d in chunk)
+                    for hook in hooks:
+                        hook.on_step_start(i, name, docs_in)
+                    wall, peak = time.perf_counter(), peak_memory()
+                tasks = [(i, state_path, chunk) for chunk in chunks]
+                results = pool.imap(_run_segment, tasks)
+                chunks = []
+                state_path = None
+                if barrier is None or not _is_shardable(barrier):
+                    chunks = [chunk for chunk, _ in results]
+                if barrier is None:
+                    if hooks:
+                        reports.append(self._round_report(i, name, wall,
+                            peak, docs_in, tokens_in, chunks))
+                    continue
+
+                logger.info("Reducing barrier step {}".format(barrier))
+                if _is_shardable(barrier):
+                    # Partials are reduced as they arrive rather than all
+                    # held at once
+                    state = barrier._barrier_reduce(
+                            _partials(results, chunks))
+                    state_path = os.path.join(tmp, 'state_{}.pkl'.format(i))
+                    with open(state_path, 'wb') as f:
+                        pkl.dump(state, f, pkl.HIGHEST_PROTOCOL)
+                    del state
+                else:
+                    docs = barrier.apply([d for chunk in chunks for d in chunk])
+                    chunks = [docs[j:j + chunk_size]
+                            for j in range(0, len(docs), chunk_size)]
+                if hooks:
+                    reports.append(self._round_report(i, name, wall, peak,
+                        docs_in, tokens_in, chunks))
+
+        if hooks:
+            report = run_report(reports, time.perf_counter() - run_wall,
+                    time.process_time() - run_cpu, memory_delta(run_peak))
+            for hook in hooks:
+                hook.on_run_end(report)
+        return [doc for chunk in chunks for doc in chunk]
+
+    def _round_report(self, i, name, wall, peak, docs_in, tokens_in, chunks):
+        # CPU time and memory are spent in the workers, not measured here
+        report = step_report(i, name, time.perf_counter() - wall, None,
+                docs_in, sum(len(chunk) for chunk in chunks), tokens_in,
+                count_tokens(d for chunk in chunks for d in chunk),
+                memory_delta(peak))
+        for hook in self.hooks:
+            hook.on_step_end(report)
+        return report
+
+    def plan(self):
+        '''
+        The execution plan: the stages apply and stream run, in order.
+        Consecutive spacy steps are compiled into a SpacyStage, and other
+        consecutive token level steps (spacy and nltk TokenFilters and
+        Stemmers) into a TokenStage, so that each run of them is a single
+        pass over the documents. Barrier steps are never fused.
+
+        :returns {list[dict]} per stage: its index and name, the steps it
+            runs, whether it is a barrier, and its cost in passes over the
+            documents and token containers built per document, see
+            _stage_cost
+
+        '''
+        plan = []
+        for i, stage in enumerate(self.stages):
+            passes, lists = _stage_cost(stage)
+            plan.append({
+                    'index': i,
+                    'name': _step_name(stage),
+                    'steps': [_step_name(step) for step in _stage_steps(stage)],
+                    'barrier': getattr(stage, 'barrier', False),
+                    'passes': passes,
+                    'lists': lists,
+                    })
+        return plan
+
+    def explain(self):
+        '''
+        :returns {str} the plan as a table, with its total cost and the
+            cost of running every step as its own stage
+        '''
+        plan = self.plan()
+        width = max([len(stage['name']) for stage in plan] + [5])
+        lines = ['{:>3}  {:{}}  {:>5}  {:>6}  {:>9}'.format('#', 'Stage',
+            width, 'Steps', 'Passes', 'Lists/doc')]
+        for stage in plan:
+            lines.append('{:>3}  {:{}}  {:>5}  {:>6}  {:>9}{}'.format(
+                stage['index'], stage['name'], width, len(stage['steps']),
+                stage['passes'], stage['lists'],
+                '  barrier' if stage['barrier'] else ''))
+        unfused = [_stage_cost(step) for step in self.steps]
+        lines.append("{} steps in {} stages: {} passes, {} lists per "
+                "document (unfused: {} passes, {} lists per document)".format(
+                    len(self.steps), len(plan),
+                    sum(stage['passes'] for stage in plan),
+                    sum(stage['lists'] for stage in plan),
+                    sum(passes for passes, _ in unfused),
+                    sum(lists for _, lists in unfused)))
+        return '\n'.join(lines)
+
+    def stream(self, docs, batch_size=1000):
+        '''
+        Lazily applies the pipeline to an iterable of documents. Each step
+        is chained as a generator stage, so documents flow through the
+        pipeline one at a time and are only processed as the result is
+        consumed. Barrier steps (such as frequency filtering) have to see
+        the whole corpus before yielding, see TokenFilter.spool.
+
+        Steps without a stream method are applied to batches of
+        batch_size documents.
+
+        :param docs {iterable[str]} documents
+
+        :param batch_size {int} batch size for steps that cannot stream
+
+        :returns {generator[list[str]]} processed documents
+
+        '''
+        if self.cache is not None and self.cached.steps:
+            docs = self._stream_cached(docs, batch_size)
+            docs = self.uncached.stream(docs, batch_size)
+            if self.hooks:
+                return self._stream_reported(docs)
+            return docs
+        if self.hooks:
+            return self._stream_measured(docs, batch_size)
+
+        for step in self.stages:
+            if getattr(step, 'barrier', False):
+                logger.info("Streaming barrier step {}".format(step))
+            else:
+                logger.info("Streaming step {}".format(step))
+            if getattr(step, 'stream', None) is not None:
+                docs = step.stream(docs)
+            else:
+                docs = _batched_apply(step, docs, batch_size)
+        return docs
+
+    def _stream_measured(self, docs, batch_size):
+        '''
+        stream, reporting on every step to the hooks as its output ends.
+        '''
+        hooks = self.hooks
+        for hook in hooks:
+            hook.on_run_start(self, None)
+        run_wall, run_cpu = time.perf_counter(), time.process_time()
+        run_peak = peak_memory()
+        meters = []
+        for i, step in enumerate(self.stages):
+            logger.info("Streaming step {}".format(step))
+            meter = StreamMeter(i, _step_name(step), hooks)
+            docs = meter.input(docs)
+            if getattr(step, 'stream', None) is not None:
+                docs = step.stream(docs)
+            else:
+                docs = _batched_apply(step, docs, batch_size)
+            docs = meter.output(docs)
+            meters.append(meter)
+
+        yield from docs
+        report = run_report([meter.report for meter in meters],
+                time.perf_counter() - run_wall, time.process_time() - run_cpu,
+                memory_delta(run_peak))
+        for hook in hooks:
+            hook.on_run_end(report)
+
+    def _stream_reported(self, docs):
+        '''
+        Reports a stream of a cached pipeline as one run. The cached steps
+        run batch by batch, and are reported once for all the batches.
+        '''
+        started = self._run_start(None)
+        yield from docs
+        self._run_end(started)
+
+    async def apply_async(self, docs, executor=None, batch_size=1000,
+            max_in_flight=4):
+        '''
+        Applies the pipeline without blocking the event loop, see astream.
+
+        :returns {list[list[str]]} processed documents
+
+        '''
+        return [doc async for doc in self.astream(docs, executor, batch_size,
+            max_in_flight)]
+
+    async def astream(self, docs, executor=None, batch_size=1000,
+            max_in_flight=4):
+        '''
+        Async generator version of stream. Batches of documents are
+        processed in an executor while the event loop carries on, and at
+        most max_in_flight batches are submitted before the oldest one has
+        been yielded, so a slow consumer holds back reading the input.
+        Cancelling the consumer cancels the batches that have not started.
+
+        With a ThreadPoolExecutor (or None, the loop's default executor)
+        batches share this pipeline's steps and models and run one at a
+        time; with a ProcessPoolExecutor they run in parallel, each worker
+        process building the pipeline from its steps once and reusing it,
+        and its models, for every batch. Pools made by executor hand the
+        steps to their workers when they start, so batches only carry
+        documents; other pools get the steps, pickled once, with every
+        batch. A pipeline with barrier steps is run on all documents at
+        once. Workers are not sent the counts TokenFilters have stored, an
+        incremental filter starts from its counts_file.
+
+        :param docs {iterable[str]} or {async iterable[str]} documents
+
+        :param executor {concurrent.futures.Executor} where to run batches
+
+        :param batch_size {int} documents per batch
+
+        :param max_in_flight {int} most batches submitted at a time
+
+        :returns {async generator[list[str]]} processed documents
+
+        '''
+        import asyncio
+
+        from concurrent.futures import ProcessPoolExecutor
+
+        loop = asyncio.get_running_loop()
+        if self._lock is None:
+            self._lock = threading.Lock()
+        if isinstance(executor, ProcessPoolExecutor):
+            # Workers build their own copy of the pipeline from the steps,
+            # rather than being sent this one with its tables every batch
+            spec = self._spec()
+            if getattr(executor, '_pipeline_spec', None) == spec:
+                spec = None
+            fun, arg = _apply_spec_batch, spec
+        else:
+            fun, arg = _apply_batch, self
+        if any(getattr(stage, 'barrier', False) for stage in self.stages):
+            batch_size = None
+        pending = deque()
+        try:
+            async for batch in _abatches(docs, batch_size):
+                pending.append(loop.run_in_executor(executor, fun, arg,
+                    batch))
+                if len(pending) >= max_in_flight:
+                    for doc in await pending.popleft():
+                        yield doc
+            while pending:
+                for doc in await pending.popleft():
+                    yield doc
+        finally:
+            for future in pending:
+                future.cancel()
+
+    def executor(self, max_workers=None):
+        '''
+        Make a process pool for apply_async and astream. Each worker builds
+        the pipeline from its steps when it starts, so batches sent to it
+        only carry documents.
+
+        :param max_workers {int} worker processes, None for one per CPU
+
+        :returns {concurrent.futures.ProcessPoolExecutor}
+
+        '''
+        from concurrent.futures import ProcessPoolExecutor
+
+        spec = self._spec()
+        executor = ProcessPoolExecutor(max_workers,
+                initializer=_init_spec_worker, initargs=(spec,))
+        executor._pipeline_spec = spec
+        return executor
+
+    def _spec(self):
+        '''
+        :returns {bytes} what a worker process needs to build a copy of
+            this pipeline: the steps, without the tables a run builds up
+            or the counts TokenFilters have stored
+        '''
+        steps = [_without_counts(step) for step in self.steps]
+        return pkl.dumps((steps, self.ids, self.cache), pkl.HIGHEST_PROTOCOL)
+
+    def __getstate__(self):
+        # Locks do not pickle, each process makes its own
+        state = dict(vars(self))
+        state.pop('_lock', None)
+        return state
+
+    def _stream_cached(self, docs, batch_size):
+        batch = []
+        for doc in docs:
+            batch.append(doc)
+            if len(batch) >= batch_size:
+                yield from self._apply_cached(batch)
+                batch = []
+        if batch:
+            yield from self._apply_cached(batch)
+
+
+class SpacyStage():
+    '''
+    Runs consecutive spacy backed steps as a single stage. The document is
+    tokenized once (or, without a spacy Tokenizer at the head, turned into
+    a Doc once), every TokenFilter keeps or drops the same Token objects and
+    the Stemmer reads their lemmas, so tokens are only turned back into
+    strings at the very end. Pipeline builds these automatically.
+    '''
+
+    barrier = False
+    tokenizer = None
+    stemmer = None
+
+    def __init__(self, steps, special_cases=()):
+        '''
+        :param steps {list} spacy steps in pipeline order. An optional
+            Tokenizer first, then TokenFilters, then an optional Stemmer.
+
+        :param special_cases {list[tuple(str, list[dict])]} for the
+            Tokenizer, see _special_cases
+
+        '''
+        self.steps = list(steps)
+        self.special_cases = list(special_cases)
+        self.filters = []
+        for step in self.steps:
+            if step.spacy_role == 'tokenize':
+                self.tokenizer = step
+            elif step.spacy_role == 'filter':
+                self.filters.append(step)
+            else:
+                self.stemmer = step
+
+    def __repr__(self):
+        return '<SpacyStage {}>'.format(
+                ', '.join(type(step).__name__ for step in self.steps))
+
+    def apply(self, docs):
+        '''
+        :param docs {list[str]} or {list[list[str]]} if the stage does not
+            start with a Tokenizer
+
+        :returns {list[list[str]]} processed documents
+
+        '''
+        return list(self.stream(docs))
+
+    def stream(self, docs):
+        '''
+        Generator version of apply, yields one document at a time.
+        '''
+        if self.tokenizer is not None:
+            docs = self.tokenizer._spacy_docs(docs, self.special_cases)
+        else:
+            from spacy.tokens import Doc
+            vocab = self.steps[0].nlp.vocab
+            docs = (Doc(vocab, words=words) for words in docs)
+
+        keeps = [f._spacy_keep() for f in self.filters]
+        lemmatize = self.stemmer is not None
+        lookup = self.stemmer._lookup_fun() if lemmatize and \
+                self.stemmer.lookup else None
+
+        for tokens in docs:
+            if keeps:
+                tokens = [t for t in tokens if all(keep(t) for keep in keeps)]
+            if lookup is not None:
+                yield lookup([t.text for t in tokens])
+            elif lemmatize:
+                yield [t.lemma_ for t in tokens]
+            else:
+                yield [t.text for t in tokens]
+
+
+class TokenStage():
+    '''
+    Runs consecutive token level steps (see _token_op in TokenFilter and
+    Stemmer) as a single stage. Every distinct token is sent through the
+    steps once, in pipeline order and in batches of the new tokens of a
+    document, and its result, the final token or None if a filter dropped
+    it, is kept in a table. Each document is then one table lookup per
+    token and one new list, however many steps are fused. Pipeline builds
+    these automatically.
+    '''
+
+    barrier = False
+    max_entries = 1000000       # Table size at which it is cleared
+
+    def __init__(self, steps):
+        '''
+        :param steps {list} token level steps in pipeline order
+
+        '''
+        self.steps = list(steps)
+        self.table = {}
+
+    def __repr__(self):
+        return '<TokenStage {}>'.format(
+                ', '.join(type(step).__name__ for step in self.steps))
+
+    def apply(self, docs):
+        return list(self.stream(docs))
+
+    def stream(self, docs):
+        fun = self._token_op()[1]
+        table = self.table
+        get = table.__getitem__
+        for doc in docs:
+            try:
+                # Once the common tokens are known most documents have no
+                # new ones, so they are only looked for on a miss
+                yield [w for w in map(get, doc) if w is not None]
+                continue
+            except KeyError:
+                pass
+            new = set(doc).difference(table)
+            if len(table) + len(new) > self.max_entries:
+                table.clear()
+                new = set(doc)
+            new = list(new)
+            table.update(zip(new, fun(new)))
+            yield [w for w in map(get, doc) if w is not None]
+
+    def _token_op(self):
+        '''
+        :returns {tuple} ('filter_map', function list[str] -> list[str]),
+            None for the tokens to drop
+        '''
+        ops = [step._token_op() for step in self.steps]
+
+        def run(words):
+            out = [None] * len(words)
+            live = range(len(words))
+            for kind, fun in ops:
+                results = fun(words)
+                if kind == 'filter':
+                    live = [i for i, keep in zip(live, results) if keep]
+                    words = [w for w, keep in zip(words, results) if keep]
+                else:
+                    words = results
+            for i, w in zip(live, words):
+                out[i] = w
+            return out
+
+        return 'filter_map', run
+
+
+class EncodeStage():
+    '''
+    Turns lists of tokens into arrays of IDs of a Vocabulary.
+    '''
+
+    barrier = False
+
+    def __init__(self, vocab):
+        self.vocab = vocab
+
+    def __repr__(self):
+        return '<EncodeStage>'
+
+    def apply(self, docs):
+        return list(self.stream(docs))
+
+    def stream(self, docs):
+        encode = self.vocab.encode
+        for doc in docs:
+            yield encode(doc)
+
+
+class DecodeStage():
+    '''
+    Turns arrays of IDs of a Vocabulary back into lists of tokens.
+    '''
+
+    barrier = False
+
+    def __init__(self, vocab):
+        self.vocab = vocab
+
+    def __repr__(self):
+        return '<DecodeStage>'
+
+    def apply(self, docs):
+        return list(self.stream(docs))
+
+    def stream(self, docs):
+        decode = self.vocab.decode
+        for doc in docs:
+            yield decode(doc)
+
+
+class IdStage():
+    '''
+    Runs a step on arrays of token IDs. A step that works on single tokens
+    (see _token_op in TokenFilter and Stemmer) is applied once per distinct
+    ID and its results are kept in a table indexed by ID: a keep/drop flag
+    for filters, the ID of the result for maps, or for the filter_maps of
+    a TokenStage, the ID of the result or DROPPED. Each document is then
+    one table lookup per token. Barrier steps, such as frequency filtering,
+    count and filter the IDs directly.
+    '''
+
+    # Table values for tokens the step has not seen yet, and for tokens a
+    # filter_map drops
+    UNSEEN = -1
+    DROPPED = -2
+
+    def __init__(self, step, vocab):
+        self.step = step
+        self.vocab = vocab
+        self.barrier = getattr(step, 'barrier', False)
+        self.table = array('q')
+
+    def __repr__(self):
+        return '<IdStage {}>'.format(self.step)
+
+    def apply(self, docs):
+        if self.barrier:
+            return [array(TYPECODE, doc) for doc in self.step.apply(docs)]
+
+        return list(self.stream(docs))
+
+    def stream(self, docs):
+        if self.barrier:
+            for doc in self.step.stream(docs):
+                yield array(TYPECODE, doc)
+            return
+
+        kind, fun = self.step._token_op()
+        table = self.table
+        strings = self.vocab.strings
+        add = self.vocab.add
+        unseen = self.UNSEEN
+        for doc in docs:
+            if len(table) < len(strings):
+                table.extend([unseen] * (len(strings) - len(table)))
+            new = list({i for i in doc if table[i] == unseen})
+            if new:
+                results = fun([strings[i] for i in new])
+                if kind == 'map':
+                    results = [add(r) for r in results]
+                elif kind == 'filter_map':
+                    results = [self.DROPPED if r is None else add(r)
+                            for r in results]
+                for i, r in zip(new, results):
+                    table[i] = r
+
+            if kind == 'filter':
+                yield array(TYPECODE, [i for i in doc if table[i]])
+            elif kind == 'filter_map':
+                yield array(TYPECODE, [r for r in map(table.__getitem__, doc)
+                    if r >= 0])
+            else:
+                yield array(TYPECODE, [table[i] for i in doc])
+
+
+def _step_name(step):
+    '''
+    Name of a step in reports, e.g. TokenFilter.nltk
+    '''
+    if isinstance(step, SpacyStage):
+        return 'SpacyStage({})'.format(', '.join(
+            _step_name(s) for s in step.steps))
+    if isinstance(step, TokenStage):
+        return 'TokenStage({})'.format(', '.join(
+            _step_name(s) for s in step.steps))
+    if isinstance(step, IdStage):
+        return 'IdStage({})'.format(_step_name(step.step))
+    name = getattr(step, 'name', None)
+    if isinstance(name, str):
+        return '{}.{}'.format(type(step).__name__, name)
+    return type(step).__name__
+
+
+def _round_name(segments, i):
+    '''
+    Name of a round of _apply_parallel in reports. A round finishes the
+    previous segment's barrier, runs its own stages and computes the
+    partial result of its barrier.
+    '''
+    names = []
+    if i > 0 and _is_shardable(segments[i - 1][1]):
+        names.append(_step_name(segments[i - 1][1]) + ' (finish)')
+    names.extend(_step_name(stage) for stage in segments[i][0])
+    barrier = segments[i][1]
+    if barrier is not None:
+        names.append(_step_name(barrier) +
+                (' (partial)' if _is_shardable(barrier) else ''))
+    return ', '.join(names)
+
+
+class _StepEvents(Hook):
+    '''
+    Hook of the cached and uncached halves of a cached Pipeline. Passes
+    their step events on to the Pipeline's hooks, with indices shifted by
+    offset, and keeps the step reports for the Pipeline's run report. The
+    halves' own run events are dropped.
+    '''
+
+    def __init__(self, hooks, reports, offset):
+        self.hooks = hooks
+        self.reports = reports
+        self.offset = offset
+        self.progress = any(hook.progress for hook in hooks)
+
+    def on_step_start(self, index, name, n_docs):
+        for hook in self.hooks:
+            hook.on_step_start(index + self.offset, name, n_docs)
+
+    def on_progress(self, index, name, n):
+        for hook in self.hooks:
+            if hook.progress:
+                hook.on_progress(index + self.offset, name, n)
+
+    def on_step_end(self, report):
+        report = dict(report, index=report['index'] + self.offset)
+        for hook in self.hooks:
+            hook.on_step_end(report)
+        index = report['index']
+        if index in self.reports:
+            report = merge_reports(self.reports[index], report)
+        self.reports[index] = report
+
+
+def _tally(counts, side, chunk):
+    '''
+    Adds the documents and tokens of chunk to counts['docs_' + side] and
+    counts['tokens_' + side].
+    '''
+    counts['docs_' + side] += len(chunk)
+    key = 'tokens_' + side
+    tokens = count_tokens(chunk)
+    counts[key] = None if tokens is None or counts[key] is None \
+            else counts[key] + tokens
+
+
+def _progress(docs, hooks, index, name):
+    for doc in docs:
+        for hook in hooks:
+            hook.on_progress(index, name, 1)
+        yield doc
+
+
+def _is_token_op(step):
+    return hasattr(step, '_token_op') and not getattr(step, 'barrier', False)
+
+
+def _use_ids(stages, vocab):
+    '''
+    Run every stage that can work on IDs (token level steps and frequency
+    filtering) as an IdStage, with EncodeStages and DecodeStages wherever
+    the representation has to change. Frequency filters that add to
+    stored counts stay on strings, since their history is keyed by word
+    and outlives the Vocabulary.
+
+    :param stages {list} pipeline stages
+
+    :param vocab {Vocabulary} shared vocabulary
+
+    :returns {list} new stages
+
+    '''
+    out = []
+    encoded = False
+    for stage in stages:
+        if _is_token_op(stage) or (_is_shardable(stage) and
+                getattr(stage, 'incremental', False) is not True):
+            if not encoded:
+                out.append(EncodeStage(vocab))
+                encoded = True
+            out.append(IdStage(stage, vocab))
+        else:
+            if encoded:
+                out.append(DecodeStage(vocab))
+                encoded = False
+            out.append(stage)
+    if encoded:
+        out.append(DecodeStage(vocab))
+    return out
+
+
+def _fuse_spacy(steps):
+    '''
+    Group runs of consecutive spacy steps into SpacyStages. A run may only
+    start with a Tokenizer and ends after a Stemmer, since later steps would
+    work on lemmas rather than the original tokens. Steps of a run share
+    one model, so they must ask for the same model and disabled components.
+    A Tokenizer with special cases is always run as a SpacyStage, fused or
+    not.
+
+    :param steps {list} pipeline steps
+
+    :returns {list} steps, with fusable runs replaced by SpacyStages
+
+    '''
+    cases = _special_cases(steps)
+    stages = []
+    run = []
+    run_cases = []
+
+    def flush():
+        if len(run) > 1 or run_cases:
+            stages.append(SpacyStage(run, run_cases))
+        else:
+            stages.extend(run)
+        del run[:]
+        del run_cases[:]
+
+    for i, step in enumerate(steps):
+        role = getattr(step, 'spacy_role', None)
+        if getattr(step, 'name', None) != 'spacy' or role is None:
+            flush()
+            stages.append(step)
+            continue
+        if role == 'tokenize' or (run and (run[-1].spacy_role == 'lemmatize'
+                or _model_key(run[-1]) != _model_key(step))):
+            flush()
+            if role == 'tokenize':
+                run_cases.extend(cases.get(i, ()))
+        run.append(step)
+    flush()
+    return stages
+
+
+def _special_cases(steps):
+    '''
+    Hand the special cases of spacy TokenFilters to the spacy Tokenizer
+    they follow, with only spacy TokenFilters in between, so that the
+    output does not depend on which steps are fused.
+
+    :param steps {list} pipeline steps
+
+    :raises ValueError if a TokenFilter's special cases have no such
+        Tokenizer
+
+    :returns {dict} index of a Tokenizer in steps -> its special cases
+
+    '''
+    cases = {}
+    tokenizer = None
+    for i, step in enumerate(steps):
+        spacy = getattr(step, 'name', None) == 'spacy'
+        role = getattr(step, 'spacy_role', None)
+        if spacy and role == 'tokenize':
+            tokenizer = i
+        elif spacy and role == 'filter':
+            special_cases = step._special_cases()
+            if special_cases and tokenizer is None:
+                raise ValueError("The special cases of {} need a spacy "
+                        "Tokenizer before it".format(step))
+            if special_cases:
+                cases.setdefault(tokenizer, []).extend(special_cases)
+        else:
+            tokenizer = None
+    return cases
+
+
+def _model_key(step):
+    return step.model, tuple(step.disable or ())
+
+
+def _fuse_tokens(stages):
+    '''
+    Group runs of consecutive token level steps into TokenStages.
+
+    :param stages {list} pipeline stages
+
+    :returns {list} stages, with fusable runs replaced by TokenStages
+
+    '''
+    out = []
+    run = []
+
+    def flush():
+        if len(run) > 1:
+            out.append(TokenStage(run))
+        else:
+            out.extend(run)
+        del run[:]
+
+    for stage in stages:
+        if _is_token_op(stage):
+            run.append(stage)
+        else:
+            flush()
+            out.append(stage)
+    flush()
+    return out
+
+
+def _compile(steps):
+    '''
+    :returns {list} the stages that run steps, see Pipeline.plan
+    '''
+    return _fuse_tokens(_fuse_spacy(steps))
+
+
+def _stage_steps(stage):
+    '''
+    :returns {list} the pipeline steps a stage runs, none for the ID
+        conversions
+    '''
+    if isinstance(stage, (SpacyStage, TokenStage)):
+        return stage.steps
+    if isinstance(stage, IdStage):
+        return _stage_steps(stage.step)
+    if isinstance(stage, (EncodeStage, DecodeStage)):
+        return []
+    return [stage]
+
+
+def _stage_cost(stage):
+    '''
+    :returns {tuple(int, int)} passes over the documents, and token
+        containers (lists, ID arrays and spacy Docs) built per document,
+        when a stage or an unfused step is streamed. A barrier reads its
+        input once to count and once more to filter, and a spooled one
+        unpickles every document again for the second pass. A fused stage
+        is a single pass however many steps it runs.
+    '''
+    if isinstance(stage, IdStage):
+        if not stage.barrier:
+            # One array of IDs, whatever the step builds for strings
+            return 1, 1
+        passes, lists = _stage_cost(stage.step)
+        # Barriers turn their output back into arrays
+        return passes, lists + 1
+    if getattr(stage, 'barrier', False):
+        if getattr(stage, 'spool', False) is True:
+            return 2, 2
+        return 2, 1
+    if isinstance(stage, SpacyStage):
+        # A Doc, the kept tokens, then their texts or lemmas, which a
+        # lookup table maps to yet another list
+        lists = 1 + bool(stage.filters) + 1
+        if stage.stemmer is not None and stage.stemmer.lookup:
+            lists += 1
+        return 1, lists
+    if getattr(stage, 'name', None) == 'spacy':
+        role = getattr(stage, 'spacy_role', None)
+        if role == 'tokenize':
+            # A Doc, then its texts
+            return 1, 2
+        if role == 'lemmatize' and not stage.lookup:
+            # The words copied into a batch Doc, the Doc, its lemmas and
+            # the document's slice of them
+            return 1, 4
+    return 1, 1
+
+
+def _is_shardable(step):
+    return hasattr(step, '_barrier_partial')
+
+
+def _split_at_barriers(stages):
+    '''
+    Split stages into segments of per-document stages, each followed by
+    the barrier that ends it. The last segment is never ended by a barrier,
+    so that the last barrier's result is applied by a final round.
+
+    :returns {list[tuple(list, step)]} (stages, barrier or None) pairs
+
+    '''
+    segments = []
+    run = []
+    for stage in stages:
+        if getattr(stage, 'barrier', False):
+            segments.append((run, stage))
+            run = []
+        else:
+            run.append(stage)
+    segments.append((run, None))
+    return segments
+
+
+# Set in each worker process by _init_worker
+_worker_segments = None
+_worker_state = {}
+
+
+def _init_worker(segments, ids=False):
+    global _worker_segments
+    if ids:
+        # Every segment starts and ends with strings, so the chunks sent
+        # between processes do not depend on this worker's Vocabulary
+        vocab = Vocabulary()
+        segments = [(_use_ids(stages, vocab), barrier)
+                for stages, barrier in segments]
+    _worker_segments = segments
+
+
+def _run_segment(task):
+    '''
+    Runs one segment of the pipeline on one chunk, in a worker process.
+
+    :param task {tuple} (segment index, path of the previous barrier's
+        reduced state or None, chunk of documents)
+
+    :returns {tuple} (processed chunk, partial result of the segment's
+        barrier or None)
+
+    '''
+    i, state_path, chunk = task
+    if state_path is not None:
+        # Each worker loads the reduced state once per round
+        if state_path not in _worker_state:
+            _worker_state.clear()
+            with open(state_path, 'rb') as f:
+                _worker_state[state_path] = pkl.load(f)
+        previous = _worker_segments[i - 1][1]
+        chunk = previous._barrier_finish(chunk, _worker_state[state_path])
+
+    stages, barrier = _worker_segments[i]
+    chunk = _run_stages(stages, chunk)
+
+    partial = None
+    if barrier is not None and _is_shardable(barrier):
+        partial = barrier._barrier_partial(chunk)
+    return chunk, partial
+
+
+def _partials(results, chunks):
+    '''
+    Partial barrier results of a round of _run_segment, collecting the
+    chunks into chunks.
+    '''
+    for chunk, partial in results:
+        chunks.append(chunk)
+        yield partial
+
+
+def _run_stages(stages, chunk):
+    for stage in stages:
+        chunk = stage.apply(chunk)
+    return chunk
+
+
+def _apply_batch(pipeline, batch):
+    '''
+    Runs a batch of apply_async or astream in an executor. Threads take
+    turns, since steps keep caches that are not safe to share.
+    '''
+    if pipeline._lock is None:
+        # A copy in a worker process
+        pipeline._lock = threading.Lock()
+    with pipeline._lock:
+        return pipeline.apply(batch)
+
+
+# Pipelines built from specs in executor worker processes, see _spec
+_spec_pipelines = {}
+
+
+def _init_spec_worker(spec):
+    _spec_pipelines[None] = _from_spec(spec)
+
+
+def _without_counts(step):
+    '''
+    :returns step, or a copy of it without its stored counts, which grow
+        with every incremental run. A copy starts again from its
+        counts_file, if any.
+    '''
+    if getattr(step, 'counts', None) is None:
+        return step
+    step = copy.copy(step)
+    step.counts = None
+    return step
+
+
+def _from_spec(spec):
+    steps, ids, cache = pkl.loads(spec)
+    return Pipeline(*steps, ids=ids, cache=cache)
+
+
+def _apply_spec_batch(spec, batch):
+    '''
+    Runs a batch of apply_async or astream in a ProcessPoolExecutor
+    worker, on the pipeline the worker built from spec, or from the spec
+    it was started with if None. Besides that one, only the pipeline of
+    the most recent spec is kept.
+    '''
+    pipeline = _spec_pipelines.get(spec)
+    if pipeline is None:
+        for key in [key for key in _spec_pipelines if key is not None]:
+            del _spec_pipelines[key]
+        pipeline = _spec_pipelines[spec] = _from_spec(spec)
+    return pipeline.apply(batch)
+
+
+async def _abatches(docs, batch_size):
+    '''
+    Batches of an iterable or async iterable, all of it when batch_size is
+    None.
+    '''
+    batch = []
+    if hasattr(docs, '__aiter__'):
+        async for doc in docs:
+            batch.append(doc)
+            if batch_size is not None and len(batch) >= batch_size:
+                yield batch
+                batch = []
+    else:
+        for doc in docs:
+            batch.append(doc)
+            if batch_size is not None and len(batch) >= batch_size:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+
+def _batched_apply(step, docs, batch_size):
+    '''
+    Stream docs through a step that only has an apply method, in batches
+    of batch_size documents.
+    '''
+    batch = []
+    for doc in docs:
+        batch.append(doc)
+        if len(batch) >= batch_size:
+            yield from step.apply(batch)
+            batch = []
+    if batch:
+        yield from step.apply(batch)
@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+On-disk cache of processed documents, keyed by document content and
+pipeline configuration.
+
+@author: John Sigmon
+"""
+
+import json
+import sqlite3
+import threading
+import hashlib
+import logging.config
+import pickle as pkl
+
+logger = logging.getLogger(__name__)
+
+class ResultCache():
+    '''
+    Stores the output of a pipeline for each document in a sqlite file.
+    An entry's key is a hash of the document together with a fingerprint
+    of the pipeline (see fingerprint), so editing a document or changing
+    any step, parameter or model version simply misses the cache instead
+    of returning stale output. When a size limit is exceeded the least
+    recently used entries are evicted. A cache can be used from several
+    threads, e.g. by Pipeline.apply_async; they take turns.
+    '''
+
+    def __init__(self, path, max_entries=None, max_bytes=None):
+        '''
+        :param path {str} sqlite database file, created if it does not exist
+
+        :param max_entries {int} most documents to keep, None for no limit
+
+        :param max_bytes {int} most bytes of stored output to keep, None for
+            no limit
+
+        '''
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.RLock()
+        # Any thread may use the connection, under the lock
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute('CREATE TABLE IF NOT EXISTS entries ('
+                'key BLOB PRIMARY KEY, value BLOB, size INTEGER, '
+                'used INTEGER)')
+        self.db.execute('CREATE INDEX IF NOT EXISTS entries_used '
+                'ON entries (used)')
+        self.db.commit()
+        # Recency clock for eviction, carried on from previous runs
+        self.clock = self.db.execute(
+                'SELECT COALESCE(MAX(used), 0) FROM entries').fetchone()[0]
+
+    def __repr__(self):
+        return '<ResultCache {}>'.format(self.path)
+
+    def __getstate__(self):
+        # Connections do not pickle, reopen the file instead
+        return {'path': self.path, 'max_entries': self.max_entries,
+                'max_bytes': self.max_bytes}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    @staticmethod
+    def key(fingerprint, doc):
+        '''
+        :param fingerprint {str} pipeline fingerprint, see fingerprint
+
+        :param doc {str} or {list[str]} input document
+
+        :returns {bytes} cache key of the document
+        '''
+        data = doc if isinstance(doc, str) else json.dumps(doc)
+        h = hashlib.blake2b(digest_size=20)
+        h.update(fingerprint.encode('utf-8'))
+        h.update(b'\0')
+        h.update(data.encode('utf-8'))
+        return h.digest()
+
+    def get_many(self, keys):
+        '''
+        :param keys {list[bytes]} cache keys
+
+        :returns {dict} output of every key that is in the cache
+
+        '''
+        with self._lock:
+            return self._get_many(keys)
+
+    def _get_many(self, keys):
+        found = {}
+        keys = list(set(keys))
+        # Stay under sqlite's limit on query parameters
+        for i in range(0, len(keys), 500):
+            batch = keys[i:i + 500]
+            rows = self.db.execute(
+                    'SELECT key, value FROM entries WHERE key IN ({})'.format(
+                        ','.join('?' * len(batch))), batch)
+            for key, value in rows:
+                found[key] = pkl.loads(value)
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        self._touch(list(found))
+        return found
+
+    def set_many(self, items):
+        '''
+        Store output, then evict entries if over a size limit.
+
+        :param items {list[tuple(bytes, list[str])]} (key, output) pairs
+
+        '''
+        with self._lock:
+            self._set_many(items)
+
+    def _set_many(self, items):
+        rows = []
+        for key, value in items:
+            value = pkl.dumps(value, pkl.HIGHEST_PROTOCOL)
+            self.clock += 1
+            rows.append((key, value, len(value), self.clock))
+        self.db.executemany('INSERT OR REPLACE INTO entries '
+                'VALUES (?, ?, ?, ?)', rows)
+        self._evict()
+        self.db.commit()
+
+    def _touch(self, keys):
+        if not keys:
+            return
+        rows = []
+        for key in keys:
+            self.clock += 1
+            rows.append((self.clock, key))
+        self.db.executemany('UPDATE entries SET used = ? WHERE key = ?', rows)
+        self.db.commit()
+
+    def _evict(self):
+        entries, size = self.db.execute(
+                'SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries').fetchone()
+        excess_entries = 0
+        if self.max_entries is not None:
+            excess_entries = max(0, entries - self.max_entries)
+        excess_bytes = 0
+        if self.max_bytes is not None:
+            excess_bytes = max(0, size - self.max_bytes)
+        if not excess_entries and not excess_bytes:
+            return
+
+        evict = []
+        for key, n in self.db.execute(
+                'SELECT key, size FROM entries ORDER BY used'):
+            if excess_entries <= 0 and excess_bytes <= 0:
+                break
+            evict.append((key,))
+            excess_entries -= 1
+            excess_bytes -= n
+        self.db.executemany('DELETE FROM entries WHERE key = ?', evict)
+        logger.info("Evicted %d entries from %s", len(evict), self.path)
+
+    def clear(self):
+        with self._lock:
+            self.db.execute('DELETE FROM entries')
+            self.db.commit()
+
+    def info(self):
+        with self._lock:
+            entries, size = self.db.execute('SELECT COUNT(*), '
+                    'COALESCE(SUM(size), 0) FROM entries').fetchone()
+        lookups = self.hits + self.misses
+        return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'entries': entries,
+                'bytes': size,
+                'max_entries': self.max_entries,
+                'max_bytes': self.max_bytes,
+                }
+
+    def close(self):
+        with self._lock:
+            self.db.close()
+
+
+def fingerprint(steps):
+    '''
+    Describe a pipeline's configuration: the type, backend and parameters
+    of every step, and the versions of the libraries and spacy models they
+    use. Pipelines that would process a document differently get different
+    fingerprints. Steps and parameter values may describe state the
+    parameters do not show, such as the contents of a file, with a
+    _fingerprint method returning a JSON friendly value, e.g. a digest;
+    a step's is a dict of parameters to add or replace.
+
+    :param steps {list} pipeline steps
+
+    :returns {str} hex digest
+
+    '''
+    config = []
+    for step in steps:
+        params = {}
+        for name in dir(step):
+            # Properties such as nlp would load the model
+            if name.startswith('_') or isinstance(
+                    getattr(type(step), name, None), property):
+                continue
+            value = getattr(step, name)
+            if not callable(value):
+                params[name] = _config_value(value)
+        if hasattr(step, '_fingerprint'):
+            params.update(step._fingerprint())
+        backend = getattr(step, 'name', None)
+        versions = {}
+        if backend in ('spacy', 'nltk'):
+            versions[backend] = _version(backend)
+        if backend == 'spacy' and getattr(step, 'model', None):
+            versions[step.model] = _version(step.model)
+        config.append([type(step).__name__, params, versions])
+    return digest(json.dumps(config, sort_keys=True).encode('utf-8'))
+
+
+def digest(data):
+    '''
+    :param data {bytes}
+
+    :returns {str} hex digest of data, as used by fingerprint
+    '''
+    return hashlib.blake2b(data, digest_size=20).hexdigest()
+
+
+def _config_value(value):
+    '''
+    JSON friendly version of a parameter. Objects without a stable value,
+    such as loaded models or caches, are described by their type only.
+    '''
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    if hasattr(value, '_fingerprint'):
+        return value._fingerprint()
+    if isinstance(value, (list, tuple, set, frozenset)):
+        values = [_config_value(v) for v in value]
+        if isinstance(value, (set, frozenset)):
+            values.sort(key=repr)
+        return values
+    # Subclasses such as Counter hold state rather than configuration
+    if type(value) is dict:
+        return {str(k): _config_value(v) for k, v in value.items()}
+    return '<{}>'.format(type(value).__name__)
+
+
+def _version(package):
+    try:
+        from importlib.metadata import version
+        return version(package)
+    except Exception:
+        return None
@@ -13,7 +13,10 @@ import sys
 import json
 import pickle as pkl
 import logging.config
-from tqdm import tqdm
+from itertools import islice
+from collections import OrderedDict
+from .ModelRegistry import ModelRegistry
+from .ResultCache import digest
 
 logger = logging.getLogger(__name__)
 ROOT_PATH = os.path.dirname(os.path.realpath(__file__))
@@ -21,23 +24,120 @@ ROOT_PATH = os.path.dirname(os.path.realpath(__file__))
 class Stemmer():
     
     apply = None
-    nlp = None
+    stream = None
+    barrier = False
+    spacy_role = 'lemmatize'    # Role when fused with other spacy steps
     stemmer = None
     lemmatizer = None
+    model = 'en_core_web_sm'
+    disable = None
+    batch_size = 1000
+    cache = None
+    lookup = False
+    lemma_table = None
 
-    def __init__(self, name, stemmer=None, lemmatizer=None):
+    def __init__(self, name, stemmer=None, lemmatizer=None,
+            model='en_core_web_sm', disable=None, batch_size=1000,
+            cache_size=100000, cache_policy='lru', cache_file=None,
+            lookup=False, lemma_table=None):
+        '''
+
+        :param name {str} name of the library you wish to use
+
+        :param stemmer {str} 'porter' or 'snowball', nltk only
+
+        :param lemmatizer {str} 'wordnet', nltk only
+
+        :param model {str} spacy model package, spacy only
+
+        :param disable {list[str]} spacy pipeline components not to load
+
+        :param batch_size {int} documents per spacy Doc, spacy only
+
+        :param cache_size {int} most stems, or with lookup lemmas, to
+            remember, None for no limit and 0 to disable caching
+
+        :param cache_policy {str} 'lru' evicts the least recently used stem
+            or lemma when the cache is full, 'fifo' the oldest one
+
+        :param cache_file {str} cache saved by save_cache to preload
+
+        :param lookup {bool} lemmatize by looking words up in a plain dict
+            rather than building spacy Docs, spacy only. Words are added to
+            the dict from spacy the first time they are seen.
+
+        :param lemma_table {dict} or {str} path of a JSON file, lemmas of
+            words to use instead of spacy's, implies lookup. Words missing
+            from it are left as they are.
+
+        '''
         self.dispatch_fun = {
             'nltk': self.nltk,
             'spacy': self.spacy
             }
+        self.stream_fun = {
+            'nltk': self._nltk_stream,
+            'spacy': self._spacy_stream
+            }
+        self.name = name
         if name: 
             self.apply = self.dispatch_fun[name]
+            self.stream = self.stream_fun[name]
         self.stemmer = stemmer
         self.lemmatizer = lemmatizer
-        
-        if name is 'spacy':
-            import en_core_web_sm
-            self.nlp = en_core_web_sm.load()
+        self.model = model
+        self.disable = disable
+        self.batch_size = batch_size
+        self.lookup = lookup or lemma_table is not None
+        self.lemma_table = lemma_table
+        self._lemma_digest = None
+        if isinstance(lemma_table, str):
+            with open(lemma_table, 'rb') as f:
+                data = f.read()
+            lemma_table = json.loads(data.decode('utf-8'))
+            self._lemma_digest = digest(data)
+        if lemma_table is None:
+            # Lemmas looked up from spacy, bounded like the stem cache
+            self._lemmas = TokenCache(cache_size, cache_policy)
+        else:
+            self._lemmas = dict(lemma_table)
+
+        # Token frequencies are Zipfian, so most stems have been seen before
+        if cache_size != 0:
+            self.cache = TokenCache(cache_size, cache_policy)
+        if cache_file is not None:
+            self.load_cache(cache_file)
+
+    def _fingerprint(self):
+        '''
+        :returns {dict} the lemma table as ResultCache's fingerprint sees
+            it, a digest of its contents rather than its path, so that
+            editing the file misses the cache
+        '''
+        if self.lemma_table is None:
+            return {}
+        if self._lemma_digest is None:
+            self._lemma_digest = digest(json.dumps(self._lemmas,
+                sort_keys=True).encode('utf-8'))
+        return {'lemma_table': '<lemmas {}>'.format(self._lemma_digest)}
+
+    def __getstate__(self):
+        # Lemmas looked up from spacy and stems grow with the corpus and are
+        # cheap to look up again, a lemma_table is kept
+        state = self.__dict__.copy()
+        if self.lemma_table is None:
+            state['_lemmas'] = TokenCache(self._lemmas.maxsize,
+                    self._lemmas.policy)
+        if self.cache is not None:
+            state['cache'] = TokenCache(self.cache.maxsize, self.cache.policy)
+        return state
+
+    @property
+    def nlp(self):
+        '''
+        The spacy model, loaded on first use and shared between steps.
+        '''
+        return ModelRegistry.load(self.model, self.disable)
 
     def nltk(self, docs):
         '''
@@ -48,6 +148,34 @@ class Stemmer():
        
         :returns {list[list[str]]} stems of words or tokens
 
+        '''
+        stems = list(self._nltk_stream(docs))
+        
+        logger.debug("Type of return: %s", type(stems))
+        logger.debug("Length: %d", len(stems))
+        if stems:
+            logger.debug("Length of first entry: %d", len(stems[0]))
+        return stems        
+
+    def _nltk_stream(self, docs):
+        '''
+        Generator version of nltk, yields the stems of one document at a time.
+
+        :params docs {iterable[list[str]]}
+
+        :returns {generator[list[str]]} stems of words or tokens
+
+        '''
+        stem = self._nltk_stem_fun()
+        if self.cache is not None:
+            stem = self.cache.wrap(stem)
+        for doc in docs:
+            yield [stem(w) for w in doc]
+
+    def _nltk_stem_fun(self):
+        '''
+        :returns {function} the nltk stem or lemmatize function, str -> str
+
         '''
         # No default stemmer currently        
         if self.stemmer == 'porter':
@@ -62,14 +190,53 @@ class Stemmer():
         
         # Logic works if functionality not expanded. Check if expanded
         if self.stemmer is not None:
-            stems = [[stemmer.stem(w) for w in doc] for doc in tqdm(docs)]
-        else:
-            stems = [[lemmatizer.lemmatize(w) for w in doc] for doc in tqdm(docs)]
-        
-        logger.debug("Type of return: %s", type(stems))
-        logger.debug("Length: %d", len(stems))
-        logger.debug("Length of first entry: %d", len(stems[0]))
-        return stems        
+            return stemmer.stem
+        return lemmatizer.lemmatize
+    
+    def cache_info(self):
+        '''
+        :returns {dict} hits, misses, size and maxsize of the stem cache,
+            or None if caching is disabled
+
+        '''
+        if self.cache is None:
+            return None
+        return self.cache.info()
+
+    def save_cache(self, path):
+        '''
+        Save the stem cache as JSON, so that later runs can preload it.
+
+        :param path {str} file to write
+
+        '''
+        self._check_cache()
+        with open(path, 'w') as f:
+            json.dump({
+                'stemmer': self.stemmer,
+                'lemmatizer': self.lemmatizer,
+                'entries': self.cache.items(),
+                }, f)
+
+    def load_cache(self, path):
+        '''
+        Preload the stem cache from a file written by save_cache.
+
+        :param path {str} file to read
+
+        '''
+        self._check_cache()
+        with open(path) as f:
+            saved = json.load(f)
+        if (saved['stemmer'], saved['lemmatizer']) != (self.stemmer, self.lemmatizer):
+            raise ValueError("Cache in {} was made by stemmer={}, "
+                    "lemmatizer={}".format(path, saved['stemmer'],
+                        saved['lemmatizer']))
+        self.cache.update(saved['entries'])
+
+    def _check_cache(self):
+        if self.cache is None:
+            raise ValueError("Stemmer caching is disabled, cache_size is 0")
     
     def spacy(self, docs):
         '''
@@ -80,13 +247,195 @@ class Stemmer():
         :returns {list[list[str]]} stems of words or tokens
 
         '''
+        return list(self._spacy_stream(docs))
+
+    def _spacy_stream(self, docs):
+        '''
+        Generator version of spacy, yields the lemmas of one document at a
+        time.
+
+        :params docs {iterable[list[str]]}
+
+        :returns {generator[list[str]]} stems of words or tokens
+
+        '''
+        if self.lookup:
+            yield from self._lookup_stream(docs)
+            return
+
         from spacy.tokens import Doc
-  
-        stems = []
-        for doc in tqdm(docs):
-            doc = Doc(self.nlp.vocab, words=doc)
-            stems.append([w.lemma_ for w in doc])
-            del doc
-        
-        return stems
-        #return [[w.lemma_ for w in Doc(self.nlp.vocab, words=doc)] for doc in docs]
+        from spacy.util import minibatch
+
+        vocab = self.nlp.vocab
+        # Without a tagger lemmas only depend on the word, so every batch
+        # of documents shares a single Doc to save per Doc overhead
+        for batch in minibatch(docs, size=self.batch_size):
+            words = Doc(vocab, words=[w for doc in batch for w in doc])
+            lemmas = [w.lemma_ for w in words]
+            start = 0
+            for doc in batch:
+                end = start + len(doc)
+                yield lemmas[start:end]
+                start = end
+
+    def _lookup_stream(self, docs):
+        '''
+        Lookup version of _spacy_stream. The words of batch_size documents
+        at a time are lemmatized together, so spacy is asked about all of
+        a batch's new words at once.
+
+        :params docs {iterable[list[str]]}
+
+        :returns {generator[list[str]]} lemmas of words or tokens
+
+        '''
+        lemmatize = self._lookup_fun()
+        docs = iter(docs)
+        while True:
+            batch = list(islice(docs, self.batch_size))
+            if not batch:
+                return
+            lemmas = lemmatize([w for doc in batch for w in doc])
+            start = 0
+            for doc in batch:
+                end = start + len(doc)
+                yield lemmas[start:end]
+                start = end
+
+    def _lookup_fun(self):
+        '''
+        :returns {function} list[str] -> list[str], the lemmas of words
+            looked up in the lemma table
+        '''
+        if self.lemma_table is not None:
+            get = self._lemmas.get
+            return lambda words: [get(w, w) for w in words]
+
+        from spacy.tokens import Doc
+
+        vocab = self.nlp.vocab
+        lemmas = self._lemmas
+        table = lemmas.data
+        lru = lemmas.policy == 'lru'
+
+        def lemmatize(words):
+            unique = set(words)
+            new = list(unique.difference(table))
+            lemmas.misses += len(new)
+            lemmas.hits += len(unique) - len(new)
+            if lru:
+                for w in unique.intersection(table):
+                    table.move_to_end(w)
+            # Without a tagger a lemma only depends on the word, so spacy's
+            # answer for a word holds for all its occurrences. The batch is
+            # answered before the table, which may not have room for all of
+            # its words, takes in the new ones.
+            found = dict(zip(new, [w.lemma_ for w in Doc(vocab, words=new)])
+                    if new else ())
+            result = [found[w] if w in found else table[w] for w in words]
+            lemmas.update(found.items())
+            return result
+
+        return lemmatize
+
+    def save_lemma_table(self, path):
+        '''
+        Save the lemmas looked up so far as JSON, to pass as lemma_table
+        to later runs, which then need no spacy model.
+
+        :param path {str} file to write
+
+        '''
+        with open(path, 'w') as f:
+            json.dump(dict(self._lemmas.items()) if self.lemma_table is None
+                    else self._lemmas, f, ensure_ascii=False)
+
+    def _token_op(self):
+        '''
+        Describe this step as an operation on single tokens, so that it can
+        be applied once per distinct token, e.g. to the integer IDs of
+        Pipeline(..., ids=True).
+
+        :returns {tuple} ('map', function list[str] -> list[str])
+
+        '''
+        if self.name == 'nltk':
+            stem = self._nltk_stem_fun()
+            # Preloaded stems still count, see cache_file
+            if self.cache is not None:
+                stem = self.cache.wrap(stem)
+            return 'map', lambda words: [stem(w) for w in words]
+        if self.lookup:
+            return 'map', self._lookup_fun()
+
+        from spacy.tokens import Doc
+
+        vocab = self.nlp.vocab
+        return 'map', lambda words: [w.lemma_ for w in Doc(vocab, words=words)]
+
+
+class TokenCache():
+    '''
+    Bounded cache of the results of a function of one token, with hit and
+    miss statistics.
+    '''
+
+    def __init__(self, maxsize=100000, policy='lru'):
+        '''
+        :param maxsize {int} most entries to keep, None for no limit
+
+        :param policy {str} 'lru' or 'fifo', which entry to evict when full
+
+        '''
+        if policy not in ('lru', 'fifo'):
+            raise ValueError("Unknown cache policy {}".format(policy))
+        self.maxsize = maxsize
+        self.policy = policy
+        self.hits = 0
+        self.misses = 0
+        # Plain dicts keep insertion order, which is all fifo needs
+        self.data = OrderedDict() if policy == 'lru' else {}
+
+    def wrap(self, fun):
+        '''
+        :param fun {function} str -> str
+
+        :returns {function} fun, answering from the cache when possible
+
+        '''
+        data = self.data
+        maxsize = self.maxsize
+        lru = self.policy == 'lru'
+
+        def cached(w):
+            try:
+                result = data[w]
+            except KeyError:
+                self.misses += 1
+                result = data[w] = fun(w)
+                if maxsize is not None and len(data) > maxsize:
+                    del data[next(iter(data))]
+                return result
+            self.hits += 1
+            if lru:
+                data.move_to_end(w)
+            return result
+
+        return cached
+
+    def info(self):
+        return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self.data),
+                'maxsize': self.maxsize,
+                }
+
+    def items(self):
+        return list(self.data.items())
+
+    def update(self, items):
+        for w, result in items:
+            self.data[w] = result
+        while self.maxsize is not None and len(self.data) > self.maxsize:
+            del self.data[next(iter(self.data))]
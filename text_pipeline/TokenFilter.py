@@ -11,21 +11,33 @@ Last modified: 6/28/18
 
 import os
 import sys
+import gzip
 import json
 import pickle as pkl
-import spacy
+import tempfile
 import logging.config
-from spacy.attrs import ORTH, LEMMA
-from spacy.tokens import Doc
-from tqdm import tqdm
+import multiprocessing
+from array import array
+from collections import Counter
+from .ModelRegistry import ModelRegistry
+from .CountMinSketch import CountMinSketch
+from .ResultCache import digest
+from .Stemmer import TokenCache
 
 logger = logging.getLogger()
 ROOT_PATH = os.path.dirname(os.path.realpath(__file__))
 
+# Word sets are built once per process and shared by every TokenFilter
+_word_sets = {}
+
 class TokenFilter():
     
     apply = None
+    stream = None
     dispatch_fun = None
+    stream_fun = None
+    barrier = False             # True if the step needs the whole corpus
+    spacy_role = 'filter'       # Role when fused with other spacy steps
 
     # Default params
     to_lower = True
@@ -35,12 +47,26 @@ class TokenFilter():
     keep_alpha_nums = True      # Keep only alphas and digits
     remove_stops = True
     remove_oov = False           # Out of Vocab
+    vocab_file = None           # Vocab for remove_oov, one word per line
     remove_nums = False          # Removes anything resembling number
     add_special_case = None
     remove_url = True
     remove_email = True
     remove_punct = False
     threshold = None # Exclusive threshold
+    approximate = False         # Count with a fixed size CountMinSketch
+    memory = 64 * 2 ** 20       # Bytes for the sketch when approximate
+    delta = 0.01                # Sketch failure probability
+    n_jobs = 1                  # Processes for frequency filtering
+    incremental = False         # Add each run's counts to the stored counts
+    counts_file = None          # Stored counts to start from, see save_counts
+    counts = None               # Stored counts, see fit
+    spool = True                # Spool barrier input to disk when streaming
+    spool_dir = None            # Directory for spool files, None for tmp
+    model = 'en_core_web_sm'    # spacy model package
+    disable = None              # spacy pipeline components not to load
+    cache_size = 100000         # Most spacy decisions to remember, 0 for none
+    cache_policy = 'lru'        # Decision to forget when full, or 'fifo'
 
     def __init__(self, name, **params):
         '''
@@ -51,15 +77,13 @@ class TokenFilter():
 
         '''
         
-        self.dispatch_fun = {
-                'spacy' : self.spacy,
-                'nltk' : self.nltk,
-                'frequency': self.frequency
-                }
-        
         # Choose library
-        if name: 
-            self.apply = self.dispatch_fun[name]
+        self.name = name
+        self._bind()
+        
+        # Frequency filtering needs every document before it can emit one
+        if name == 'frequency':
+            self.barrier = True
         
         # Parse params
         for key in params:
@@ -67,20 +91,71 @@ class TokenFilter():
         logger.debug(vars(self))
         
         # Setup big files for vocab etc
-        if name == 'spacy':
-            #import en_core_web_md
-            #self.nlp = en_core_web_md.load()
-            import en_core_web_sm
-            self.nlp = en_core_web_sm.load()
-        
         if name == 'nltk':
-            from nltk.corpus import words
-            from nltk.corpus import stopwords
             if self.remove_stops is True:
-                self.stop_words = set(stopwords.words('english'))
+                self._stop_words_source = 'nltk:stopwords'
+                self.stop_words = load_word_set(self._stop_words_source)
 
             if self.remove_oov is True:
-                self.vocab = words.words() 
+                self._vocab_source = self.vocab_file or 'nltk:words'
+                self.vocab = load_word_set(self._vocab_source)
+
+        if name == 'spacy':
+            self._compile_spacy_checks()
+
+        if self.counts_file is not None:
+            self.load_counts(self.counts_file)
+
+    def _bind(self):
+        '''
+        Point apply and stream at this filter's methods for its name.
+        '''
+        self.dispatch_fun = {
+                'spacy' : self.spacy,
+                'nltk' : self.nltk,
+                'frequency': self.frequency
+                }
+        self.stream_fun = {
+                'spacy' : self._spacy_stream,
+                'nltk' : self._nltk_stream,
+                'frequency': self._frequency_stream
+                }
+        if self.name: 
+            self.apply = self.dispatch_fun[self.name]
+            self.stream = self.stream_fun[self.name]
+
+    def __getstate__(self):
+        # Word sets are looked up again in the receiving process rather
+        # than pickled, e.g. when sent to Pipeline's worker processes
+        state = self.__dict__.copy()
+        state.pop('stop_words', None)
+        state.pop('vocab', None)
+        # Bound methods would refer to this filter rather than a copy
+        for key in ('dispatch_fun', 'stream_fun', 'apply', 'stream'):
+            state.pop(key, None)
+        # Decisions are cheap to make again, and grow with the corpus
+        if state.get('_decisions') is not None:
+            state['_decisions'] = TokenCache(self.cache_size,
+                    self.cache_policy)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._bind()
+        if '_stop_words_source' in state:
+            self.stop_words = load_word_set(self._stop_words_source)
+        if '_vocab_source' in state:
+            self.vocab = load_word_set(self._vocab_source)
+        # Copies sent to workers without their counts start from the file
+        if self.counts is None and self.counts_file is not None:
+            self.load_counts(self.counts_file)
+
+    @property
+    def nlp(self):
+        '''
+        The spacy model, loaded on first use and shared between steps.
+        '''
+        return ModelRegistry.load(self.model, self.disable)
         
     def spacy(self, docs):
         '''
@@ -96,48 +171,115 @@ class TokenFilter():
         '''
         
 
-        if self.add_special_case is not None:
-            special_cases = self.add_special_case
-            for pattern, replace in special_cases:
-                logger.debug(type(pattern, replace))
-                self.nlp.tokenizer.add_special_case(pattern, replace)
-        
-        # Tokenize
-        tkns = []
-        for doc in tqdm(docs):
-            # Intermediate steps are all tokens. Lemmatize at the end.
-            # Add unicode text to tkns at end of intermediate steps
-            # Pass over each doc multiple times to avoid complicated logic.
-            doc = Doc(self.nlp.vocab,words=doc)
-            if self.remove_stops is True:     
-                doc = [t for t in doc if t.is_stop is False]
-
-           # This functionality does not currently work on spacy end
-           # if self.remove_oov is True:
-           #     doc = [t for t in doc if t.is_oov is True] # keep if in vocab
-            
-            if self.keep_alpha is True:
-                doc = [t for t in doc if t.is_alpha is True]
-
-            if self.keep_alpha_nums is True:
-                doc = [t for t in doc if t.is_alpha or t.is_digit is True]
-                        
-            if self.remove_punct is True:
-                doc = [t for t in doc if t.is_punct is False]
-            
-            if self.remove_nums is True:
-                doc = [t for t in doc if t.like_num is False]
-            
-            if self.remove_email is True:
-                doc = [t for t in doc if t.like_email is False]
-            
-            if self.remove_url is True:
-                doc = [t for t in doc if t.like_url is False]
-            
-            tkns.append([t.text for t in doc])
-            del doc
-        
-        return tkns 
+        return list(self._spacy_stream(docs))
+
+    def _spacy_stream(self, docs):
+        '''
+        Generator version of spacy, yields one filtered document at a time.
+
+        : params {iterable[list[str]]} documents to be filtered
+
+        : returns {generator[list[str]]} filtered documents
+
+        '''
+        decide = self._spacy_word_check()
+
+        # One pass and one lookup per token, spacy is only asked about
+        # words that have not been seen recently
+        for doc in docs:
+            yield [w for w in doc if decide(w)]
+
+    def _compile_spacy_checks(self):
+        '''
+        Turn the enabled spacy filters into a list of checks. Each check is
+        (attributes, required): a token is kept only if, for every check,
+        whether any of its attributes is set equals required. Keep/drop
+        decisions only depend on the lexeme, so they are cached per word,
+        in a TokenCache of cache_size words.
+        '''
+        checks = []
+        if self.remove_stops is True:
+            checks.append((('is_stop',), False))
+        # remove_oov does not currently work on spacy end
+        if self.keep_alpha is True:
+            checks.append((('is_alpha',), True))
+        if self.keep_alpha_nums is True:
+            checks.append((('is_alpha', 'is_digit'), True))
+        if self.remove_punct is True:
+            checks.append((('is_punct',), False))
+        if self.remove_nums is True:
+            checks.append((('like_num',), False))
+        if self.remove_email is True:
+            checks.append((('like_email',), False))
+        if self.remove_url is True:
+            checks.append((('like_url',), False))
+        self._checks = tuple(checks)
+        self._decisions = None
+        if self.cache_size != 0:
+            self._decisions = TokenCache(self.cache_size, self.cache_policy)
+
+    def _spacy_decide(self, lex):
+        '''
+        : params lex {spacy.lexeme.Lexeme} or {spacy.tokens.Token}
+
+        : returns {bool} True if the word passes every enabled filter
+
+        '''
+        for attrs, required in self._checks:
+            if any(getattr(lex, attr) for attr in attrs) is not required:
+                return False
+        return True
+
+    def _special_cases(self):
+        '''
+        Special cases only change how text is split into tokens, so in a
+        Pipeline they are handed to the spacy Tokenizer before the filter,
+        which then tokenizes with a copy of the model's tokenizer that has
+        them, see ModelRegistry.tokenizer. The shared model is never
+        changed.
+
+        : returns {list[tuple(str, list[dict])]} add_special_case, or empty
+
+        '''
+        special_cases = list(self.add_special_case or ())
+        for pattern, replace in special_cases:
+            logger.debug("Special case %r -> %r", pattern, replace)
+        return special_cases
+
+    def _spacy_word_check(self):
+        '''
+        : returns {function} str -> bool, True if the word passes every
+            enabled filter, answered from the decision cache when possible
+
+        '''
+        vocab = self.nlp.vocab
+        decide = self._spacy_decide
+        check = lambda w: decide(vocab[w])
+        if self._decisions is None:
+            return check
+        return self._decisions.wrap(check)
+
+    def _spacy_keep(self):
+        '''
+        Decide whether spacy should keep tokens, used by fused spacy
+        stages. Shares the per word decisions of spacy.
+
+        : returns {function} spacy.tokens.Token -> bool, True if the token
+            passes every enabled filter
+
+        '''
+        decide = self._spacy_word_check()
+        return lambda t: decide(t.text)
+
+    def cache_info(self):
+        '''
+        :returns {dict} hits, misses, size and maxsize of the spacy
+            decision cache, or None if there is none
+
+        '''
+        if getattr(self, '_decisions', None) is None:
+            return None
+        return self._decisions.info()
     
     def nltk(self, docs):
         '''
@@ -147,10 +289,18 @@ class TokenFilter():
         :returns {list[list[str]]} tokenized docs
 
         '''
+        return list(self._nltk_stream(docs))
+
+    def _nltk_stream(self, docs):
+        '''
+        Generator version of nltk, yields one filtered document at a time.
 
-        # Tokenize
-        tkns = []
-        for doc in tqdm(docs):
+        :param docs {iterable[list[str]]} 
+
+        :returns {generator[list[str]]} filtered docs
+
+        '''
+        for doc in docs:
         
             if self.remove_stops is True:
                 doc = [w for w in doc if w not in self.stop_words]
@@ -158,9 +308,7 @@ class TokenFilter():
             if self.remove_oov is True:
                 doc = [w for w in doc if w in self.vocab]
 
-            tkns.append(doc)
-            del doc
-        return tkns        
+            yield doc
 
     def frequency(self, docs):
         '''
@@ -174,20 +322,388 @@ class TokenFilter():
 
         '''
         
-        # Get frequency counts from doc
-        freq_counts = {}
-        for doc in tqdm(docs):
-            for w in doc:
-                if w in freq_counts:
-                    freq_counts[w] += 1
-                else:
-                    freq_counts[w] = 1
-
-        # Get list of words that are to be removed
-        remove_list = [w for w in tqdm(freq_counts) if freq_counts[w] < self.threshold]
-        remove_list_dict = dict.fromkeys(remove_list, None)
-        del remove_list
+        if self.n_jobs is not None and self.n_jobs != 1:
+            return self._frequency_parallel(docs)
+
+        freq_counts = self._add_history(self.count(docs))
+        remove_list_dict = self._rare_words(freq_counts)
         del freq_counts
 
         # Make new list of documents without words in remove_list
-        return [[w for w in doc if w not in remove_list_dict] for doc in tqdm(docs)]
+        return [[w for w in doc if w not in remove_list_dict] for doc in docs]
+
+    def _frequency_parallel(self, docs):
+        '''
+        frequency with n_jobs processes. docs is split into one shard per
+        process, the shards are counted in parallel, the partial counts are
+        merged and then the shards are filtered in parallel.
+        '''
+        n_jobs = self.n_jobs if self.n_jobs != -1 else os.cpu_count() or 1
+        size = -(-len(docs) // n_jobs) or 1
+        shards = [docs[i:i + size] for i in range(0, len(docs), size)]
+
+        with multiprocessing.Pool(n_jobs) as pool:
+            freq_counts = self._add_history(self.merge_counts(
+                pool.imap_unordered(_count_shard,
+                    [(self, shard) for shard in shards])))
+            remove_list_dict = self._rare_words(freq_counts)
+            del freq_counts
+            filtered = pool.map(_filter_shard,
+                    [(remove_list_dict, shard) for shard in shards])
+        return [doc for shard in filtered for doc in shard]
+
+    def _frequency_stream(self, docs):
+        '''
+        Generator version of frequency. This step is a barrier: every
+        document has to be counted before the first one can be filtered.
+        While counting, the incoming documents are spooled to a temporary
+        file (or kept in a list if spool is False), which is then read back
+        one document at a time for the filtering pass.
+
+        :params docs {iterable[list[str]]} documents
+
+        :returns {generator[list[str]]} filtered documents
+
+        '''
+        if self.spool is not True:
+            docs = list(docs)
+            remove_list_dict = self._rare_words(
+                    self._add_history(self.count(docs)))
+            for doc in docs:
+                yield [w for w in doc if w not in remove_list_dict]
+            return
+
+        with tempfile.TemporaryFile(dir=self.spool_dir) as spool:
+            freq_counts = self._new_counts()
+            for doc in docs:
+                freq_counts.update(doc)
+                pkl.dump(doc, spool, pkl.HIGHEST_PROTOCOL)
+            freq_counts = self._add_history(freq_counts)
+            remove_list_dict = self._rare_words(freq_counts)
+            del freq_counts
+            logger.debug("Spooled %d bytes", spool.tell())
+
+            spool.seek(0)
+            while True:
+                try:
+                    doc = pkl.load(spool)
+                except EOFError:
+                    break
+                yield [w for w in doc if w not in remove_list_dict]
+
+    def count(self, docs):
+        '''
+        Count how often each word occurs in docs. Counts of different
+        shards of a corpus can be combined with merge_counts, so shards can
+        be counted separately, e.g. in other processes, see count_shards.
+
+        :params docs {iterable[list[str]]} documents
+
+        :returns {Counter} word -> frequency count, or {CountMinSketch} if
+            approximate
+
+        '''
+        freq_counts = self._new_counts()
+        for doc in docs:
+            freq_counts.update(doc)
+        return freq_counts
+
+    def merge_counts(self, partials):
+        '''
+        Combine the counts of several shards of a corpus.
+
+        :params partials {iterable[Counter]} or {iterable[CountMinSketch]}
+            results of count
+
+        :returns {Counter} or {CountMinSketch} counts of the whole corpus
+
+        '''
+        freq_counts = self._new_counts()
+        for partial in partials:
+            freq_counts.update(partial)
+        return freq_counts
+
+    def count_shards(self, shards, n_jobs=1):
+        '''
+        Count several shards of a corpus in parallel and merge the counts.
+
+        :params shards {list} each shard is either a list of documents or a
+            function taking no arguments that returns an iterable of
+            documents, such as a functools.partial that reads one input
+            file. Functions are called in the worker process, so the
+            documents do not have to be sent to it. Both must be picklable.
+
+        :params n_jobs {int} number of processes, -1 for one per CPU
+
+        :returns {Counter} or {CountMinSketch} counts of the whole corpus
+
+        '''
+        if n_jobs == -1:
+            n_jobs = os.cpu_count() or 1
+        if n_jobs == 1:
+            return self.merge_counts(_count_shard((self, shard)) for shard in shards)
+        with multiprocessing.Pool(n_jobs) as pool:
+            return self.merge_counts(pool.imap_unordered(_count_shard,
+                [(self, shard) for shard in shards]))
+
+    def fit(self, docs):
+        '''
+        Add the frequency counts of docs to the stored counts. Can be
+        called again with every new batch of documents, see transform and
+        save_counts.
+
+        :params docs {iterable[list[str]]} documents
+
+        :returns {TokenFilter} self
+
+        '''
+        self._store_counts(self.count(docs))
+        return self
+
+    def transform(self, docs):
+        '''
+        Remove words whose stored frequency count is under the threshold.
+        Unlike frequency, the documents are not counted, so words that
+        were never fit are removed.
+
+        :params docs {iterable[list[str]]} documents
+
+        :returns {list[list[str]]} filtered documents
+
+        '''
+        if self.counts is None:
+            raise ValueError("TokenFilter has no counts, call fit first")
+        rare = RareWords(self.counts, self.threshold)
+        return [[w for w in doc if w not in rare] for doc in docs]
+
+    def save_counts(self, path):
+        '''
+        Save the stored counts, gzip compressed. Exact counts are written
+        as one word and its count per line, approximate ones as the raw
+        sketch.
+
+        :params path {str} file to write
+
+        '''
+        with gzip.open(path, 'wb') as f:
+            if isinstance(self.counts, CountMinSketch):
+                header = {'format': 'sketch', 'width': self.counts.width,
+                        'depth': self.counts.depth, 'total': self.counts.total}
+                f.write(json.dumps(header).encode('utf-8') + b'\n')
+                f.write(self.counts.table.tobytes())
+                return
+            f.write(json.dumps({'format': 'counts'}).encode('utf-8') + b'\n')
+            for w, n in self.counts.most_common():
+                f.write('{}\t{}\n'.format(n, json.dumps(w)).encode('utf-8'))
+
+    def load_counts(self, path):
+        '''
+        Replace the stored counts with counts saved by save_counts.
+
+        :params path {str} file to read
+
+        '''
+        with gzip.open(path, 'rb') as f:
+            header = json.loads(f.readline().decode('utf-8'))
+            if header['format'] == 'sketch':
+                counts = CountMinSketch(header['width'], header['depth'])
+                counts.total = header['total']
+                counts.table = array('Q')
+                counts.table.frombytes(f.read())
+            else:
+                counts = Counter()
+                for line in f:
+                    n, w = line.decode('utf-8').rstrip('\n').split('\t', 1)
+                    counts[json.loads(w)] = int(n)
+        if isinstance(counts, CountMinSketch) != (self.approximate is True):
+            raise ValueError("{} holds {} counts".format(path,
+                header['format']))
+        self.counts = counts
+
+    def _add_history(self, freq_counts):
+        '''
+        With incremental, add freq_counts to the stored counts and use
+        those for the threshold. Otherwise just freq_counts.
+        '''
+        if self.incremental is not True:
+            return freq_counts
+        return self._store_counts(freq_counts)
+
+    def _store_counts(self, freq_counts):
+        if self.counts is None:
+            self.counts = freq_counts
+        else:
+            self.counts.update(freq_counts)
+        return self.counts
+
+    def _new_counts(self):
+        '''
+        :returns {Counter} empty counts, or {CountMinSketch} if approximate
+
+        '''
+        if self.approximate is True:
+            return CountMinSketch.from_memory(self.memory, self.delta)
+        return Counter()
+
+    def _rare_words(self, freq_counts):
+        '''
+        Get the words whose frequency count is under the threshold.
+
+        :params freq_counts {Counter} word -> frequency count, or
+            {CountMinSketch}
+
+        :returns {dict} words to be removed, as keys, or {RareWords} which
+            tests words against the sketch
+
+        '''
+        if isinstance(freq_counts, CountMinSketch):
+            logger.info("Approximate counts are at most %.1f too high "
+                    "with probability %.3f", freq_counts.error_bound(),
+                    1 - freq_counts.delta)
+            return RareWords(freq_counts, self.threshold)
+        remove_list = [w for w in freq_counts if freq_counts[w] < self.threshold]
+        return dict.fromkeys(remove_list, None)
+
+    def _token_op(self):
+        '''
+        Describe the spacy and nltk filters as an operation on single
+        tokens, so that they can be applied once per distinct token, e.g.
+        to the integer IDs of Pipeline(..., ids=True).
+
+        :returns {tuple} ('filter', function list[str] -> list[bool]), True
+            for the tokens to keep
+
+        '''
+        if self.name == 'spacy':
+            vocab = self.nlp.vocab
+            decide = self._spacy_decide
+            return 'filter', lambda words: [decide(vocab[w]) for w in words]
+
+        stop_words = self.stop_words if self.remove_stops is True else ()
+        vocab = self.vocab if self.remove_oov is True else None
+        return 'filter', lambda words: [w not in stop_words and
+                (vocab is None or w in vocab) for w in words]
+
+    # Barrier protocol, used by Pipeline to run frequency filtering over
+    # shards of the corpus in separate processes: every shard is counted
+    # with _barrier_partial, the partial counts are combined once with
+    # _barrier_reduce, and the result is applied to every shard with
+    # _barrier_finish.
+
+    def _barrier_partial(self, docs):
+        '''
+        :params docs {list[list[str]]} one shard of the documents
+
+        :returns {Counter} word -> frequency count within the shard, exact
+            even if approximate, since a shard's Counter is much smaller
+            than a sketch and is folded into one by _barrier_reduce
+
+        '''
+        freq_counts = Counter()
+        for doc in docs:
+            freq_counts.update(doc)
+        return freq_counts
+
+    def _barrier_reduce(self, partials):
+        '''
+        :params partials {iterable[Counter]} counts of every shard, each
+            merged and then dropped as it arrives
+
+        :returns {dict} words to be removed, as keys
+
+        '''
+        return self._rare_words(self._add_history(self.merge_counts(partials)))
+
+    def _barrier_finish(self, docs, remove_list_dict):
+        '''
+        :params docs {list[list[str]]} one shard of the documents
+
+        :params remove_list_dict {dict} result of _barrier_reduce
+
+        :returns {list[list[str]]} filtered shard
+
+        '''
+        return [[w for w in doc if w not in remove_list_dict] for doc in docs]
+
+
+def _count_shard(task):
+    token_filter, shard = task
+    if callable(shard):
+        shard = shard()
+    return token_filter.count(shard)
+
+
+def _filter_shard(task):
+    remove_list_dict, shard = task
+    return [[w for w in doc if w not in remove_list_dict] for doc in shard]
+
+
+class RareWords():
+    '''
+    Words whose count is under a threshold, according to a Counter or a
+    CountMinSketch. Supports the same `w in remove_list_dict` test as the
+    dict of rare words without having to list the vocabulary. Since a
+    sketch never underestimates, words at or above the threshold are never
+    removed; a rarer word may be kept if its estimate is inflated by more
+    than the sketch's error.
+    '''
+
+    def __init__(self, counts, threshold):
+        self.counts = counts
+        self.threshold = threshold
+
+    def __contains__(self, w):
+        return self.counts[w] < self.threshold
+
+
+class WordSet(frozenset):
+    '''
+    A frozenset of words that describes itself to ResultCache's fingerprint
+    by a digest, computed at most once, rather than by its sorted words.
+    '''
+
+    digest = None   # Of the word list file, or of the sorted words
+
+    def _fingerprint(self):
+        if self.digest is None:
+            self.digest = digest('\n'.join(sorted(self)).encode('utf-8'))
+        return '<WordSet {}>'.format(self.digest)
+
+
+def load_word_set(source):
+    '''
+    Get a set of words, building it only the first time it is asked for in
+    this process. Sets are hashed, so membership tests take constant time
+    however large the vocabulary is.
+
+    :param source {str} 'nltk:words' for the nltk words corpus,
+        'nltk:stopwords' for nltk's english stop words, or the path of a
+        UTF-8 file with one word per line
+
+    :returns {WordSet} the words
+
+    '''
+    if source.startswith('nltk:'):
+        key = source
+    else:
+        key = os.path.realpath(source)
+    word_set = _word_sets.get(key)
+    if word_set is not None:
+        return word_set
+
+    if source == 'nltk:words':
+        from nltk.corpus import words
+        word_set = WordSet(words.words())
+    elif source == 'nltk:stopwords':
+        from nltk.corpus import stopwords
+        word_set = WordSet(stopwords.words('english'))
+    else:
+        with open(source, 'rb') as f:
+            data = f.read()
+        word_set = WordSet(line.strip() for line in
+                data.decode('utf-8').splitlines() if line.strip())
+        word_set.digest = digest(data)
+    logger.debug("Loaded %d words from %s", len(word_set), source)
+
+    _word_sets[key] = word_set
+    return word_set
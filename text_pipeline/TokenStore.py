@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Columnar on-disk format for tokenized documents, readable through mmap.
+
+@author: John Sigmon
+"""
+
+import os
+import sys
+import mmap
+import struct
+import logging.config
+from array import array
+from .Vocabulary import Vocabulary, TYPECODE
+
+logger = logging.getLogger(__name__)
+
+# File layout, every section aligned to 8 bytes:
+#   header      HEADER, then zero padding up to DATA_START
+#   ids         token IDs of every document, one after the other (TYPECODE)
+#   offsets     n_docs + 1 positions into ids where each document starts,
+#               the last one being the total number of tokens ('Q')
+#   vocab       vocab_size + 1 byte positions into the strings ('Q')
+#   strings     UTF-8 vocabulary strings, one after the other
+MAGIC = b'TPTS'
+VERSION = 1
+HEADER = struct.Struct('<4sHc1sQQQQQQ')
+DATA_START = 64
+
+
+class TokenStore():
+    '''
+    Read only view of a token store written by TokenStoreWriter. The file
+    is memory mapped rather than read, so opening it is instant whatever
+    its size, documents are decoded only when accessed and the pages are
+    shared between processes reading the same file.
+    '''
+
+    def __init__(self, path):
+        '''
+        :param path {str} token store file
+
+        :raises ValueError if the file is not a complete token store
+
+        '''
+        self.path = path
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size < DATA_START:
+                raise ValueError("{} is not a token store".format(path))
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, typecode, byteorder, self.n_docs, n_tokens,
+                offsets_pos, vocab_size, vocab_pos, strings_pos) = \
+                HEADER.unpack_from(self.mm, 0)
+        if magic == bytes(len(MAGIC)):
+            self.mm.close()
+            raise ValueError("{} was not closed by its writer".format(path))
+        if magic != MAGIC or version != VERSION:
+            self.mm.close()
+            raise ValueError("{} is not a token store".format(path))
+        if byteorder.decode() != sys.byteorder[0]:
+            self.mm.close()
+            raise ValueError("{} was written on a {} endian machine".format(
+                path, 'big' if byteorder == b'b' else 'little'))
+
+        typecode = typecode.decode()
+        itemsize = array(typecode).itemsize
+        view = memoryview(self.mm)
+        # Casts of the mapped file, nothing is copied
+        self.token_ids = view[DATA_START:DATA_START + n_tokens * itemsize].cast(
+                typecode)
+        self.offsets = view[offsets_pos:offsets_pos + (self.n_docs + 1) * 8
+                ].cast('Q')
+        self.vocab_offsets = view[vocab_pos:vocab_pos + (vocab_size + 1) * 8
+                ].cast('Q')
+        self.strings = view[strings_pos:strings_pos + self.vocab_offsets[-1]]
+        self._decoded = [None] * vocab_size
+
+    def __repr__(self):
+        return '<TokenStore {} ({} documents)>'.format(self.path, self.n_docs)
+
+    def __len__(self):
+        return self.n_docs
+
+    def __getitem__(self, n):
+        '''
+        :param n {int} document number
+
+        :returns {list[str]} tokens of the document
+
+        '''
+        string = self.string
+        return [string(i) for i in self.ids(n)]
+
+    def __iter__(self):
+        for n in range(self.n_docs):
+            yield self[n]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def ids(self, n):
+        '''
+        :param n {int} document number
+
+        :returns {memoryview} token IDs of the document, a view of the
+            mapped file
+
+        '''
+        if n < 0:
+            n += self.n_docs
+        if not 0 <= n < self.n_docs:
+            raise IndexError("Document {} out of range".format(n))
+        return self.token_ids[self.offsets[n]:self.offsets[n + 1]]
+
+    def string(self, i):
+        '''
+        :param i {int} token ID
+
+        :returns {str} the token
+        '''
+        s = self._decoded[i]
+        if s is None:
+            start, end = self.vocab_offsets[i], self.vocab_offsets[i + 1]
+            s = self._decoded[i] = str(self.strings[start:end], 'utf-8')
+        return s
+
+    def vocabulary(self):
+        '''
+        :returns {Vocabulary} every string of the store, with its ID
+        '''
+        return Vocabulary(self.string(i) for i in range(len(self._decoded)))
+
+    def close(self):
+        '''
+        Unmap the file. Views returned by ids keep the map alive, in which
+        case it is unmapped once the last of them is gone.
+        '''
+        # Views must be released before the map can be closed
+        for view in (self.token_ids, self.offsets, self.vocab_offsets,
+                self.strings):
+            view.release()
+        mm, self.mm = self.mm, None
+        if mm is None:
+            return
+        try:
+            mm.close()
+        except BufferError:
+            logger.debug("%s still has views of ids, unmapped when they are "
+                    "gone", self.path)
+
+
+class TokenStoreWriter():
+    '''
+    Writes documents to a token store one at a time, so the output of
+    Pipeline.stream can be stored without holding the corpus in memory.
+    Token IDs go to disk as they are added; the document offsets and the
+    vocabulary are kept in memory and appended by close.
+    '''
+
+    def __init__(self, path):
+        '''
+        :param path {str} file to write
+
+        '''
+        self.path = path
+        self.vocab = Vocabulary()
+        self.offsets = array('Q', [0])
+        self.f = open(path, 'wb')
+        # Placeholder header, an unclosed store can not be opened
+        self.f.write(bytes(DATA_START))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is None:
+            self.close()
+        else:
+            # Leave the header unwritten, so that partial output is not
+            # mistaken for a complete store
+            self.f.close()
+
+    def add(self, doc):
+        '''
+        :param doc {list[str]} tokens
+
+        '''
+        ids = self.vocab.encode(doc)
+        self.f.write(ids.tobytes())
+        self.offsets.append(self.offsets[-1] + len(ids))
+
+    def extend(self, docs):
+        for doc in docs:
+            self.add(doc)
+
+    def close(self):
+        if self.f.closed:
+            return
+        f = self.f
+        _pad(f)
+        offsets_pos = f.tell()
+        f.write(self.offsets.tobytes())
+
+        vocab_pos = f.tell()
+        strings = [s.encode('utf-8') for s in self.vocab.strings]
+        vocab_offsets = array('Q', [0])
+        for s in strings:
+            vocab_offsets.append(vocab_offsets[-1] + len(s))
+        f.write(vocab_offsets.tobytes())
+        strings_pos = f.tell()
+        f.write(b''.join(strings))
+
+        f.seek(0)
+        f.write(HEADER.pack(MAGIC, VERSION, TYPECODE.encode(),
+                sys.byteorder[0].encode(), len(self.offsets) - 1,
+                self.offsets[-1], offsets_pos, len(strings), vocab_pos,
+                strings_pos))
+        f.close()
+        logger.info("Wrote %d documents to %s", len(self.offsets) - 1,
+                self.path)
+
+
+def write_store(path, docs):
+    '''
+    Write documents to a token store.
+
+    :param path {str} file to write
+
+    :param docs {iterable[list[str]]} documents, e.g. Pipeline.stream output
+
+    :returns {int} number of documents written
+
+    '''
+    with TokenStoreWriter(path) as writer:
+        writer.extend(docs)
+        return len(writer.offsets) - 1
+
+
+def _pad(f):
+    f.write(bytes(-f.tell() % 8))
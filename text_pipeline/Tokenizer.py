@@ -10,24 +10,58 @@ Last modified: 6/26/18
 """
 
 import os
+import re
 import sys
 import json
 import pickle as pkl
-import spacy
-import en_core_web_sm
 import logging.config
-from nltk.tokenize import word_tokenize
-from spacy.attrs import ORTH, LEMMA
-from tqdm import tqdm
+from .ModelRegistry import ModelRegistry
 
 logger = logging.getLogger()
 ROOT_PATH = os.path.dirname(os.path.realpath(__file__))
 
+# Pieces of the regex backend's pattern. Like nltk's word_tokenize, it
+# splits off most punctuation, clitics such as n't and 's, a colon or comma
+# unless a digit follows, and a period unless a word character follows,
+# and keeps hyphens, slashes and inner periods within words.
+_REGEX_URL = r"(?:https?://|www\.)[^\s<>\"]+?(?=[.,;:!?)\]]*(?:\s|$))"
+_REGEX_EMAIL = r"[\w.+-]+@[\w-]+(?:\.[\w-]+)+"
+_REGEX_NUM = r"[$\u20ac\u00a3]?\d+(?:[.,:]\d+)*%?"
+_REGEX_BASE = r"""
+      \w+(?=n't\b)                    # do|n't
+    | n't\b
+    | '(?:s|re|ve|ll|d|m)\b            # clitics
+    | \.{2,} | --
+    | [;@\#$%&?!\[\](){}<>*"]
+    | [:,](?!\d)
+    | (?:[^\s;@\#$%&?!\[\](){}<>*",:.'-]    # word
+        | [,:](?=\d)
+        | \.(?=[^\s\])}>"'.])
+        | '(?!(?:s|re|ve|ll|d|m)\b)
+        | -(?!-)
+      )+
+    | [.'-]
+"""
+
+# Compiled patterns, one per combination of rules
+_regex_patterns = {}
+
 class Tokenizer():
     
     apply = None
+    stream = None
     dispatch_fun = None
+    stream_fun = None
+    barrier = False
+    spacy_role = 'tokenize'     # Role when fused with other spacy steps
     to_lower = True
+    model = 'en_core_web_sm'    # spacy model package
+    disable = None              # spacy pipeline components not to load
+    batch_size = 1000           # Documents per spacy batch
+    n_process = 1               # spacy worker processes, -1 for all CPUs
+    keep_urls = False           # regex: keep urls as one token
+    keep_emails = False         # regex: keep emails as one token
+    keep_nums = False           # regex: keep numbers, e.g. $1,000.50, whole
 
     def __init__(self, name, **params):
         '''
@@ -41,16 +75,26 @@ class Tokenizer():
         self.dispatch_fun = {
                 'spacy' : self.spacy,
                 'nltk' : self.nltk,
+                'regex' : self.regex,
                 }
+        self.stream_fun = {
+                'spacy' : self._spacy_stream,
+                'nltk' : self._nltk_stream,
+                'regex' : self._regex_stream,
+                }
+        self.name = name
         if name: 
             self.apply = self.dispatch_fun[name]
+            self.stream = self.stream_fun[name]
         for key in params:
             setattr(self, key, params[key])
-        
-        # Setup big files for vocab etc
-        if name == 'spacy':
-            import en_core_web_sm
-            self.nlp = en_core_web_sm.load()
+
+    @property
+    def nlp(self):
+        '''
+        The spacy model, loaded on first use and shared between steps.
+        '''
+        return ModelRegistry.load(self.model, self.disable)
 
     def spacy(self, docs):
         '''
@@ -64,17 +108,49 @@ class Tokenizer():
         : returns {list[list[str]]} tokenized documents
 
         '''
-        
-        # Tokenize
-        tkns = []
-        for doc in tqdm(docs):
-            if self.to_lower is True:
-                doc = doc.lower()
-            doc = self.nlp.tokenizer(doc)
-            tkns.append([t.text for t in doc])
-            del doc
+        return list(self._spacy_stream(docs))
+
+    def _spacy_stream(self, docs):
+        '''
+        Generator version of spacy, yields one tokenized document at a time.
+
+        : params {iterable[str]} documents to be tokenized
+
+        : returns {generator[list[str]]} tokenized documents
+
+        '''
+        for doc in self._spacy_docs(docs):
+            yield [t.text for t in doc]
+
+    def _spacy_docs(self, docs, special_cases=()):
+        '''
+        Tokenize documents into spacy Docs, batch_size documents at a time.
+        With n_process other than 1 the batches are handed to spacy's own
+        multiprocessing. Used directly by fused spacy stages, which keep
+        working on the Doc's tokens.
+
+        : params {iterable[str]} documents to be tokenized
+
+        : params special_cases {list[tuple(str, list[dict])]} special cases
+            of the TokenFilters after this Tokenizer, see
+            ModelRegistry.tokenizer. The tokenizer that has them runs in
+            this process whatever n_process is.
 
-        return tkns 
+        : returns {generator[spacy.tokens.Doc]} tokenized documents
+
+        '''
+        if self.to_lower is True:
+            docs = (doc.lower() for doc in docs)
+
+        nlp = self.nlp
+        if special_cases:
+            return ModelRegistry.tokenizer(self.model, self.disable,
+                    special_cases).pipe(docs, batch_size=self.batch_size)
+        if self.n_process == 1:
+            return nlp.tokenizer.pipe(docs, batch_size=self.batch_size)
+        # Only the tokenizer is wanted, so disable every component
+        return nlp.pipe(docs, batch_size=self.batch_size,
+                n_process=self.n_process, disable=nlp.pipe_names)
 
     def nltk(self, docs):
         '''
@@ -85,13 +161,66 @@ class Tokenizer():
 
         '''
         
-        # Tokenize
-        tkns = []
-        for doc in tqdm(docs):
+        return list(self._nltk_stream(docs))
+
+    def _nltk_stream(self, docs):
+        '''
+        Generator version of nltk, yields one tokenized document at a time.
+
+        :param docs {iterable[str]}
+
+        :returns {generator[list[str]]} tokenized docs
+
+        '''
+        from nltk.tokenize import word_tokenize
+
+        for doc in docs:
             if self.to_lower is True:
                 doc = doc.lower()
-            doc = word_tokenize(doc)
-            tkns.append(doc)
-            del doc
+            yield word_tokenize(doc)
+
+    def regex(self, docs):
+        '''
+        Tokenize with a single precompiled regular expression that follows
+        nltk's word_tokenize conventions, without a model or sentence
+        splitting.
 
-        return tkns        
+        :param docs {list[str]}
+
+        :returns {list[list[str]]} tokenized docs
+
+        '''
+        return list(self._regex_stream(docs))
+
+    def _regex_stream(self, docs):
+        '''
+        Generator version of regex, yields one tokenized document at a time.
+
+        :param docs {iterable[str]}
+
+        :returns {generator[list[str]]} tokenized docs
+
+        '''
+        findall = _regex_pattern(self.keep_urls is True,
+                self.keep_emails is True, self.keep_nums is True).findall
+        if self.to_lower is True:
+            for doc in docs:
+                yield findall(doc.lower())
+        else:
+            for doc in docs:
+                yield findall(doc)
+
+
+def _regex_pattern(urls, emails, nums):
+    '''
+    :returns {re.Pattern} the regex backend's pattern, with the optional
+        rules tried before the others
+    '''
+    key = (urls, emails, nums)
+    pattern = _regex_patterns.get(key)
+    if pattern is None:
+        rules = [rule for rule, on in zip(
+            (_REGEX_URL, _REGEX_EMAIL, _REGEX_NUM), key) if on]
+        pattern = _regex_patterns[key] = re.compile(
+                '|'.join(rules + [_REGEX_BASE]), re.VERBOSE | re.IGNORECASE)
+    return pattern
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Shared string to integer ID mapping for the interned token representation.
+
+@author: John Sigmon
+"""
+
+import logging.config
+from array import array
+
+logger = logging.getLogger(__name__)
+
+# Unsigned 32 bit IDs, enough for any realistic vocabulary
+TYPECODE = 'I'
+
+class Vocabulary():
+    '''
+    Interns tokens as integer IDs. Documents become compact arrays of IDs,
+    so each distinct string is only stored once however often it occurs.
+    IDs are handed out in order of first appearance, starting at 0.
+    '''
+
+    def __init__(self, strings=None):
+        '''
+        :param strings {iterable[str]} optional initial strings, which get
+            the IDs 0, 1, 2, ... in order
+
+        '''
+        self.strings = []
+        self.ids = {}
+        if strings is not None:
+            for s in strings:
+                self.add(s)
+
+    def __len__(self):
+        return len(self.strings)
+
+    def __contains__(self, s):
+        return s in self.ids
+
+    def __getitem__(self, i):
+        return self.strings[i]
+
+    def add(self, s):
+        '''
+        :param s {str} token
+
+        :returns {int} ID of the token, added if it is new
+
+        '''
+        i = self.ids.get(s)
+        if i is None:
+            i = self.ids[s] = len(self.strings)
+            self.strings.append(s)
+        return i
+
+    def encode(self, doc):
+        '''
+        :param doc {list[str]} tokens
+
+        :returns {array} IDs of the tokens
+
+        '''
+        ids = self.ids
+        strings = self.strings
+        encoded = array(TYPECODE)
+        for s in doc:
+            i = ids.get(s)
+            if i is None:
+                i = ids[s] = len(strings)
+                strings.append(s)
+            encoded.append(i)
+        return encoded
+
+    def decode(self, doc):
+        '''
+        :param doc {array} or {list[int]} IDs
+
+        :returns {list[str]} tokens
+
+        '''
+        strings = self.strings
+        return [strings[i] for i in doc]
@@ -4,3 +4,10 @@ from .Pipeline import Pipeline
 from .TokenFilter import TokenFilter
 from .Stemmer import Stemmer
 from .Tokenizer import Tokenizer
+from .Normalizer import Normalizer
+from .ModelRegistry import ModelRegistry
+from .Vocabulary import Vocabulary
+from .ResultCache import ResultCache
+from .TokenStore import TokenStore, TokenStoreWriter, write_store
+from .Corpus import Corpus, CorpusWriter, write_corpus
+from .Metrics import Hook, LogSink, JsonSink, PrometheusSink, TqdmSink
@@ -0,0 +1,300 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of every backend and of full pipelines on synthetic corpora.
+
+    python -m text_pipeline.benchmark run -o results.json
+    python -m text_pipeline.benchmark compare baseline.json results.json
+
+@author: John Sigmon
+"""
+
+import sys
+import json
+import math
+import time
+import random
+import fnmatch
+import argparse
+import platform
+import tracemalloc
+import logging.config
+from .Pipeline import Pipeline
+from .Tokenizer import Tokenizer
+from .TokenFilter import TokenFilter
+from .Stemmer import Stemmer
+from .Normalizer import Normalizer
+
+logger = logging.getLogger(__name__)
+
+# The most frequent words of the synthetic vocabulary, so that stop word
+# removal has its usual effect
+STOP_WORDS = ['the', 'of', 'and', 'to', 'a', 'in', 'is', 'that', 'for', 'it',
+        'was', 'on', 'with', 'as', 'be', 'at', 'by', 'this', 'have', 'from']
+SYLLABLES = ['ba', 'ko', 'ri', 'tu', 'me', 'sa', 'lo', 'ne', 'di', 'pa', 'ge',
+        'fu', 'mi', 'ra', 'to', 've']
+SUFFIXES = ['', '', '', 's', 'ing', 'ed', 'ly', 'er']
+
+
+def synthetic_corpus(n_docs, mean_length=100, sigma=0.6, vocab_size=20000,
+        seed=0):
+    '''
+    Make a reproducible corpus whose words follow Zipf's law, like natural
+    text, with some numbers, punctuation, urls and emails mixed in so that
+    every filter has work to do.
+
+    :param n_docs {int} number of documents
+
+    :param mean_length {int} mean words per document
+
+    :param sigma {float} spread of the log-normal document lengths
+
+    :param vocab_size {int} number of distinct words
+
+    :param seed {int} random seed, the same seed gives the same corpus
+
+    :returns {list[str]} documents
+
+    '''
+    rng = random.Random(seed)
+    vocab = list(STOP_WORDS)
+    while len(vocab) < vocab_size:
+        word = ''.join(rng.choice(SYLLABLES)
+                for _ in range(rng.randint(1, 4))) + rng.choice(SUFFIXES)
+        vocab.append(word)
+    vocab[100::97] = [str(i) for i in range(len(vocab[100::97]))]
+    vocab[150::211] = ['{}@example.com'.format(w) for w in vocab[150::211]]
+    vocab[175::307] = ['https://www.{}.org'.format(w) for w in vocab[175::307]]
+    weights = [1.0 / rank for rank in range(1, len(vocab) + 1)]
+    cum_weights = []
+    total = 0.0
+    for w in weights:
+        total += w
+        cum_weights.append(total)
+
+    # Log-normal lengths with the requested mean
+    mu = math.log(mean_length) - sigma ** 2 / 2
+    docs = []
+    for _ in range(n_docs):
+        length = max(1, int(rng.lognormvariate(mu, sigma)))
+        words = rng.choices(vocab, cum_weights=cum_weights, k=length)
+        for i in range(12, length, 13):
+            words[i] += rng.choice('.,;!?')
+        words[0] = words[0].capitalize()
+        docs.append(' '.join(words))
+    return docs
+
+
+def _split(docs):
+    return [doc.split() for doc in docs]
+
+
+# Benchmark cases: (pipeline factory, whether its input is tokenized)
+CASES = {
+        'Normalizer.unicode': (lambda: Pipeline(Normalizer('unicode')), False),
+        'Normalizer.unicode.strip_accents': (lambda: Pipeline(
+            Normalizer('unicode', strip_accents=True)), False),
+        'Tokenizer.spacy': (lambda: Pipeline(Tokenizer('spacy')), False),
+        'Tokenizer.nltk': (lambda: Pipeline(Tokenizer('nltk')), False),
+        'Tokenizer.regex': (lambda: Pipeline(Tokenizer('regex')), False),
+        'TokenFilter.spacy': (lambda: Pipeline(TokenFilter('spacy')), True),
+        'TokenFilter.nltk': (lambda: Pipeline(TokenFilter('nltk')), True),
+        'TokenFilter.frequency': (lambda: Pipeline(
+            TokenFilter('frequency', threshold=5)), True),
+        'TokenFilter.frequency.approximate': (lambda: Pipeline(
+            TokenFilter('frequency', threshold=5, approximate=True)), True),
+        'Stemmer.spacy': (lambda: Pipeline(Stemmer('spacy')), True),
+        'Stemmer.spacy.lookup': (lambda: Pipeline(
+            Stemmer('spacy', lookup=True)), True),
+        'Stemmer.nltk.snowball': (lambda: Pipeline(
+            Stemmer('nltk', stemmer='snowball')), True),
+        'Stemmer.nltk.porter': (lambda: Pipeline(
+            Stemmer('nltk', stemmer='porter')), True),
+        'Stemmer.nltk.wordnet': (lambda: Pipeline(
+            Stemmer('nltk', lemmatizer='wordnet')), True),
+        'pipeline.spacy': (lambda: Pipeline(Tokenizer('spacy'),
+            TokenFilter('spacy'), Stemmer('spacy')), False),
+        'pipeline.nltk': (lambda: Pipeline(Tokenizer('nltk'),
+            TokenFilter('nltk'), Stemmer('nltk', stemmer='snowball'),
+            TokenFilter('frequency', threshold=5)), False),
+        'pipeline.nltk.ids': (lambda: Pipeline(Tokenizer('nltk'),
+            TokenFilter('nltk'), Stemmer('nltk', stemmer='snowball'),
+            TokenFilter('frequency', threshold=5), ids=True), False),
+        'pipeline.regex': (lambda: Pipeline(Tokenizer('regex'),
+            TokenFilter('nltk'), Stemmer('nltk', stemmer='snowball'),
+            TokenFilter('frequency', threshold=5)), False),
+        }
+
+
+def run_case(name, docs, repeat=3, memory=True):
+    '''
+    Benchmark one case. A pipeline is built and warmed up on a few
+    documents first, so model loading is not timed. Every run after that
+    gets a freshly built pipeline, so the memo tables a run builds up
+    (Stemmer caches, fused TokenStage and IdStage tables) start cold and
+    the numbers are those of a first pass over the corpus.
+
+    :param name {str} key of CASES
+
+    :param docs {list[str]} corpus
+
+    :param repeat {int} timed runs, the fastest counts
+
+    :param memory {bool} also make a run under tracemalloc for the peak
+        memory allocated by Python
+
+    :returns {dict} seconds, docs_per_s, tokens_per_s and peak_memory in
+        bytes, or error if the backend is not available
+
+    '''
+    factory, tokenized = CASES[name]
+    inputs = _split(docs) if tokenized else docs
+    tokens = sum(len(doc.split()) for doc in docs)
+    try:
+        factory().apply(inputs[:10])
+    except (ImportError, OSError, LookupError) as e:
+        logger.warning("Skipping %s: %s", name, e)
+        return {'error': '{}: {}'.format(type(e).__name__, e)}
+
+    seconds = min(_time(factory(), inputs) for _ in range(repeat))
+    result = {
+            'seconds': seconds,
+            'docs_per_s': len(docs) / seconds,
+            'tokens_per_s': tokens / seconds,
+            }
+    if memory:
+        pipeline = factory()
+        tracemalloc.start()
+        try:
+            pipeline.apply(inputs)
+            result['peak_memory'] = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return result
+
+
+def _time(pipeline, inputs):
+    start = time.perf_counter()
+    pipeline.apply(inputs)
+    return time.perf_counter() - start
+
+
+def run(n_docs=10000, mean_length=100, sigma=0.6, vocab_size=20000, seed=0,
+        cases='*', repeat=3, memory=True):
+    '''
+    Benchmark every case whose name matches the glob pattern cases.
+
+    :returns {dict} meta, describing the machine and corpus, and results,
+        one entry per case, see run_case
+
+    '''
+    docs = synthetic_corpus(n_docs, mean_length, sigma, vocab_size, seed)
+    meta = {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'docs': n_docs,
+            'mean_length': mean_length,
+            'sigma': sigma,
+            'vocab_size': vocab_size,
+            'seed': seed,
+            'repeat': repeat,
+            }
+    results = {}
+    for name in CASES:
+        if fnmatch.fnmatch(name, cases):
+            logger.info("Running %s", name)
+            results[name] = run_case(name, docs, repeat, memory)
+    return {'meta': meta, 'results': results}
+
+
+def compare(baseline, current, tolerance=0.1):
+    '''
+    Find regressions: cases whose throughput dropped, or whose peak memory
+    grew, by more than tolerance relative to the baseline.
+
+    :param baseline {dict} output of run
+
+    :param current {dict} output of run
+
+    :param tolerance {float} allowed relative change
+
+    :returns {list[tuple(str, str, float, float)]} (case, metric, baseline
+        value, current value) for every regression
+
+    '''
+    regressions = []
+    for name, base in baseline['results'].items():
+        result = current['results'].get(name)
+        if result is None or 'error' in base or 'error' in result:
+            continue
+        for metric in ('docs_per_s', 'tokens_per_s'):
+            if result[metric] < base[metric] * (1 - tolerance):
+                regressions.append((name, metric, base[metric], result[metric]))
+        if 'peak_memory' in base and 'peak_memory' in result:
+            if result['peak_memory'] > base['peak_memory'] * (1 + tolerance):
+                regressions.append((name, 'peak_memory', base['peak_memory'],
+                    result['peak_memory']))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='python -m text_pipeline.benchmark')
+    commands = parser.add_subparsers(dest='command')
+
+    run_parser = commands.add_parser('run', help="run the benchmarks")
+    run_parser.add_argument('-o', '--output', help="JSON file for the results")
+    run_parser.add_argument('--docs', type=int, default=10000)
+    run_parser.add_argument('--mean-length', type=int, default=100)
+    run_parser.add_argument('--sigma', type=float, default=0.6)
+    run_parser.add_argument('--vocab-size', type=int, default=20000)
+    run_parser.add_argument('--seed', type=int, default=0)
+    run_parser.add_argument('--cases', default='*',
+            help="glob pattern of the cases to run, e.g. 'Stemmer.*'")
+    run_parser.add_argument('--repeat', type=int, default=3)
+    run_parser.add_argument('--no-memory', action='store_true',
+            help="skip the peak memory runs")
+
+    compare_parser = commands.add_parser('compare',
+            help="flag regressions against a baseline")
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('current')
+    compare_parser.add_argument('--tolerance', type=float, default=0.1)
+
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+
+    if args.command == 'run':
+        results = run(args.docs, args.mean_length, args.sigma,
+                args.vocab_size, args.seed, args.cases, args.repeat,
+                not args.no_memory)
+        for name, result in results['results'].items():
+            if 'error' in result:
+                print("{:36} {}".format(name, result['error']))
+            else:
+                print("{:36} {:10.1f} docs/s {:12.1f} tokens/s".format(
+                    name, result['docs_per_s'], result['tokens_per_s']))
+        if args.output:
+            with open(args.output, 'w') as f:
+                json.dump(results, f, indent=2)
+        return 0
+
+    if args.command == 'compare':
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        with open(args.current) as f:
+            current = json.load(f)
+        regressions = compare(baseline, current, args.tolerance)
+        for name, metric, base, value in regressions:
+            print("REGRESSION {} {}: {:.1f} -> {:.1f} ({:+.1%})".format(
+                name, metric, base, value, value / base - 1))
+        if not regressions:
+            print("No regressions")
+        return 1 if regressions else 0
+
+    parser.print_help()
+    return 2
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,374 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+text-pipeline command: runs a pipeline described by a config file over
+many input files.
+
+@author: John Sigmon
+"""
+
+import os
+import sys
+import json
+import time
+import tempfile
+import pickle as pkl
+import argparse
+import logging.config
+import multiprocessing
+from .Pipeline import Pipeline
+from .Tokenizer import Tokenizer
+from .TokenFilter import TokenFilter
+from .Stemmer import Stemmer
+from .Normalizer import Normalizer
+from .Corpus import Corpus, CorpusWriter, COMPRESSION, JSONL_EXTENSIONS
+from .TokenStore import TokenStoreWriter
+
+logger = logging.getLogger(__name__)
+
+# Step types a config may use
+STEPS = {
+        'Normalizer': Normalizer,
+        'Tokenizer': Tokenizer,
+        'TokenFilter': TokenFilter,
+        'Stemmer': Stemmer,
+        }
+
+# Output extension of each output format
+EXTENSIONS = {'jsonl': '.jsonl', 'text': '.txt', 'store': '.tps'}
+
+
+def load_config(path):
+    '''
+    Read a pipeline config, JSON or, with PyYAML installed, YAML.
+
+    :param path {str} config file
+
+    :returns {dict} config
+
+    '''
+    with open(path) as f:
+        if path.endswith(('.yml', '.yaml')):
+            try:
+                import yaml
+            except ImportError:
+                raise ImportError("Reading YAML configs needs PyYAML, "
+                        "pip install pyyaml")
+            return yaml.safe_load(f)
+        return json.load(f)
+
+
+def build_pipeline(config):
+    '''
+    Make the Pipeline a config describes. Every entry of steps names the
+    step's type and backend; its other keys are the step's params.
+
+        {"steps": [{"type": "Tokenizer", "name": "spacy"},
+                   {"type": "TokenFilter", "name": "spacy",
+                    "remove_stops": true}],
+         "ids": false}
+
+    :param config {dict} config
+
+    :returns {Pipeline}
+
+    '''
+    steps = []
+    for step in config['steps']:
+        params = dict(step)
+        kind = params.pop('type')
+        if kind not in STEPS:
+            raise ValueError("Unknown step type {}, expected one of {}".format(
+                kind, ', '.join(STEPS)))
+        name = params.pop('name')
+        steps.append(STEPS[kind](name, **params))
+    return Pipeline(*steps, ids=config.get('ids', False))
+
+
+def shards(inputs, out_dir, output_format, compress=None):
+    '''
+    Pair every input file with its output file. Files inside an input
+    directory keep their path relative to it.
+
+    :raises ValueError if two inputs would be written to the same output,
+        e.g. x/day.txt and y/day.jsonl
+
+    :returns {list[tuple(str, str)]} (input, output) paths
+
+    '''
+    extension = EXTENSIONS[output_format]
+    if compress and output_format != 'store':
+        extension += '.' + compress
+    pairs = []
+    for path in inputs:
+        if os.path.isdir(path):
+            files = [(f, os.path.relpath(f, path))
+                    for f in Corpus(path).files()]
+        else:
+            files = [(path, os.path.basename(path))]
+        for f, name in files:
+            pairs.append((f, os.path.join(out_dir, _stem(name) + extension)))
+
+    written = {}
+    for f, out_path in pairs:
+        if out_path in written:
+            raise ValueError("{} and {} would both be written to {}".format(
+                written[out_path], f, out_path))
+        written[out_path] = f
+    return pairs
+
+
+def _stem(name):
+    root, ext = os.path.splitext(name)
+    if ext in COMPRESSION:
+        root, ext = os.path.splitext(root)
+    if ext in JSONL_EXTENSIONS or ext == '.txt':
+        return root
+    return root + ext
+
+
+class _Finished():
+    '''
+    A barrier step whose result over every input file is known, applied
+    to one document at a time, see _reduce_barrier.
+    '''
+
+    barrier = False
+
+    def __init__(self, step, state):
+        self.step = step
+        self.state = state
+
+    def apply(self, docs):
+        return self.step._barrier_finish(docs, self.state)
+
+    def stream(self, docs):
+        for doc in docs:
+            yield from self.step._barrier_finish([doc], self.state)
+
+
+def _finish_barriers(steps, ids, tasks, field, workers, spool_dir):
+    '''
+    Replace every barrier step with the result of a pass over every input
+    file, so that e.g. frequency thresholds count the whole corpus rather
+    than one file. The output of the steps before a barrier is spooled to
+    files in spool_dir while it is counted, so that later passes read it
+    back rather than running those steps again.
+
+    :returns {tuple} ({list} steps left to run, without barriers,
+        {dict} input path -> spool file holding its output so far)
+
+    '''
+    steps = list(steps)
+    start = 0
+    spools = {}
+    for i, step in enumerate(steps):
+        if not getattr(step, 'barrier', False):
+            continue
+        if not hasattr(step, '_barrier_partial'):
+            raise ValueError("Step {} needs the whole corpus and cannot be "
+                    "run over separate files".format(step))
+        logger.info("Counting %d files for %s", len(tasks), step)
+        # Nothing to spool if no step runs before the barrier
+        spool = spool_dir if i > start else None
+        state, new_spools = _reduce_barrier(steps[start:i], ids, step,
+            [path for path, _ in tasks], field, workers, spools, spool)
+        steps[i] = _Finished(step, state)
+        if spool is not None:
+            for path in spools.values():
+                os.remove(path)
+            spools = new_spools
+            start = i
+    return steps[start:], spools
+
+
+def _reduce_barrier(steps, ids, barrier, paths, field, workers, spools,
+        spool_dir):
+    '''
+    Stream every file through steps and reduce barrier's partial results
+    of the files, see the barrier protocol in TokenFilter.
+
+    :returns {tuple} (result of barrier._barrier_reduce,
+        {dict} input path -> spool file of the output of steps)
+
+    '''
+    new_spools = {}
+
+    def partials(results):
+        for path, partial, spool in results:
+            if spool is not None:
+                new_spools[path] = spool
+            yield partial
+
+    initargs = (steps, ids, field, spools, barrier, spool_dir)
+    if workers == 1:
+        _init_worker(*initargs)
+        return barrier._barrier_reduce(partials(map(_count_file,
+            paths))), new_spools
+    with multiprocessing.Pool(workers, initializer=_init_worker,
+            initargs=initargs) as pool:
+        return barrier._barrier_reduce(partials(pool.imap_unordered(
+            _count_file, paths))), new_spools
+
+
+# Built once per worker process by _init_worker
+_pipeline = None
+_field = None
+_spools = None
+_barrier = None
+_spool_dir = None
+
+
+def _init_worker(steps, ids, field, spools, barrier=None, spool_dir=None):
+    global _pipeline, _field, _spools, _barrier, _spool_dir
+    _pipeline = Pipeline(*steps, ids=ids)
+    _field = field
+    _spools = spools
+    _barrier = barrier
+    _spool_dir = spool_dir
+
+
+def _read(path):
+    '''
+    :returns {iterable} documents of an input file, or the output of the
+        steps before the last barrier if spooled
+    '''
+    spool = _spools.get(path)
+    if spool is None:
+        return Corpus(path, field=_field)
+    return _read_spool(spool)
+
+
+def _read_spool(spool):
+    with open(spool, 'rb') as f:
+        while True:
+            try:
+                yield pkl.load(f)
+            except EOFError:
+                return
+
+
+def _spooled(docs, f):
+    for doc in docs:
+        pkl.dump(doc, f, pkl.HIGHEST_PROTOCOL)
+        yield doc
+
+
+def _count_file(path):
+    '''
+    :returns {tuple} (input path, partial result of _barrier for the file,
+        spool file of the documents counted or None)
+    '''
+    docs = _pipeline.stream(_read(path))
+    if _spool_dir is None:
+        return path, _barrier._barrier_partial(docs), None
+    fd, spool = tempfile.mkstemp(suffix='.spool', dir=_spool_dir)
+    with os.fdopen(fd, 'wb') as f:
+        return path, _barrier._barrier_partial(_spooled(docs, f)), spool
+
+
+def _run_shard(task):
+    '''
+    Stream one input file through the pipeline into its output file.
+
+    :returns {tuple} (input path, documents, tokens, seconds)
+
+    '''
+    path, out_path = task
+    start = time.time()
+    os.makedirs(os.path.dirname(out_path) or '.', exist_ok=True)
+    if out_path.endswith(EXTENSIONS['store']):
+        writer = TokenStoreWriter(out_path)
+    else:
+        writer = CorpusWriter(out_path)
+    docs = tokens = 0
+    with writer:
+        for doc in _pipeline.stream(_read(path)):
+            writer.add(doc)
+            docs += 1
+            tokens += len(doc)
+    return path, docs, tokens, time.time() - start
+
+
+def _collect(results):
+    docs = tokens = 0
+    for path, n_docs, n_tokens, seconds in results:
+        docs += n_docs
+        tokens += n_tokens
+        logger.info("%s: %d documents in %.1fs", path, n_docs, seconds)
+    return docs, tokens
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='text-pipeline',
+            description="Run a text pipeline over corpus files, writing one "
+            "output file per input file.")
+    parser.add_argument('config', help="JSON or YAML pipeline config")
+    parser.add_argument('inputs', nargs='+',
+            help="input files or directories, see Corpus")
+    parser.add_argument('-o', '--out-dir', required=True,
+            help="directory for the output files")
+    parser.add_argument('-j', '--workers', type=int, default=1,
+            help="files processed at once, -1 for one per CPU")
+    parser.add_argument('--field', default=None,
+            help="JSONL field holding the document, default from the config "
+            "or 'text'")
+    parser.add_argument('--format', choices=sorted(EXTENSIONS), default=None,
+            help="output format, default from the config or jsonl")
+    parser.add_argument('--compress', choices=['gz', 'bz2'], default=None,
+            help="compress text and jsonl output")
+    parser.add_argument('--spool-dir', default=None,
+            help="directory for the output of the steps before a barrier, "
+            "kept until the next pass reads it back, default from the config "
+            "or the system's temporary directory")
+    parser.add_argument('-v', '--verbose', action='store_true')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+    config = load_config(args.config)
+    field = args.field or config.get('field', 'text')
+    output_format = args.format or config.get('format', 'jsonl')
+    compress = args.compress or config.get('compress')
+    spool_dir = args.spool_dir or config.get('spool_dir')
+    workers = args.workers
+    if workers == -1:
+        workers = os.cpu_count() or 1
+
+    try:
+        tasks = shards(args.inputs, args.out_dir, output_format, compress)
+    except ValueError as e:
+        parser.error(str(e))
+    if not tasks:
+        parser.error("No input files")
+    workers = max(1, min(workers, len(tasks)))
+
+    start = time.time()
+    # Bigger files first, so that the last one to finish is short
+    tasks.sort(key=lambda task: -os.path.getsize(task[0]))
+    ids = config.get('ids', False)
+    with tempfile.TemporaryDirectory(dir=spool_dir) as spool_dir:
+        try:
+            steps, spools = _finish_barriers(build_pipeline(config).steps,
+                    ids, tasks, field, workers, spool_dir)
+        except ValueError as e:
+            parser.error(str(e))
+        if workers == 1:
+            _init_worker(steps, ids, field, spools)
+            docs, tokens = _collect(map(_run_shard, tasks))
+        else:
+            with multiprocessing.Pool(workers, initializer=_init_worker,
+                    initargs=(steps, ids, field, spools)) as pool:
+                docs, tokens = _collect(pool.imap_unordered(_run_shard,
+                    tasks))
+    elapsed = time.time() - start
+
+    print("{} files, {} documents, {} tokens in {:.1f}s with {} workers".format(
+        len(tasks), docs, tokens, elapsed, workers))
+    print("{:.1f} documents/s, {:.1f} tokens/s".format(
+        docs / elapsed if elapsed else 0.0,
+        tokens / elapsed if elapsed else 0.0))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())